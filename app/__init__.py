@@ -18,7 +18,7 @@ def create_app():
 
     db.init_app(app)
     migrate.init_app(app, db)
-    socketio.init_app(app)
+    socketio.init_app(app, message_queue=app.config["SOCKETIO_MESSAGE_QUEUE"])
     mail.init_app(app)
 
     with app.app_context():
@@ -36,6 +36,11 @@ def create_app():
 
         register_handlers(app)
 
+        # Import and register CLI commands
+        from app.commands import register_commands
+
+        register_commands(app)
+
         # Initialize Socket.IO events
         from app.events import init_socketio
 
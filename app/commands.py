@@ -0,0 +1,178 @@
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from app.models import User
+from app.services.counters import reconcile_counters
+from app.services.fragments import get_post_card_cache
+from app.services.friendships import migrate_legacy_friendships
+from app.services.indexes import check_query_plans, dedupe_unique_rows
+from app.services.memberships import dedupe_memberships
+from app.services.messages import rebuild_conversations
+from app.services.rendering import rerender_posts
+from app.services.search import reindex_search
+from app.services.tags import backfill_post_tags
+from app.services.tasks import retry_failed_jobs, work
+from app.services.timeline import rebuild_all_timelines
+from app.services.visibility import get_visibility_cache
+from app.utils.helpers import get_presigned_url_cache
+
+timeline_cli = AppGroup("timeline", help="Manage materialized home timelines.")
+counters_cli = AppGroup("counters", help="Manage denormalized counter columns.")
+conversations_cli = AppGroup("conversations", help="Manage the messages inbox.")
+tags_cli = AppGroup("tags", help="Manage the hashtag index.")
+search_cli = AppGroup("search", help="Manage the user and group search index.")
+posts_cli = AppGroup("posts", help="Manage stored post html.")
+friendships_cli = AppGroup("friendships", help="Manage the friendship table.")
+groups_cli = AppGroup("groups", help="Manage group memberships.")
+indexes_cli = AppGroup("indexes", help="Check indexes and unique constraints.")
+tasks_cli = AppGroup("tasks", help="Run background tasks stored in the database.")
+cache_cli = AppGroup("cache", help="Inspect the in-process caches.")
+
+# Caches with hit/miss metrics, by name
+CACHES = {
+    "presigned urls": get_presigned_url_cache,
+    "post cards": get_post_card_cache,
+    "visibility": get_visibility_cache,
+}
+
+
+@timeline_cli.command("rebuild")
+def rebuild_timeline_command():
+    """Recompute every user's timeline from posts, friends and groups"""
+    total = rebuild_all_timelines()
+    click.echo(f"Rebuilt timelines for {total} users.")
+
+
+@counters_cli.command("reconcile")
+def reconcile_counters_command():
+    """Recompute like, comment, friend and post counters from the source rows"""
+    reconcile_counters()
+    click.echo("Reconciled counters.")
+
+
+@conversations_cli.command("rebuild")
+def rebuild_conversations_command():
+    """Recompute every conversation summary from the messages"""
+    total = rebuild_conversations()
+    click.echo(f"Rebuilt {total} conversations.")
+
+
+@tags_cli.command("backfill")
+def backfill_tags_command():
+    """Rebuild the hashtag index from every post's content"""
+    total = backfill_post_tags()
+    click.echo(f"Indexed {total} post tags.")
+
+
+@search_cli.command("reindex")
+def reindex_search_command():
+    """Recompute the search column of every user and group"""
+    total = reindex_search()
+    click.echo(f"Reindexed {total} users and groups.")
+
+
+@posts_cli.command("rerender")
+def rerender_posts_command():
+    """Render html of posts stored by older link rules or before it was stored"""
+    total = rerender_posts()
+    click.echo(f"Rendered {total} posts.")
+
+
+@friendships_cli.command("migrate")
+def migrate_friendships_command():
+    """Copy friends and friend requests from the tables friendship replaced"""
+    total = migrate_legacy_friendships()
+    click.echo(f"Copied {total} friendship edges.")
+
+
+@groups_cli.command("dedupe")
+def dedupe_memberships_command():
+    """Remove duplicate admin and member rows before their primary keys are added"""
+    total = dedupe_memberships()
+    click.echo(f"Removed {total} duplicate membership rows.")
+
+
+@indexes_cli.command("dedupe")
+def dedupe_unique_rows_command():
+    """Remove duplicate likes and invitations before their unique indexes are added"""
+    total = dedupe_unique_rows()
+    click.echo(f"Removed {total} duplicate rows.")
+
+
+@indexes_cli.command("check")
+@click.option("--verbose", is_flag=True, help="Print the query plans.")
+def check_indexes_command(verbose):
+    """Explain the main queries and fail if one does not use its index"""
+    results = check_query_plans()
+
+    for name, index, used, plan in results:
+        click.echo(f"{'ok' if used else 'MISSING'}  {name}: {index}")
+        if verbose or not used:
+            click.echo(f"    {plan}".replace("\n", "\n    "))
+
+    if not all(used for _, _, used, _ in results):
+        raise SystemExit(1)
+
+
+@tasks_cli.command("work")
+@click.option("--batch", default=10, help="Jobs claimed at a time.")
+@click.option("--poll", default=1.0, help="Seconds to wait when no job is due.")
+@click.option("--once", is_flag=True, help="Run the due jobs once and exit.")
+def work_command(batch, poll, once):
+    """Run jobs queued with TASK_QUEUE=database until stopped"""
+    work(limit=batch, poll_interval=poll, once=once)
+
+
+@tasks_cli.command("retry")
+def retry_jobs_command():
+    """Queue jobs that failed every attempt again"""
+    total = retry_failed_jobs()
+    click.echo(f"Queued {total} failed jobs again.")
+
+
+@cache_cli.command("stats")
+@click.argument("paths", nargs=-1)
+@click.option("--user", "username", help="Request the paths as this user.")
+def cache_stats_command(paths, username):
+    """
+    Print hit/miss metrics of the caches. They are kept per process, so the
+    PATHS (e.g. / /my-feed) are requested in this process first.
+    """
+    if paths:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.BadParameter(
+                "Give the username to request as.", param_hint="--user"
+            )
+
+        client = current_app.test_client()
+        with client.session_transaction() as session:
+            session["user_id"] = user.id
+
+        for path in paths:
+            response = client.get(path)
+            click.echo(f"GET {path} {response.status_code}")
+
+    for name, get_cache in CACHES.items():
+        stats = get_cache().stats()
+        click.echo(
+            f"{name}: {stats['hits']} hits, {stats['shared_hits']} shared hits, "
+            f"{stats['misses']} misses ({stats['hit_rate']:.0%}), "
+            f"{stats['size']}/{stats['maxsize']} entries, "
+            f"{stats['evictions']} evictions"
+        )
+
+
+def register_commands(app):
+    app.cli.add_command(timeline_cli)
+    app.cli.add_command(counters_cli)
+    app.cli.add_command(conversations_cli)
+    app.cli.add_command(tags_cli)
+    app.cli.add_command(search_cli)
+    app.cli.add_command(posts_cli)
+    app.cli.add_command(friendships_cli)
+    app.cli.add_command(groups_cli)
+    app.cli.add_command(indexes_cli)
+    app.cli.add_command(tasks_cli)
+    app.cli.add_command(cache_cli)
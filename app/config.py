@@ -14,6 +14,65 @@ class Config:
 
     MAX_CONTENT_LENGTH = 1024 * 1024  # 1 MB
 
+    # Serve feeds from the materialized timeline table (run `flask timeline rebuild` first)
+    TIMELINE_ENABLED = os.getenv("TIMELINE_ENABLED", "false").lower() == "true"
+
+    # Socket.IO message queue (e.g. redis://localhost:6379/0) to emit across workers,
+    # unset uses the in-process manager which only reaches this worker's clients
+    SOCKETIO_MESSAGE_QUEUE = os.getenv("SOCKETIO_MESSAGE_QUEUE")
+
+    # "like" or "trigram" (PostgreSQL pg_trgm, also matches misspellings)
+    SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "like")
+
+    # Rendered post cards without viewer state, 0 disables the cache.
+    # A directory shares them between workers on the same host.
+    POST_CARD_CACHE_SIZE = int(os.getenv("POST_CARD_CACHE_SIZE", 1024))
+    POST_CARD_CACHE_TTL = int(os.getenv("POST_CARD_CACHE_TTL", 60))
+    POST_CARD_CACHE_DIR = os.getenv("POST_CARD_CACHE_DIR")
+
+    # Presigned S3 urls, reused until REFRESH_MARGIN seconds before they expire.
+    # A directory shares them between workers on the same host.
+    PRESIGNED_URL_CACHE_SIZE = int(os.getenv("PRESIGNED_URL_CACHE_SIZE", 2048))
+    PRESIGNED_URL_REFRESH_MARGIN = int(os.getenv("PRESIGNED_URL_REFRESH_MARGIN", 300))
+    PRESIGNED_URL_CACHE_DIR = os.getenv("PRESIGNED_URL_CACHE_DIR")
+
+    # Friend and group ids of users for feeds and group access
+    VISIBILITY_CACHE_SIZE = int(os.getenv("VISIBILITY_CACHE_SIZE", 4096))
+    VISIBILITY_CACHE_TTL = int(os.getenv("VISIBILITY_CACHE_TTL", 60))
+    VISIBILITY_CACHE_DIR = os.getenv("VISIBILITY_CACHE_DIR")
+
+    # Likes, comments, shares and invites of the same target within the window fold
+    # into one unread notification. Socket emits of it are sent once per delay.
+    NOTIFICATION_AGGREGATE_WINDOW = int(
+        os.getenv("NOTIFICATION_AGGREGATE_WINDOW", 3600)
+    )
+    NOTIFICATION_EMIT_DELAY = float(os.getenv("NOTIFICATION_EMIT_DELAY", 2))
+
+    # Background tasks (image uploads, notifications): "local" runs them in a pool of
+    # greenlets, "database" stores them for `flask tasks work`, "sync" runs inline
+    TASK_QUEUE = os.getenv("TASK_QUEUE", "local")
+    TASK_WORKERS = int(os.getenv("TASK_WORKERS", 4))
+    TASK_RETRIES = int(os.getenv("TASK_RETRIES", 3))
+    TASK_RETRY_DELAY = float(os.getenv("TASK_RETRY_DELAY", 1))
+    TASK_LEASE = int(os.getenv("TASK_LEASE", 300))
+
+    # Where uploaded images are stored: "s3", "local" (files in STORAGE_DIR) or
+    # "memory" (this process only). Local and memory objects are served under /media,
+    # for development, tests and benchmarks without AWS
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3")
+    STORAGE_DIR = os.getenv("STORAGE_DIR", "storage")
+
+    # Images the browser uploads straight to storage: largest size in bytes and
+    # seconds the upload form and its token stay valid
+    UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", 5 * 1024 * 1024))
+    UPLOAD_EXPIRES = int(os.getenv("UPLOAD_EXPIRES", 3600))
+
+    # S3 client, its connection pool is shared by all greenlets of a worker
+    S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50))
+    S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", 3))
+    S3_CONNECT_TIMEOUT = float(os.getenv("S3_CONNECT_TIMEOUT", 5))
+    S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT", 30))
+
     # Mail Settings
     # MAIL_SERVER = "smtp.mailgun.org"
     # MAIL_PORT = 587
@@ -1,19 +1,18 @@
-from flask import request, session
+from flask import session
+from flask_socketio import join_room
 
-connected_users = {}
+
+def user_room(user_id):
+    """Room every connection of the user joins, emit here to reach all tabs"""
+    return f"user:{user_id}"
 
 
 def init_socketio(socketio):
     @socketio.on("connect")
     def handle_connect():
+        # Connections leave their rooms on disconnect
         user_id = session.get("user_id")
         if user_id:
-            connected_users[user_id] = request.sid
-
-    @socketio.on("disconnect")
-    def handle_disconnect():
-        user_id = session.get("user_id")
-        if user_id in connected_users:
-            del connected_users[user_id]  # Remove SID when the user disconnects
+            join_room(user_room(user_id))
 
     return socketio
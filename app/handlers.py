@@ -1,11 +1,41 @@
-from flask import g, redirect, request, session, url_for
+from flask import abort, g, redirect, request, session, url_for
 
-from app.extensions import db
-from app.models import User
-from app.routes.auth_routes import logout
-from app.services.notifications import get_unread_notifications
-from app.services.queries import has_unread_messages
-from app.extensions import db
+from app.services.queries import get_user_with_unread_state
+
+
+def load_current_user():
+    """Current user, loaded by the load_user before request handler"""
+    if "user" in g:
+        return g.user
+
+    return _load_user()
+
+
+def _load_user():
+    """Load current user and navbar state from the session onto g"""
+    user_id = session.get("user_id")
+
+    if not user_id or request.endpoint == "static":
+        g.user = None
+        g.has_unread_messages = False
+        g.unread_notifications = None
+        return g.user
+
+    user, has_unread_messages, unread_notifications = get_user_with_unread_state(
+        user_id
+    )
+
+    g.user = user
+
+    if user is None:
+        g.has_unread_messages = False
+        g.unread_notifications = None
+        abort(404)
+
+    g.has_unread_messages = has_unread_messages
+    g.unread_notifications = unread_notifications
+
+    return g.user
 
 
 def register_handlers(app):
@@ -13,11 +43,9 @@ def register_handlers(app):
 
     @app.before_request
     def load_user():
-        user_id = session.get("user_id")
-        if user_id:
-            g.user = db.get_or_404(User, user_id)  # Load the user or 404 if not found
-        else:
-            g.user = None  # Set to None if no user is in session
+        # User with unread counters, unread notifications only queried if any.
+        # Always from the session, g outlives the request in an outer app context
+        _load_user()
 
     # Instead of passing @login_required routes manually
     @app.before_request
@@ -36,39 +64,10 @@ def register_handlers(app):
         if not g.user.is_completed and request.endpoint != "auth.complete_profile":
             return redirect(url_for("auth.complete_profile"))
 
-    @app.before_request
-    def load_unread_message_status():
-        user_id = session.get("user_id")
-
-        if user_id:
-            current_user = User.query.get(user_id)
-            if current_user:
-                g.has_unread_messages = has_unread_messages(current_user.id)
-            else:
-                g.has_unread_messages = False
-        else:
-            g.has_unread_messages = False
-
-    @app.before_request
-    def load_unread_notifications():
-        user_id = session.get("user_id")
-
-        if user_id:
-            current_user = User.query.get(user_id)
-            if current_user:
-                g.unread_notifications = get_unread_notifications(current_user.id)
-            else:
-                g.unread_notifications = []
-        else:
-            g.unread_notifications = None
-
     """ Context Processor """
 
     # Inject user variable to all pages
     # https://flask.palletsprojects.com/en/3.0.x/templating/#context-processors
     @app.context_processor
     def inject_user():
-        if "user_id" in session:
-            user = User.query.get(session["user_id"])
-            return dict(current_user=user)
-        return dict(current_user=None)
+        return dict(current_user=load_current_user())
@@ -9,47 +9,43 @@ from sqlalchemy import (
     Enum,
     ForeignKey,
     Integer,
+    LargeBinary,
+    PrimaryKeyConstraint,
     String,
     Table,
     Text,
+    and_,
+    event,
+    select,
+)
+from sqlalchemy.orm import (
+    Mapped,
+    aliased,
+    mapped_column,
+    query_expression,
+    relationship,
 )
-from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.sql import func
 
 from app.extensions import db
-from app.utils.helpers import get_presigned_url
-from app.utils.time_utils import format_message_time, format_time_ago
-
-# Association table for friends
-friends_table = Table(
-    "friends",
-    db.Model.metadata,
-    Column("user_id", Integer, ForeignKey("user.id", ondelete="CASCADE")),
-    Column("friend_id", Integer, ForeignKey("user.id", ondelete="CASCADE")),
-)
-
-# Association table for pending friend requests
-pending_requests_table = Table(
-    "pending_requests",
-    db.Model.metadata,
-    Column("user_id", Integer, ForeignKey("user.id", ondelete="CASCADE")),
-    Column("pending_id", Integer, ForeignKey("user.id", ondelete="CASCADE")),
-)
-
-# Association table for received friend requests
-received_requests_table = Table(
-    "received_requests",
-    db.Model.metadata,
-    Column("user_id", Integer, ForeignKey("user.id", ondelete="CASCADE")),
-    Column("request_id", Integer, ForeignKey("user.id", ondelete="CASCADE")),
+from app.utils.helpers import (
+    TEXT_RENDER_VERSION,
+    get_presigned_url,
+    normalize_search_text,
+    process_text,
 )
+from app.utils.images import variant_key
+from app.utils.time_utils import format_message_time, format_time_ago
 
-# Association table for group members
+# Association table for group members, admins are not listed as members
 group_members = Table(
     "members",
     db.Model.metadata,
     Column("user_id", Integer, ForeignKey("user.id", ondelete="CASCADE")),
     Column("group_id", Integer, ForeignKey("group.id", ondelete="CASCADE")),
+    PrimaryKeyConstraint("group_id", "user_id"),
+    # Groups of a user
+    db.Index("ix_members_user", "user_id"),
 )
 
 group_admins = Table(
@@ -57,11 +53,40 @@ group_admins = Table(
     db.Model.metadata,
     Column("user_id", Integer, ForeignKey("user.id", ondelete="CASCADE")),
     Column("group_id", Integer, ForeignKey("group.id", ondelete="CASCADE")),
+    PrimaryKeyConstraint("group_id", "user_id"),
+    db.Index("ix_admins_user", "user_id"),
+)
+
+# Users counted in a notification's actor_count, each once
+notification_actors = Table(
+    "notification_actors",
+    db.Model.metadata,
+    Column(
+        "notification_id",
+        Integer,
+        ForeignKey("notification.id", ondelete="CASCADE"),
+    ),
+    Column("user_id", Integer, ForeignKey("user.id", ondelete="CASCADE")),
+    PrimaryKeyConstraint("notification_id", "user_id"),
+    # Notifications a user already sent
+    db.Index("ix_notification_actors_user", "user_id"),
 )
 
 
+# Trigram index for search on PostgreSQL (needs the pg_trgm extension)
+def search_index(name):
+    return db.Index(
+        name,
+        "search_text",
+        postgresql_using="gin",
+        postgresql_ops={"search_text": "gin_trgm_ops"},
+    )
+
+
 # User model
 class User(db.Model):
+    __table_args__ = (search_index("ix_user_search_text"),)
+
     id: Mapped[int] = mapped_column(primary_key=True)
     username: Mapped[str] = mapped_column(String(80), unique=True, nullable=False)
     email: Mapped[str] = mapped_column(String(120), unique=True, nullable=False)
@@ -79,38 +104,19 @@ class User(db.Model):
     is_completed: Mapped[bool] = mapped_column(Boolean, default=False)
     is_private: Mapped[bool] = mapped_column(Boolean, default=False)
 
-    # Many-to-Many relationship for friends
-    friends: Mapped[List["User"]] = relationship(
-        "User",
-        secondary=friends_table,
-        primaryjoin=id == friends_table.c.user_id,
-        secondaryjoin=id == friends_table.c.friend_id,
-        backref="friends_with",
-        cascade="all, delete",
-        passive_deletes=True,
+    # Denormalized counters, kept up to date by app/services/counters.py
+    friend_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    post_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    unread_message_count: Mapped[int] = mapped_column(
+        Integer, default=0, server_default="0"
     )
-
-    # Many-to-Many relationship for pending friend requests
-    pending_requests: Mapped[List["User"]] = relationship(
-        "User",
-        secondary=pending_requests_table,
-        primaryjoin=id == pending_requests_table.c.user_id,
-        secondaryjoin=id == pending_requests_table.c.pending_id,
-        backref="pending_from",
-        cascade="all, delete",
-        passive_deletes=True,
+    unread_notification_count: Mapped[int] = mapped_column(
+        Integer, default=0, server_default="0"
     )
 
-    # Many-to-Many relationship for received friend requests
-    received_requests: Mapped[List["User"]] = relationship(
-        "User",
-        secondary=received_requests_table,
-        primaryjoin=id == received_requests_table.c.user_id,
-        secondaryjoin=id == received_requests_table.c.request_id,
-        backref="received_from",
-        cascade="all, delete",
-        passive_deletes=True,
-    )
+    # Normalized name, surname and username, kept up to date on flush
+    search_text: Mapped[Optional[str]] = mapped_column(Text)
+    search_score: Mapped[Optional[int]] = query_expression()
 
     posts: Mapped[List["Post"]] = relationship(
         back_populates="user", cascade="all, delete"
@@ -187,14 +193,61 @@ class User(db.Model):
     def __repr__(self) -> str:
         return super().__repr__()
 
+    def build_search_text(self) -> str:
+        return normalize_search_text(self.name, self.surname, self.username)
+
+    def friendship_state(self, user_id):
+        """State of the edge from this user to user_id, a primary key lookup"""
+        friendship = db.session.get(Friendship, (self.id, user_id))
+        return friendship.state if friendship else None
+
     def is_friends(self, user_id):
-        return any(friend.id == user_id for friend in self.friends)
+        return self.friendship_state(user_id) == FriendshipState.FRIENDS
+
+    def total_requests(self) -> int:
+        return db.session.scalar(
+            select(func.count()).where(
+                Friendship.user_id == self.id,
+                Friendship.state == FriendshipState.RECEIVED,
+            )
+        )
 
     def total_friends(self) -> int:
-        return len(self.friends)
+        return self.friend_count or 0
 
     def total_posts(self) -> int:
-        return len(self.posts)
+        return self.post_count or 0
+
+
+class FriendshipState(enum.Enum):
+    FRIENDS = "friends"
+    # user_id sent a request to other_id
+    REQUESTED = "requested"
+    # other_id sent a request to user_id
+    RECEIVED = "received"
+
+
+# Relationship between two users, stored from both sides so the state from
+# either user is a primary key lookup and a user's friends a prefix scan
+class Friendship(db.Model):
+    user_id: Mapped[int] = mapped_column(
+        ForeignKey("user.id", ondelete="CASCADE"), primary_key=True
+    )
+    other_id: Mapped[int] = mapped_column(
+        ForeignKey("user.id", ondelete="CASCADE"), primary_key=True
+    )
+    state: Mapped[FriendshipState] = mapped_column(
+        Enum(FriendshipState), nullable=False
+    )
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+
+    # Cascading deletes of the other user
+    __table_args__ = (db.Index("ix_friendship_other", "other_id"),)
+
+    def __repr__(self):
+        return f"<Friendship {self.user_id} {self.state.value} {self.other_id}>"
 
 
 # Post model
@@ -215,6 +268,21 @@ class Post(db.Model):
     content: Mapped[str] = mapped_column(Text, nullable=False)
     shares: Mapped[int] = mapped_column(Integer, default=0)
 
+    # process_text output stored on insert, re-rendered on version changes
+    content_html: Mapped[Optional[str]] = mapped_column(Text)
+    content_html_version: Mapped[Optional[int]] = mapped_column(Integer)
+
+    like_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    comment_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+
+    # Community feed, profile and group pages, newest first; reshares of a post
+    __table_args__ = (
+        db.Index("ix_post_created", "created_at"),
+        db.Index("ix_post_user_created", "user_id", "created_at"),
+        db.Index("ix_post_group_created", "group_id", "created_at"),
+        db.Index("ix_post_parent", "parent_id"),
+    )
+
     # Likes
     likes: Mapped[List["Like"]] = relationship(
         primaryjoin="and_(Like.post_id == Post.id, Like.post_id.isnot(None))",
@@ -244,19 +312,38 @@ class Post(db.Model):
     # Group relation
     group: Mapped["Group"] = relationship(back_populates="posts", passive_deletes=True)
 
+    # Filled by post_card_options() so cards don't load likes
+    liked_by_viewer: Mapped[Optional[bool]] = query_expression()
+
     def __repr__(self) -> str:
         return f"<Post {self.id} by User {self.user_id}>"
 
+    def render_content(self):
+        self.content_html = process_text(self.content)
+        self.content_html_version = TEXT_RENDER_VERSION
+
+    # Stored html unless it was rendered by older rules
+    def rendered_content(self) -> str:
+        if self.content_html_version == TEXT_RENDER_VERSION:
+            return self.content_html
+
+        return process_text(self.content)
+
+    # Uses liked_by_viewer when loaded for the viewing user
     def is_liked_by_user(self, user_id):
+        if self.liked_by_viewer is not None:
+            return bool(self.liked_by_viewer)
         return any(like.user_id == user_id for like in self.likes)
 
     def total_likes(self) -> int:
-        return len(self.likes)
+        return self.like_count or 0
 
     def total_comments(self) -> int:
-        return len(self.comments)
+        return self.comment_count or 0
 
     def latest_comments(self, limit=3):
+        if limit <= LATEST_COMMENTS_LIMIT:
+            return self.recent_comments[:limit]
         return self.comments[:limit]
 
 
@@ -275,6 +362,11 @@ class Comment(db.Model):
         DateTime(timezone=True), default=func.now()
     )
 
+    like_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+
+    # Comments of a post and its latest comments on post cards
+    __table_args__ = (db.Index("ix_comment_post_created", "post_id", "created_at"),)
+
     post: Mapped["Post"] = relationship(back_populates="comments")
     user: Mapped["User"] = relationship(passive_deletes=True)
 
@@ -285,14 +377,20 @@ class Comment(db.Model):
         passive_deletes=True,
     )
 
+    # Filled by post_card_options() so cards don't load likes
+    liked_by_viewer: Mapped[Optional[bool]] = query_expression()
+
     def __repr__(self) -> str:
         return f"<Comment {self.id} on Post {self.post_id}>"
 
+    # Uses liked_by_viewer when loaded for the viewing user
     def is_liked_by_user(self, user_id):
+        if self.liked_by_viewer is not None:
+            return bool(self.liked_by_viewer)
         return any(like.user_id == user_id for like in self.likes)
 
     def total_likes(self) -> int:
-        return len(self.likes)
+        return self.like_count or 0
 
 
 # Like model
@@ -312,12 +410,14 @@ class Like(db.Model):
         DateTime(timezone=True), default=func.now()
     )
 
-    # One of post_id or comment_id must be filled
+    # One of post_id or comment_id must be filled, once per user
     __table_args__ = (
         db.CheckConstraint(
             "(post_id IS NOT NULL AND comment_id IS NULL) OR (post_id IS NULL AND comment_id IS NOT NULL)",
             name="like_on_one_type",
         ),
+        db.Index("uq_like_post_user", "post_id", "user_id", unique=True),
+        db.Index("uq_like_comment_user", "comment_id", "user_id", unique=True),
     )
 
     # Relationship to post and comment
@@ -348,6 +448,13 @@ class Message(db.Model):
     )
     is_read: Mapped[bool] = mapped_column(Boolean, default=False)
 
+    # Unread messages of a user and the history of a conversation (both
+    # directions are read with two scans of the same index)
+    __table_args__ = (
+        db.Index("ix_message_recipient_read", "recipient_id", "is_read"),
+        db.Index("ix_message_pair_created", "sender_id", "recipient_id", "created_at"),
+    )
+
     sender: Mapped["User"] = relationship(
         foreign_keys=[sender_id], back_populates="sent_messages"
     )
@@ -364,7 +471,7 @@ class Message(db.Model):
             "content": self.content,
             "sender_id": self.sender_id,
             "sender": {
-                "image": get_presigned_url(self.sender.image),
+                "image": get_presigned_url(variant_key(self.sender.image, "thumb")),
                 "name": self.sender.name,
                 "surname": self.sender.surname,
             },
@@ -374,6 +481,47 @@ class Message(db.Model):
         }
 
 
+# Latest state of the conversation between two users, user1_id < user2_id
+class Conversation(db.Model):
+    PREVIEW_LENGTH = 255
+
+    user1_id: Mapped[int] = mapped_column(
+        ForeignKey("user.id", ondelete="CASCADE"), primary_key=True
+    )
+    user2_id: Mapped[int] = mapped_column(
+        ForeignKey("user.id", ondelete="CASCADE"), primary_key=True
+    )
+    last_message_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey("message.id", ondelete="SET NULL")
+    )
+    last_sender_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    last_message_preview: Mapped[str] = mapped_column(
+        String(PREVIEW_LENGTH), nullable=False
+    )
+    last_message_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+    user1_unread: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    user2_unread: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+
+    user1: Mapped["User"] = relationship(foreign_keys=[user1_id])
+    user2: Mapped["User"] = relationship(foreign_keys=[user2_id])
+
+    __table_args__ = (
+        db.Index("ix_conversation_user1_last", "user1_id", "last_message_at"),
+        db.Index("ix_conversation_user2_last", "user2_id", "last_message_at"),
+    )
+
+    def __repr__(self):
+        return f"<Conversation {self.user1_id} and {self.user2_id}>"
+
+    def other_user(self, user_id):
+        return self.user2 if user_id == self.user1_id else self.user1
+
+    def unread_count(self, user_id):
+        return self.user1_unread if user_id == self.user1_id else self.user2_unread
+
+
 # Notification Enum
 class NotificationEnum(enum.Enum):
     FRIEND_REQUEST = "friend_request"
@@ -416,6 +564,22 @@ class Notification(db.Model):
         DateTime(timezone=True), default=func.now()
     )
 
+    # Events folded into this notification, sender_id is the latest actor.
+    # Comma separated ids of the latest actors, most recent first.
+    actor_count: Mapped[int] = mapped_column(Integer, default=1, server_default="1")
+    recent_actor_ids: Mapped[Optional[str]] = mapped_column(Text)
+
+    # Unread dropdown and the notifications page, newest first
+    __table_args__ = (
+        db.Index(
+            "ix_notification_recipient_read_created",
+            "recipient_id",
+            "is_read",
+            "created_at",
+        ),
+        db.Index("ix_notification_recipient_created", "recipient_id", "created_at"),
+    )
+
     # Relationships
     recipient: Mapped["User"] = relationship(
         foreign_keys=[recipient_id],
@@ -436,6 +600,12 @@ class Notification(db.Model):
     def __repr__(self):
         return f"<Notification {self.id} from {self.sender_id} to {self.recipient_id}>"
 
+    def recent_actors(self):
+        """Ids of the latest actors, most recent first"""
+        if not self.recent_actor_ids:
+            return [self.sender_id]
+        return [int(actor_id) for actor_id in self.recent_actor_ids.split(",")]
+
     def to_dict(self):
         """Convert notification to dictionary for JSON serialization"""
         return {
@@ -443,10 +613,11 @@ class Notification(db.Model):
             "type": self.notification_type.value,
             "sender_name": f"{self.sender.name} {self.sender.surname}",
             "sender_username": self.sender.username,
-            "sender_image": get_presigned_url(self.sender.image),
+            "sender_image": get_presigned_url(variant_key(self.sender.image, "thumb")),
             "created_at": format_time_ago(self.created_at),
             "created_at_iso": self.created_at.isoformat(),
             "is_read": self.is_read,
+            "actor_count": self.actor_count or 1,
             "post_id": self.post_id,
             "comment_id": self.comment_id,
             "group_id": self.group_id,
@@ -466,6 +637,8 @@ class GroupRole(enum.Enum):
 
 
 class Group(db.Model):
+    __table_args__ = (search_index("ix_group_search_text"),)
+
     id: Mapped[int] = mapped_column(primary_key=True)
     owner_id: Mapped[int] = mapped_column(
         ForeignKey("user.id", ondelete="CASCADE"), nullable=False
@@ -482,6 +655,12 @@ class Group(db.Model):
         nullable=False,
     )
 
+    post_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+
+    # Normalized name and about, kept up to date on flush
+    search_text: Mapped[Optional[str]] = mapped_column(Text)
+    search_score: Mapped[Optional[int]] = query_expression()
+
     owner: Mapped["User"] = relationship(
         back_populates="owned_groups", passive_deletes=True
     )
@@ -525,40 +704,44 @@ class Group(db.Model):
     def __repr__(self):
         return f"<Group {self.id} by {self.owner_id}>"
 
+    def build_search_text(self) -> str:
+        return normalize_search_text(self.name, self.about)
+
+    # Owner, admin, member or None, memoized for the request
+    def role_of(self, user: User) -> Optional[GroupRole]:
+        # Imported here, the services import the models
+        from app.services.memberships import get_group_role
+
+        return get_group_role(self, user.id)
+
     def can_post(self, user: User) -> bool:
-        return user == self.owner or user in self.admins or user in self.members
+        return self.role_of(user) is not None
 
     def total_posts(self) -> int:
-        return len(self.posts)
+        return self.post_count or 0
 
     # Check if a user can remove another user or post from the group
     def can_remove_user(self, user: User, target_user: User) -> bool:
-        if user == self.owner:
-            return target_user != self.owner
-
-        elif user in self.admins:
-            return (
-                target_user != self.owner
-                and target_user not in self.admins
-                and target_user in self.members
-            )
+        role = self.role_of(user)
+
+        if role == GroupRole.OWNER:
+            return target_user.id != self.owner_id
+
+        elif role == GroupRole.ADMIN:
+            return self.role_of(target_user) == GroupRole.MEMBER
 
         return False
 
     # Remove a user from the group
     def remove_user(self, user: User):
-        if user in self.admins:
-            self.admins.remove(user)
-        if user in self.members:
-            self.members.remove(user)
+        from app.services.memberships import remove_from_group
+
+        remove_from_group(self, user.id)
 
     def can_view(self, user: User) -> bool:
-        return (
-            self.group_type == GroupType.PUBLIC
-            or user == self.owner
-            or user in self.admins
-            or user in self.members
-        )
+        # Live membership, the cached visibility only filters feeds and can lag
+        # behind removals on other workers
+        return self.group_type == GroupType.PUBLIC or self.role_of(user) is not None
 
     def get_admins(self, limit=3):
         return self.admins[:limit]
@@ -570,7 +753,48 @@ class Group(db.Model):
         return any(invitation.invitee_id == user.id for invitation in self.invitations)
 
     def is_member(self, user: User) -> bool:
-        return self.owner_id == user.id or user in self.admins or user in self.members
+        return self.role_of(user) is not None
+
+
+# Materialized home timeline, filled when posts are written (fan-out on write)
+class TimelineEntry(db.Model):
+    __tablename__ = "timeline"
+
+    user_id: Mapped[int] = mapped_column(
+        ForeignKey("user.id", ondelete="CASCADE"), primary_key=True
+    )
+    post_id: Mapped[int] = mapped_column(
+        ForeignKey("post.id", ondelete="CASCADE"), primary_key=True
+    )
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+
+    __table_args__ = (db.Index("ix_timeline_user_created", "user_id", "created_at"),)
+
+    def __repr__(self):
+        return f"<TimelineEntry Post {self.post_id} for User {self.user_id}>"
+
+
+# Hashtags extracted from post content, created_at is copied from the post
+class PostTag(db.Model):
+    __tablename__ = "post_tags"
+
+    tag: Mapped[str] = mapped_column(String(100), primary_key=True)
+    post_id: Mapped[int] = mapped_column(
+        ForeignKey("post.id", ondelete="CASCADE"), primary_key=True
+    )
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+
+    __table_args__ = (
+        db.Index("ix_post_tags_tag_created", "tag", "created_at"),
+        db.Index("ix_post_tags_created", "created_at"),
+    )
+
+    def __repr__(self):
+        return f"<PostTag #{self.tag} on Post {self.post_id}>"
 
 
 class Invitation(db.Model):
@@ -588,6 +812,11 @@ class Invitation(db.Model):
         DateTime(timezone=True), default=func.now()
     )
 
+    # A user has at most one pending invitation to a group
+    __table_args__ = (
+        db.Index("uq_invitation_group_invitee", "group_id", "invitee_id", unique=True),
+    )
+
     group: Mapped["Group"] = relationship(
         back_populates="invitations", passive_deletes=True
     )
@@ -601,3 +830,65 @@ class Invitation(db.Model):
         back_populates="received_invitations",
         passive_deletes=True,
     )
+
+
+# Background task stored for `flask tasks work` when TASK_QUEUE is "database".
+# run_at is pushed forward while a worker runs the job and is None once it failed
+# every attempt.
+class Job(db.Model):
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # Task function as "module:name" and its msgpack encoded [args, kwargs]
+    name: Mapped[str] = mapped_column(String(200), nullable=False)
+    payload: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+    attempts: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    last_error: Mapped[Optional[str]] = mapped_column(Text)
+    run_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), default=func.now()
+    )
+
+    # Workers claim the due jobs, oldest first
+    __table_args__ = (db.Index("ix_job_run_at", "run_at"),)
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.name}>"
+
+
+# Latest comments of each post, lets post cards eager-load them in one query
+# https://docs.sqlalchemy.org/en/20/orm/join_conditions.html#row-limited-relationships-with-window-functions
+LATEST_COMMENTS_LIMIT = 3
+
+_ranked_comments = select(
+    Comment,
+    func.row_number()
+    .over(partition_by=Comment.post_id, order_by=Comment.created_at.desc())
+    .label("row_number"),
+).subquery()
+
+LatestComment = aliased(Comment, _ranked_comments)
+
+Post.recent_comments = relationship(
+    LatestComment,
+    primaryjoin=and_(
+        LatestComment.post_id == Post.id,
+        _ranked_comments.c.row_number <= LATEST_COMMENTS_LIMIT,
+    ),
+    order_by=_ranked_comments.c.row_number,
+    viewonly=True,
+)
+
+
+# Posts are immutable, render their html once
+@event.listens_for(Post, "before_insert")
+def _render_post_content(mapper, connection, target):
+    target.render_content()
+
+
+# Keep search columns in sync with the searched fields
+@event.listens_for(User, "before_insert")
+@event.listens_for(User, "before_update")
+@event.listens_for(Group, "before_insert")
+@event.listens_for(Group, "before_update")
+def _update_search_text(mapper, connection, target):
+    target.search_text = target.build_search_text()
@@ -1,4 +1,4 @@
-from flask import flash, redirect, render_template, request, session, url_for
+from flask import flash, g, redirect, render_template, request, session, url_for
 from werkzeug.security import check_password_hash, generate_password_hash
 
 from app.extensions import db
@@ -71,13 +71,13 @@ def register():
 
 @auth_bp.route("/register/complete", methods=["GET", "POST"])
 def complete_profile():
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     if current_user.is_completed:
         return redirect(url_for("main.feed"))
 
     if request.method == "POST":
         # Ensure user exists
-        user = db.get_or_404(User, session["user_id"])
+        user = g.user
         if not user:
             return redirect(url_for("auth.login"))
 
@@ -97,10 +97,10 @@ def complete_profile():
             flash("Please fill the required fields!", "error")
             return redirect(url_for("auth.complete_profile"))
 
-        image_key = upload_file_to_s3(image)
+        # Recorded on the user once it is stored
+        upload_file_to_s3(image, user.id)
 
         # Update user
-        user.image = image_key
         user.name = name
         user.surname = surname
         user.location = location
@@ -2,12 +2,14 @@ from flask import url_for
 from markupsafe import Markup
 
 from app.routes import filters_bp
+from app.services.fragments import render_post_card
 from app.utils.helpers import (
     create_notification_link,
     create_notification_message,
     get_presigned_url,
     process_text,
 )
+from app.utils.images import variant_key
 from app.utils.time_utils import format_message_time, format_time_ago
 
 
@@ -36,8 +38,22 @@ def process_text_filter(text):
     processed = process_text(text)
     return Markup(processed)
 
+
+# Stored html of the post, processed live only if missing or outdated
+@filters_bp.app_template_filter("post_content")
+def post_content_filter(post):
+    return Markup(post.rendered_content())
+
+
+# Size is a key of IMAGE_SIZES: thumb, medium or full
 @filters_bp.app_template_filter('s3_url')
-def s3_url_filter(key, type='user'):
+def s3_url_filter(key, type='user', size='full'):
    if not key:
        return url_for('static', filename='placeholder.jpg' if type == 'user' else 'group_placeholder.jpg')
-   return get_presigned_url(key)
\ No newline at end of file
+   return get_presigned_url(variant_key(key, size))
+
+
+# Post card with the viewer's like state and delete buttons, cached per post
+@filters_bp.app_template_global("render_post_card")
+def render_post_card_global(post, current_user, group=None, display_group=True):
+    return render_post_card(post, current_user, group, display_group)
@@ -1,6 +1,7 @@
 from flask import (
     abort,
     flash,
+    g,
     jsonify,
     redirect,
     render_template,
@@ -10,9 +11,23 @@ from flask import (
 )
 
 from app.extensions import db
-from app.models import Group, Invitation, NotificationEnum, Post, User
+from app.models import Group, GroupRole, Invitation, NotificationEnum, Post, User
 from app.routes import group_bp
-from app.services.notifications import create_notification, emit_notification
+from app.services.counters import increment, release_group_counters
+from app.services.fragments import invalidate_all_post_cards
+from app.services.memberships import (
+    add_member,
+    create_invitation,
+    demote_to_member,
+    group_user_ids,
+    promote_to_admin,
+    remove_from_group,
+)
+from app.services.notifications import (
+    create_notification,
+    emit_notification,
+    notify,
+)
 from app.services.queries import (
     get_group_admins,
     get_group_members,
@@ -20,16 +35,26 @@ from app.services.queries import (
     get_groups,
     get_users_to_invite,
 )
-from app.utils.helpers import allowed_file, delete_file_from_s3, upload_file_to_s3
+from app.services.tags import index_post_tags
+from app.services.timeline import backfill_group, prune_group, push_post
+from app.services.visibility import invalidate_visibility
+from app.utils.helpers import (
+    allowed_file,
+    complete_upload,
+    delete_file_from_s3,
+    upload_file_to_s3,
+)
+from app.utils.images import validate_image
 
 
 @group_bp.route("/groups")
 def index():
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
     search_query = request.args.get("q")
 
     # Get groups
-    pagination = get_groups(page=page, search_query=search_query)
+    pagination = get_groups(page=page, search_query=search_query, cursor=cursor)
 
     return render_template(
         "groups/index.html",
@@ -43,11 +68,15 @@ def index():
 @group_bp.route("/my-groups")
 def my_groups():
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
     search_query = request.args.get("q")
 
     # Get groups
     pagination = get_groups(
-        page=page, search_query=search_query, user_id=session["user_id"]
+        page=page,
+        search_query=search_query,
+        user_id=session["user_id"],
+        cursor=cursor,
     )
 
     return render_template(
@@ -74,11 +103,8 @@ def create():
             flash("Please fill the required fields!", "error")
             return redirect(url_for("group.create"))
 
-        image_key = upload_file_to_s3(image, folder="group-image")
-
         group = Group(
             owner_id=session["user_id"],
-            image=image_key,
             name=name,
             about=about,
             group_type=privacy,
@@ -87,7 +113,11 @@ def create():
         # Save changes
         try:
             db.session.add(group)
+            # Group must be flushed to have an id for its image
+            db.session.flush()
+            upload_file_to_s3(image, group.id, folder="group-image")
             db.session.commit()
+            invalidate_visibility(group.owner_id)
             flash("Successfully created a group.", "success")
             return redirect(url_for("group.page", id=group.id))
         except:
@@ -103,7 +133,7 @@ def page(id):
     group = db.get_or_404(Group, id)
 
     if request.method == "POST":
-        current_user = db.get_or_404(User, session["user_id"])
+        current_user = g.user
         if not group.can_post(current_user):
             flash("You don't have permission to post in this group", "error")
             return redirect(url_for("group.page", id=id))
@@ -111,10 +141,17 @@ def page(id):
         content = request.form["content"]
         post = Post(content=content, user_id=session["user_id"], group_id=group.id)
         db.session.add(post)
+        push_post(post)
+        index_post_tags(post)
+        increment(User.post_count, post.user_id)
+        increment(Group.post_count, group.id)
         db.session.commit()
 
     page = request.args.get("page", 1, type=int)
-    pagination = get_group_posts(group_id=group.id, page=page)
+    cursor = request.args.get("cursor")
+    pagination = get_group_posts(
+        group_id=group.id, page=page, cursor=cursor, viewer_id=session["user_id"]
+    )
 
     return render_template(
         "groups/group/index.html",
@@ -138,23 +175,16 @@ def invite(id):
 
         user = db.get_or_404(User, user_id)
 
-        if user in group.members or user in group.admins or user == group.owner:
+        if group.is_member(user):
             return jsonify({"error": "User already in group"}), 400
 
-        existing_invitation = Invitation.query.filter_by(
-            group_id=group.id, invitee_id=user.id, inviter_id=session["user_id"]
-        ).first()
+        invitation = create_invitation(group, user.id, session["user_id"])
 
-        if existing_invitation:
+        if not invitation:
             return jsonify({"error": "Invitation already sent"}), 400
 
-        invitation = Invitation(
-            group_id=group.id, invitee_id=user.id, inviter_id=session["user_id"]
-        )
-
-        db.session.add(invitation)
-
-        notification = create_notification(
+        # Notify the user in the background, once the invitation is committed
+        notify(
             recipient_id=user.id,
             sender_id=session["user_id"],
             group_id=group.id,
@@ -163,15 +193,13 @@ def invite(id):
 
         db.session.commit()
 
-        # Emit notification with SocketIO
-        emit_notification(notification)
-
         return "success", 200
 
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
     search_query = request.args.get("q")
     pagination = get_users_to_invite(
-        page=page, search_query=search_query, group_id=group.id
+        page=page, search_query=search_query, group_id=group.id, cursor=cursor
     )
 
     return render_template(
@@ -202,7 +230,8 @@ def members(id):
 def all_admins(id):
     group = db.get_or_404(Group, id)
     page = request.args.get("page", 1, type=int)
-    pagination = get_group_admins(group_id=group.id, page=page)
+    cursor = request.args.get("cursor")
+    pagination = get_group_admins(group_id=group.id, page=page, cursor=cursor)
 
     return render_template(
         "groups/group/all_admins.html",
@@ -217,7 +246,8 @@ def all_admins(id):
 def all_members(id):
     group = db.get_or_404(Group, id)
     page = request.args.get("page", 1, type=int)
-    pagination = get_group_members(group_id=group.id, page=page)
+    cursor = request.args.get("cursor")
+    pagination = get_group_members(group_id=group.id, page=page, cursor=cursor)
 
     return render_template(
         "groups/group/all_members.html",
@@ -239,6 +269,8 @@ def settings(id):
     if request.method == "POST":
 
         image = request.files.get("image")
+        # Token of an image the browser uploaded straight to storage
+        upload = request.form.get("upload")
         name = request.form["name"]
         about = request.form["about"]
         privacy = request.form["privacy"]
@@ -248,17 +280,26 @@ def settings(id):
             flash("Please fill the required fields!", "error")
             return redirect(url_for("group.create"))
 
+        # Name and image are shown on cards of the group's posts
+        card_fields = (group.name, group.image)
+
         group.name = name
         group.about = about
         group.group_type = privacy
 
-        if image.filename:
-            if not allowed_file(image.filename):
+        if upload:
+            # The image replaces the current one once it is stored
+            image_key = complete_upload(
+                upload, g.user.id, folder="group-image", group_id=group.id
+            )
+            if image_key is None:
                 return abort(422)
 
-            delete_file_from_s3(group.image)
-            image_key = upload_file_to_s3(image, folder="group-image")
-            group.image = image_key
+        elif image.filename:
+            if not allowed_file(image.filename) or not validate_image(image.stream):
+                return abort(422)
+
+            upload_file_to_s3(image, group.id, folder="group-image")
 
         elif group.image and delete_image and not image.filename:
             delete_file_from_s3(group.image)
@@ -267,6 +308,8 @@ def settings(id):
         # Save changes
         try:
             db.session.commit()
+            if card_fields != (group.name, group.image):
+                invalidate_all_post_cards()
             flash("Successfully updated the group.", "success")
         except:
             db.session.rollback()
@@ -281,7 +324,8 @@ def settings(id):
 def settings_admins(id):
     group = db.get_or_404(Group, id)
     page = request.args.get("page", 1, type=int)
-    pagination = get_group_admins(group_id=id, page=page)
+    cursor = request.args.get("cursor")
+    pagination = get_group_admins(group_id=id, page=page, cursor=cursor)
 
     return render_template(
         "groups/group/all_admins.html",
@@ -298,8 +342,14 @@ def delete_group(id):
         Group.id == id, Group.owner_id == session["user_id"]
     ).first_or_404()
 
+    delete_file_from_s3(group.image)
+    release_group_counters(group.id)
+    user_ids = db.session.execute(group_user_ids(group.id)).scalars().all()
     db.session.delete(group)
     db.session.commit()
+    invalidate_visibility(*user_ids)
+    # Reshares of the group's posts show them as deleted
+    invalidate_all_post_cards()
 
     flash(f"Group {group.name} deleted successfully.", "success")
     return redirect(url_for("main.feed"))
@@ -321,12 +371,14 @@ def post(id, post_id):
 
 @group_bp.route("/groups/<id>/join", methods=["POST"])
 def join_group(id):
-    user = db.get_or_404(User, session["user_id"])
+    user = g.user
     group = db.get_or_404(Group, id)
 
-    group.members.append(user)
+    if add_member(group, user.id):
+        backfill_group(user.id, group.id)
 
     db.session.commit()
+    invalidate_visibility(user.id)
 
     flash(f"You have joined {group.name}!", "success")
     return "success", 200
@@ -334,7 +386,7 @@ def join_group(id):
 
 @group_bp.route("/groups/<id>/invite/accept", methods=["POST"])
 def accept_invite(id):
-    user = db.get_or_404(User, session["user_id"])
+    user = g.user
     group = db.get_or_404(Group, id)
 
     invitation = Invitation.query.filter_by(
@@ -342,7 +394,8 @@ def accept_invite(id):
         invitee_id=user.id,
     ).first_or_404()
 
-    group.members.append(user)
+    if add_member(group, user.id):
+        backfill_group(user.id, group.id)
     db.session.delete(invitation)
 
     # Send notification to inviter
@@ -354,6 +407,7 @@ def accept_invite(id):
     )
 
     db.session.commit()
+    invalidate_visibility(user.id)
 
     # Emit notification with SocketIO
     emit_notification(notification)
@@ -364,7 +418,7 @@ def accept_invite(id):
 
 @group_bp.route("/groups/<id>/invite/decline", methods=["POST"])
 def decline_invite(id):
-    user = db.get_or_404(User, session["user_id"])
+    user = g.user
     group = db.get_or_404(Group, id)
 
     invitation = Invitation.query.filter_by(
@@ -382,12 +436,14 @@ def decline_invite(id):
 
 @group_bp.route("/groups/<id>/leave", methods=["POST"])
 def leave(id):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
 
     group = db.get_or_404(Group, id)
 
     group.remove_user(current_user)
+    prune_group(current_user.id, group.id)
     db.session.commit()
+    invalidate_visibility(current_user.id)
 
     flash(f"You left {group.name}!", "success")
     return redirect(url_for("group.page", id=id))
@@ -395,7 +451,7 @@ def leave(id):
 
 @group_bp.route("/groups/<id>/remove-user/<user_id>", methods=["POST"])
 def remove_user(id, user_id):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     target_user = db.get_or_404(User, user_id)
     group = db.get_or_404(Group, id)
 
@@ -404,12 +460,12 @@ def remove_user(id, user_id):
         return "unauthorized", 401
 
     # Remove from appropriate list
-    if target_user in group.admins:
-        group.admins.remove(target_user)
-    if target_user in group.members:
-        group.members.remove(target_user)
+    remove_from_group(group, target_user.id)
+
+    prune_group(target_user.id, group.id)
 
     db.session.commit()
+    invalidate_visibility(target_user.id)
 
     flash(f"Removed {target_user.name} {target_user.surname} from the group", "success")
     return "success", 200
@@ -417,7 +473,7 @@ def remove_user(id, user_id):
 
 @group_bp.route("/groups/<id>/make-admin/<user_id>", methods=["POST"])
 def make_admin(id, user_id):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     target_user = db.get_or_404(User, user_id)
     group = db.get_or_404(Group, id)
 
@@ -425,17 +481,18 @@ def make_admin(id, user_id):
         flash("Only owner or admins can remove a user from the group", "error")
         return "unauthorized", 401
 
-    if target_user not in group.members:
-        flash("User must be a member to be made admin", "error")
-        return "not found", 404
+    role = group.role_of(target_user)
 
-    if target_user in group.admins:
+    if role == GroupRole.ADMIN:
         flash("User is already an admin", "error")
         return "bad request", 400
 
+    if role != GroupRole.MEMBER:
+        flash("User must be a member to be made admin", "error")
+        return "not found", 404
+
     # Move from member to admin
-    group.members.remove(target_user)
-    group.admins.append(target_user)
+    promote_to_admin(group, target_user.id)
 
     # Send notification to new admin
     notification = create_notification(
@@ -456,7 +513,7 @@ def make_admin(id, user_id):
 
 @group_bp.route("/groups/<id>/revoke-admin/<user_id>", methods=["POST"])
 def revoke_admin(id, user_id):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     target_user = db.get_or_404(User, user_id)
     group = db.get_or_404(Group, id)
 
@@ -464,13 +521,12 @@ def revoke_admin(id, user_id):
         flash("Only the owner can revoke admin privileges", "error")
         return "unauthorized", 401
 
-    if target_user not in group.admins:
+    if group.role_of(target_user) != GroupRole.ADMIN:
         flash("User is not an admin", "error")
         return "bad request", 400
 
     # Move from admin to member
-    group.admins.remove(target_user)
-    group.members.append(target_user)
+    demote_to_member(group, target_user.id)
     db.session.commit()
 
     flash(
@@ -1,10 +1,14 @@
 from flask import (
+    Response,
     abort,
+    current_app,
     flash,
+    g,
     jsonify,
     redirect,
     render_template,
     request,
+    send_from_directory,
     session,
     url_for,
 )
@@ -13,8 +17,9 @@ from werkzeug.security import check_password_hash, generate_password_hash
 from app.extensions import db
 from app.models import (
     Comment,
-    Like,
-    Message,
+    FriendshipState,
+    Group,
+    GroupRole,
     Notification,
     NotificationEnum,
     Post,
@@ -22,20 +27,51 @@ from app.models import (
 )
 from app.routes import main_bp
 from app.routes.error_routes import unauthorized
-from app.services.messages import create_message, emit_message
+from app.services.counters import (
+    decrement,
+    increment,
+    release_group_counters,
+    release_unread_notifications,
+    release_user_counters,
+)
+from app.services.fragments import (
+    invalidate_all_post_cards,
+    invalidate_post_card,
+    invalidate_reshare_cards,
+)
+from app.services.friendships import (
+    accept_friendship,
+    are_friends,
+    decline_friendship,
+    get_friendship_state,
+    remove_friendship,
+    send_friendship_request,
+)
+from app.services.likes import toggle_like
+from app.services.messages import (
+    create_message,
+    decode_before,
+    emit_message,
+    encode_message_history,
+    get_message_history,
+    mark_conversation_read,
+)
 from app.services.notifications import (
     create_notification,
     emit_notification,
     get_all_unread_notifications,
     get_next_notification,
     get_notifications,
-    get_unread_notifications,
+    mark_all_as_read,
     mark_as_read,
+    mark_friend_request_read,
+    notify,
 )
 from app.services.queries import (
     get_community_posts,
     get_friends,
     get_latest_conversations,
+    get_post_comments,
     get_posts,
     get_requests,
     get_user_by_username,
@@ -43,22 +79,35 @@ from app.services.queries import (
     get_users,
     get_users_groups,
 )
+from app.services.tags import get_trending_tags, index_post_tags, normalize_tag
+from app.services.timeline import backfill_author, prune_author, push_post
+from app.services.visibility import invalidate_visibility
 from app.utils.helpers import (
     allowed_file,
     array_to_str,
+    complete_upload,
+    create_upload,
     delete_file_from_s3,
     upload_file_to_s3,
 )
+from app.utils.images import validate_image
+from app.utils.storage import (
+    LocalStorage,
+    MemoryStorage,
+    get_storage,
+    load_upload_policy,
+)
 from app.utils.time_utils import format_time_ago
 
 
 @main_bp.route("/profiles")
 def user_list():
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
     search_query = request.args.get("q")
 
     # Get users
-    users = get_users(search_query=search_query, page=page)
+    users = get_users(search_query=search_query, page=page, cursor=cursor)
 
     return render_template(
         "users/profiles.html",
@@ -73,6 +122,7 @@ def user_list():
 @main_bp.route("/profiles/<username>")
 def user_profile(username):
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
     user = get_user_by_username(username, posts=True)
     is_friends = user.is_friends(session["user_id"])
 
@@ -82,7 +132,9 @@ def user_profile(username):
             "users/profile/index.html", user=user, posts=[], can_view=False
         )
 
-    pagination = get_user_posts(user_id=user.id, page=page)
+    pagination = get_user_posts(
+        user_id=user.id, page=page, cursor=cursor, viewer_id=session["user_id"]
+    )
 
     return render_template(
         "users/profile/index.html",
@@ -114,9 +166,10 @@ def user_profile_friends(username):
         )
 
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
 
     # Get friends
-    friends = get_friends(user.id, page=page)
+    friends = get_friends(user.id, page=page, cursor=cursor)
 
     return render_template(
         "users/profile/friends.html",
@@ -140,9 +193,10 @@ def user_profile_groups(username):
         )
 
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
 
     # Get user's groups
-    groups = get_users_groups(user_id=user.id, page=page)
+    groups = get_users_groups(user_id=user.id, page=page, cursor=cursor)
 
     return render_template(
         "users/profile/groups.html",
@@ -159,7 +213,7 @@ def user_profile_groups(username):
 
 @main_bp.route("/settings")
 def settings():
-    user = db.get_or_404(User, session["user_id"])
+    user = g.user
 
     return render_template("users/settings.html", user=user)
 
@@ -171,10 +225,20 @@ def user_delete(id):
     if user.id != session["user_id"]:
         return abort(401)
 
-    delete_file_from_s3(user.image)
+    # Owned groups are deleted with the user, remove all images in one batch
+    owned_groups = db.session.execute(
+        db.select(Group.id, Group.image).filter_by(owner_id=user.id)
+    ).all()
+    delete_file_from_s3(user.image, *[group.image for group in owned_groups])
 
+    # Other members' posts and notifications go with the owned groups
+    for group in owned_groups:
+        release_group_counters(group.id, exclude_sender_id=user.id)
+    release_user_counters(user.id)
     db.session.delete(user)
     db.session.commit()
+    # Cards show the author's comments too
+    invalidate_all_post_cards()
     session.clear()
     
     flash('Your account has been successfully deleted.', 'success')
@@ -184,6 +248,8 @@ def user_delete(id):
 @main_bp.route("/settings/general", methods=["POST"])
 def general_settings():
     image = request.files["image"]
+    # Token of an image the browser uploaded straight to storage
+    upload = request.form.get("upload")
     name = request.form["name"]
     surname = request.form["surname"]
     email = request.form["email"]
@@ -191,7 +257,9 @@ def general_settings():
     delete_image = True if request.form["delete_image"] == "true" else False
 
     # Get user
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
+    # Name and image are shown on cards of every post and comment
+    card_fields = (current_user.name, current_user.surname, current_user.image)
 
     # If email exists don't change
     if email and email != current_user.email:
@@ -216,13 +284,16 @@ def general_settings():
     else:
         current_user.is_private = False
 
-    if image.filename:
-        if not allowed_file(image.filename):
+    if upload:
+        # The image replaces the current one once it is stored
+        if complete_upload(upload, current_user.id) is None:
             return abort(422)
 
-        delete_file_from_s3(current_user.image)
-        image_key = upload_file_to_s3(image)
-        current_user.image = image_key
+    elif image.filename:
+        if not allowed_file(image.filename) or not validate_image(image.stream):
+            return abort(422)
+
+        upload_file_to_s3(image, current_user.id)
 
     elif current_user.image and delete_image and not image.filename:
         delete_file_from_s3(current_user.image)
@@ -231,6 +302,8 @@ def general_settings():
     # Save changes
     try:
         db.session.commit()
+        if card_fields != (current_user.name, current_user.surname, current_user.image):
+            invalidate_all_post_cards()
         flash("Your profile has been updated successfully!", "success")
     except:
         db.session.rollback()
@@ -239,6 +312,33 @@ def general_settings():
     return redirect(url_for("main.settings"))
 
 
+# Form for uploading a profile or group image straight to storage
+@main_bp.route("/uploads", methods=["POST"])
+def create_image_upload():
+    data = request.get_json(silent=True) or {}
+    folder = data.get("folder", "user-image")
+
+    try:
+        group_id = int(data["group_id"]) if folder == "group-image" else None
+    except (KeyError, TypeError, ValueError):
+        return abort(400)
+
+    if folder not in ("user-image", "group-image"):
+        return abort(400)
+
+    # Only the owner edits a group's settings, so only they get a form for its image
+    if group_id is not None:
+        group = db.get_or_404(Group, group_id)
+        if group.role_of(g.user) != GroupRole.OWNER:
+            return abort(403)
+
+    form = create_upload(data.get("filename"), g.user.id, folder, group_id)
+    if form is None:
+        return abort(422)
+
+    return jsonify(form)
+
+
 @main_bp.route("/settings/password", methods=["POST"])
 def password_settings():
     current_password = request.form["current-password"]
@@ -246,7 +346,7 @@ def password_settings():
     new_password_again = request.form["new-password-again"]
 
     # Get user
-    user = db.get_or_404(User, session["user_id"])
+    user = g.user
 
     # Check if the current password is correct
     if not check_password_hash(user.password, current_password):
@@ -274,7 +374,7 @@ def password_settings():
 @main_bp.route("/settings/info", methods=["POST"])
 def info_settings():
     # Get user
-    user = db.get_or_404(User, session["user_id"])
+    user = g.user
 
     # Get form data
     location = request.form.get("location")
@@ -314,7 +414,7 @@ def classes_settings():
     classes_string = array_to_str(selected_classes)
 
     # Get the user
-    user = db.get_or_404(User, session["user_id"])
+    user = g.user
 
     # Update the user's classes field with the new values
     user.classes = classes_string
@@ -334,7 +434,7 @@ def links_settings():
     links_string = array_to_str(links)
 
     # Get the user
-    user = db.get_or_404(User, session["user_id"])
+    user = g.user
 
     # Update the user's links
     user.links = links_string
@@ -353,13 +453,14 @@ def links_settings():
 # Feed
 @main_bp.route("/")
 def feed():
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
 
     pagination = get_community_posts(
         user_id=current_user.id,
-        friends=current_user.friends,
         page=page,
+        cursor=cursor,
     )
 
     return render_template(
@@ -370,13 +471,14 @@ def feed():
 # Friends feed
 @main_bp.route("/my-feed")
 def my_feed():
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
 
     pagination = get_posts(
         user_id=current_user.id,
-        friends=current_user.friends,
         page=page,
+        cursor=cursor,
     )
 
     return render_template(
@@ -397,6 +499,9 @@ def create_post():
     content = request.form["content"]
     post = Post(content=content, user_id=session["user_id"])
     db.session.add(post)
+    push_post(post)
+    index_post_tags(post)
+    increment(User.post_count, post.user_id)
     db.session.commit()
     return redirect(url_for("main.feed"))
 
@@ -404,18 +509,21 @@ def create_post():
 # Reshare post
 @main_bp.route("/post/<id>/reshare", methods=["POST"])
 def reshare_post(id):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     parent_post = Post.query.get_or_404(id)
-    parent_post.shares += 1
+    increment(Post.shares, parent_post.id)
     content = request.form["content"]
 
     post = Post(content=content, parent_id=parent_post.id, user_id=session["user_id"])
     db.session.add(post)
     db.session.flush()
+    push_post(post)
+    index_post_tags(post)
+    increment(User.post_count, post.user_id)
 
-    # Create a notification for original_post user
+    # Notify original_post user in the background, once the post is committed
     if current_user.id != parent_post.user_id:
-        notification = create_notification(
+        notify(
             recipient_id=parent_post.user_id,
             post_id=post.id,
             sender_id=session["user_id"],
@@ -423,11 +531,7 @@ def reshare_post(id):
         )
 
     db.session.commit()
-
-    # Emitting notification before commit creates error, took me an hour to debug
-    if current_user.id != parent_post.user_id:
-        # Emit notification with SocketIO
-        emit_notification(notification)
+    invalidate_post_card(parent_post)
 
     return redirect(url_for("main.feed"))
 
@@ -435,7 +539,7 @@ def reshare_post(id):
 # Delete post
 @main_bp.route("/post/delete/<id>", methods=["DELETE"])
 def delete_post(id):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     post = db.get_or_404(Post, id)
 
     if not post:
@@ -451,6 +555,13 @@ def delete_post(id):
         flash("You don't have permission to delete this post.", "error")
         return unauthorized()
 
+    decrement(User.post_count, post.user_id)
+    if post.group_id:
+        decrement(Group.post_count, post.group_id)
+    release_unread_notifications(Notification.post_id == post.id)
+    invalidate_post_card(post)
+    invalidate_reshare_cards(post.id)
+
     db.session.delete(post)
     db.session.commit()
     flash("Post deleted successfully.", "success")
@@ -461,39 +572,25 @@ def delete_post(id):
 # Like post
 @main_bp.route("/like/<id>", methods=["POST"])
 def like_post(id):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     post = db.get_or_404(Post, id)
 
-    # Convert liked posts to array
-    like = Like.query.filter_by(user_id=current_user.id, post_id=post.id).first()
+    # Like the post, or unlike it if already liked
+    is_liked, like_count, added = toggle_like(current_user.id, post)
 
-    # Check if the post is already liked by the user
-    if like:
-        # Unlike the post if already liked
-        db.session.delete(like)
-        is_liked = False
-    else:
-        # Like the post
-        new_like = Like(user_id=current_user.id, post_id=post.id)
-        db.session.add(new_like)
-        is_liked = True
-
-    if current_user.id != post.user_id and not like:
-        notification = create_notification(
+    # Notify post user in the background, once per liker
+    if added and current_user.id != post.user_id:
+        notify(
             recipient_id=post.user_id,
             post_id=post.id,
             sender_id=current_user.id,
             notification_type=NotificationEnum.POST_LIKE,
+            once=True,
         )
 
-    # Update the user's liked posts and the post's like count, also create notification
+    # Update the post's like count
     db.session.commit()
-
-    if current_user.id != post.user_id and not like:
-        # Emit notification with SocketIO
-        emit_notification(notification)
-
-    like_count = len(post.likes)
+    invalidate_post_card(post)
 
     return jsonify({"likes": like_count, "isLiked": is_liked})
 
@@ -501,41 +598,26 @@ def like_post(id):
 # Like comment
 @main_bp.route("/like/comment/<id>", methods=["POST"])
 def like_comment(id):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     comment = db.get_or_404(Comment, id)
 
-    # Liked comments
-    like = Like.query.filter_by(user_id=current_user.id, comment_id=comment.id).first()
-
-    # Check if the comment is already liked by the user
-    if like:
-        # Unlike the comment if already liked
-        db.session.delete(like)
-        is_liked = False
-    else:
-        # Like the comment
-        new_like = Like(user_id=current_user.id, comment_id=comment.id)
-        db.session.add(new_like)
-        is_liked = True
+    # Like the comment, or unlike it if already liked
+    is_liked, like_count, added = toggle_like(current_user.id, comment)
 
-    # Create a notification for comment's user
-    if current_user.id != comment.user_id:
-        notification = create_notification(
+    # Notify comment's user in the background, once per liker
+    if added and current_user.id != comment.user_id:
+        notify(
             recipient_id=comment.user_id,
             sender_id=current_user.id,
             comment_id=comment.id,
             post_id=comment.post_id,
             notification_type=NotificationEnum.COMMENT_LIKE,
+            once=True,
         )
 
-    # Update the user's liked posts and the post's like count
+    # Update the comment's like count
     db.session.commit()
-
-    if current_user.id != comment.user_id:
-        # Emit notification with SocketIO
-        emit_notification(notification)
-
-    like_count = len(comment.likes)
+    invalidate_post_card(comment.post)
 
     return jsonify({"likes": like_count, "isLiked": is_liked})
 
@@ -544,17 +626,18 @@ def like_comment(id):
 def comment_post(id):
     content = request.json
 
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     post = db.get_or_404(Post, id)
 
     # Create comment
     comment = Comment(user_id=current_user.id, post_id=post.id, content=content)
     db.session.add(comment)
     db.session.flush()
+    increment(Post.comment_count, post.id)
 
-    # Create a notification for post user
+    # Notify post user in the background, once the comment is committed
     if current_user.id != post.user_id:
-        notification = create_notification(
+        notify(
             recipient_id=post.user_id,
             sender_id=current_user.id,
             comment_id=comment.id,
@@ -563,10 +646,7 @@ def comment_post(id):
         )
 
     db.session.commit()
-
-    if current_user.id != post.user_id:
-        # Emit notification with SocketIO
-        emit_notification(notification)
+    invalidate_post_card(post)
 
     comment_data = {
         "id": comment.id,
@@ -582,7 +662,7 @@ def comment_post(id):
 # Delete comment
 @main_bp.route("/comment/delete/<id>", methods=["DELETE"])
 def delete_comment(id):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     comment = db.get_or_404(Comment, id)
 
     if not comment:
@@ -598,6 +678,9 @@ def delete_comment(id):
         flash("You don't have permission to delete this comment.", "error")
         return unauthorized()
 
+    decrement(Post.comment_count, comment.post_id)
+    release_unread_notifications(Notification.comment_id == comment.id)
+    invalidate_post_card(comment.post)
     db.session.delete(comment)
     db.session.commit()
     flash("Comment deleted successfully.", "success")
@@ -608,12 +691,9 @@ def delete_comment(id):
 # Load more comments
 @main_bp.route("/post/<id>/comments")
 def load_more_comments(id):
-    page = int(request.args["page"]) + 1
-    comments = (
-        Comment.query.filter_by(post_id=id)
-        .order_by(Comment.created_at.asc())
-        .paginate(page=page, per_page=3)
-    )
+    cursor = request.args.get("cursor")
+    page = request.args.get("page", 0, type=int) + 1
+    comments = get_post_comments(id, page=page, cursor=cursor)
     comment_list = []
 
     for comment in comments:
@@ -636,7 +716,13 @@ def load_more_comments(id):
         }
         comment_list.append(comment_data)
 
-    return jsonify({"comments": comment_list, "has_next": comments.has_next})
+    data = {"comments": comment_list, "has_next": comments.has_next}
+
+    # Cursor mode returns the cursor of the next page instead of page numbers
+    if cursor is not None:
+        data["next_cursor"] = comments.next_cursor
+
+    return jsonify(data)
 
 
 """ FRIENDS """
@@ -645,12 +731,14 @@ def load_more_comments(id):
 @main_bp.route("/friends")
 def friends():
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
     search_query = request.args.get("q")
     users = get_users(
         search_query=search_query,
         page=page,
         get_friends=True,
         user_id=session["user_id"],
+        cursor=cursor,
     )
 
     return render_template(
@@ -666,7 +754,7 @@ def friends():
 # Requests
 @main_bp.route("/friends/requests")
 def friend_requests():
-    user = db.get_or_404(User, session["user_id"])
+    user = g.user
 
     received_requests = get_requests(user.id)
 
@@ -676,29 +764,30 @@ def friend_requests():
 # Send a friend request
 @main_bp.route("/requests/<username>", methods=["POST"])
 def send_friend_request(username):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     target_user = User.query.filter_by(username=username).first()
 
-    if not target_user:
+    if not target_user or target_user.id == current_user.id:
         flash("User not found!", "error")
         return "", 200
 
-    if target_user in current_user.friends:
+    state = get_friendship_state(current_user.id, target_user.id)
+
+    if state == FriendshipState.FRIENDS:
         flash("You're already friends with this user.", "info")
         return "", 200
 
-    elif target_user in current_user.pending_requests:
+    elif state == FriendshipState.REQUESTED:
         flash("Friend request already sent.", "info")
         return "", 200
 
     # Accept the request if current user was already requested by the target user
-    elif current_user in target_user.pending_requests:
-        current_user.friends.append(target_user)
-        target_user.friends.append(current_user)
+    elif state == FriendshipState.RECEIVED:
+        accept_friendship(current_user.id, target_user.id)
 
-        # Remove pending/received requests
-        current_user.received_requests.remove(target_user)
-        target_user.pending_requests.remove(current_user)
+        # Add each other's posts to timelines
+        backfill_author(current_user.id, target_user.id)
+        backfill_author(target_user.id, current_user.id)
 
         # Send a friend accept notification to target user
         notification = create_notification(
@@ -711,17 +800,10 @@ def send_friend_request(username):
         emit_notification(notification)
 
         # Update friend request notification to read if not read yet
-        unread_request = Notification.query.filter(
-            Notification.recipient_id == current_user.id,
-            Notification.sender_id == target_user.id,
-            Notification.notification_type == NotificationEnum.FRIEND_REQUEST.value,
-            Notification.is_read == False,
-        ).first()
-
-        if unread_request:
-            unread_request.is_read = True
+        mark_friend_request_read(current_user.id, target_user.id)
 
         db.session.commit()
+        invalidate_visibility(current_user.id, target_user.id)
 
         flash(
             f"You are now friends with {target_user.name} {target_user.surname}.",
@@ -729,8 +811,9 @@ def send_friend_request(username):
         )
         return "", 200
 
-    current_user.pending_requests.append(target_user)
-    target_user.received_requests.append(current_user)
+    if not send_friendship_request(current_user.id, target_user.id):
+        flash("Friend request already sent.", "info")
+        return "", 200
 
     # Send a friend request notification to target user
     notification = create_notification(
@@ -753,20 +836,22 @@ def send_friend_request(username):
 # Accept a friend request
 @main_bp.route("/requests/<username>/accept", methods=["POST"])
 def accept_friend_request(username):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     target_user = User.query.filter_by(username=username).one_or_404()
 
-    if target_user in current_user.friends:
+    if are_friends(current_user.id, target_user.id):
         flash("You're already friends with this user.", "info")
         return "", 200
 
     # Accept the request if current user was already requested by the target user
-    current_user.friends.append(target_user)
-    target_user.friends.append(current_user)
+    if not accept_friendship(current_user.id, target_user.id):
+        flash("Friend request not found.", "info")
+        return "", 200
+
+    # Add each other's posts to timelines
+    backfill_author(current_user.id, target_user.id)
+    backfill_author(target_user.id, current_user.id)
 
-    # Remove pending/received requests
-    current_user.received_requests.remove(target_user)
-    target_user.pending_requests.remove(current_user)
     # Send a notification
     notification = create_notification(
         recipient_id=target_user.id,
@@ -780,17 +865,10 @@ def accept_friend_request(username):
     emit_notification(notification)
 
     # Update friend request notification to read if not read yet
-    unread_request = Notification.query.filter(
-        Notification.recipient_id == current_user.id,
-        Notification.sender_id == target_user.id,
-        Notification.notification_type == NotificationEnum.FRIEND_REQUEST.value,
-        Notification.is_read == False,
-    ).first()
-
-    if unread_request:
-        unread_request.is_read = True
+    mark_friend_request_read(current_user.id, target_user.id)
 
     db.session.commit()
+    invalidate_visibility(current_user.id, target_user.id)
 
     flash(
         f"You're now friends with {target_user.name} {target_user.surname}.", "success"
@@ -801,16 +879,17 @@ def accept_friend_request(username):
 # Decline a friend request
 @main_bp.route("/requests/<username>/decline", methods=["POST"])
 def decline_friend_request(username):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     target_user = User.query.filter_by(username=username).one_or_404()
 
-    if target_user in current_user.friends:
+    if are_friends(current_user.id, target_user.id):
         flash("You're already friends with this user.", "info")
         return "", 200
 
     # Remove pending/received requests
-    current_user.received_requests.remove(target_user)
-    target_user.pending_requests.remove(current_user)
+    if not decline_friendship(current_user.id, target_user.id):
+        flash("Friend request not found.", "info")
+        return "", 200
 
     db.session.commit()
 
@@ -824,18 +903,19 @@ def decline_friend_request(username):
 # Remove a user from friends
 @main_bp.route("/friends/<username>/remove", methods=["DELETE"])
 def remove_friend(username):
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     target_user = User.query.filter_by(username=username).one_or_404()
 
-    if target_user not in current_user.friends:
+    if not remove_friendship(current_user.id, target_user.id):
         flash("You're not friends with this user.", "info")
         return "", 200
 
-    # Remove pending/received requests
-    current_user.friends.remove(target_user)
-    target_user.friends.remove(current_user)
+    # Remove each other's posts from timelines
+    prune_author(current_user.id, target_user.id)
+    prune_author(target_user.id, current_user.id)
 
     db.session.commit()
+    invalidate_visibility(current_user.id, target_user.id)
 
     flash(f"{target_user.name} {target_user.surname} removed from friends.", "success")
     return jsonify({"username": target_user.username, "status": "success"})
@@ -847,17 +927,17 @@ def remove_friend(username):
 # Messages page
 @main_bp.route("/messages")
 def view_messages():
-    current_user = db.get_or_404(User, session["user_id"])
-    messages = get_latest_conversations(current_user.id)
+    current_user = g.user
+    conversations = get_latest_conversations(current_user.id)
 
-    return render_template("messages/index.html", messages=messages)
+    return render_template("messages/index.html", conversations=conversations)
 
 
 # Single message page
 @main_bp.route("/messages/<username>", methods=["GET", "POST"])
 def conversation(username):
     # Get current user and friend
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     friend = User.query.filter_by(username=username).first_or_404()
 
     if current_user.username == username:
@@ -886,20 +966,8 @@ def conversation(username):
         message_limit = 20
 
         # Fetch initial messages between current user and friend
-        messages = (
-            Message.query.filter(
-                (
-                    (Message.sender_id == current_user.id)
-                    & (Message.recipient_id == friend.id)
-                )
-                | (
-                    (Message.sender_id == friend.id)
-                    & (Message.recipient_id == current_user.id)
-                )
-            )
-            .order_by(Message.created_at.desc())
-            .limit(message_limit)
-            .all()
+        messages, next_before = get_message_history(
+            current_user.id, friend.id, limit=message_limit
         )
 
         # Reverse to show from oldest to newest after limiting
@@ -909,97 +977,66 @@ def conversation(username):
             "messages/conversation.html",
             messages=messages,
             friend=friend,
-            has_more=len(messages) == message_limit,
+            has_more=next_before is not None,
+            next_before=next_before,
         )
 
 
-# Load more messages
-@main_bp.route("/messages/<username>/more")
-def load_more_conversation(username):
-    # Get current user and friend
-    current_user = db.get_or_404(User, session["user_id"])
+# Older messages of a conversation, before=<created_at>,<id> of the oldest shown
+@main_bp.route("/messages/<username>/history")
+def message_history(username):
+    current_user = g.user
     friend = User.query.filter_by(username=username).first_or_404()
 
     if current_user.username == username:
         flash("You can't chat with yourself!", "error")
         return redirect(url_for("main.view_messages"))
 
-    # Limit the initial number of messages to load
-    message_limit = 20
-    page = int(request.args["page"]) + 1
-
-    # Fetch initial messages between current user and friend
-    messages = (
-        Message.query.filter(
-            (
-                (Message.sender_id == current_user.id)
-                & (Message.recipient_id == friend.id)
-            )
-            | (
-                (Message.sender_id == friend.id)
-                & (Message.recipient_id == current_user.id)
-            )
-        )
-        .order_by(Message.created_at.desc())
-        .paginate(page=page, per_page=message_limit)
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+    messages, next_before = get_message_history(
+        current_user.id,
+        friend.id,
+        before=decode_before(request.args.get("before")),
+        limit=limit,
     )
 
-    message_list = []
-
-    for message in messages:
-        message_data = {
-            "content": message.content,
-            "sender": {
-                "id": message.sender.id,
-                "image": message.sender.image,
-                "name": message.sender.name,
-                "surname": message.sender.surname,
-            },
-            "sender_id": message.sender.id,
-            "recipient_id": message.recipient_id,
-            "created_at_iso": message.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-            "created_at": format_time_ago(message.created_at),
-        }
-        message_list.append(message_data)
-
-    return jsonify({"messages": message_list, "has_next": messages.has_next})
+    return Response(
+        encode_message_history(messages, next_before, (current_user, friend)),
+        mimetype="application/json",
+    )
 
 
 # Update read status
 @main_bp.route("/messages/<username>/mark_read", methods=["POST"])
 def mark_messages_as_read(username):
     # Get current user and friend
-    current_user = db.get_or_404(User, session["user_id"])
+    current_user = g.user
     friend = User.query.filter_by(username=username).first_or_404()
 
     if current_user.username == username:
         flash("You can't chat with yourself!", "error")
         return redirect(url_for("main.view_messages"))
 
-    unread_messages = Message.query.filter(
-        Message.sender_id == friend.id,
-        Message.recipient_id == current_user.id,
-        Message.is_read == False,
+    read_count, other_unread_messages = mark_conversation_read(
+        current_user.id, friend.id
     )
 
-    for message in unread_messages:
-        message.is_read = True
-
-    other_unread_messages = Message.query.filter(
-        Message.recipient_id == current_user.id, Message.is_read == False
-    ).count()
-
     db.session.commit()
     return jsonify(
-        {"success": True, "other_unread_messages": other_unread_messages > 0}
+        {
+            "success": True,
+            "read": read_count,
+            "other_unread_messages": other_unread_messages > 0,
+        }
     )
 
 
 @main_bp.route("/notifications")
 def notifications():
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
 
-    pagination = get_notifications(session["user_id"], page=page)
+    pagination = get_notifications(session["user_id"], page=page, cursor=cursor)
 
     return render_template(
         "notifications.html",
@@ -1012,8 +1049,11 @@ def notifications():
 @main_bp.route("/notifications/unread/all")
 def all_unread_notifications():
     page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor")
 
-    pagination = get_all_unread_notifications(session["user_id"], page=page)
+    pagination = get_all_unread_notifications(
+        session["user_id"], page=page, cursor=cursor
+    )
 
     return render_template(
         "notifications_unread.html",
@@ -1025,16 +1065,15 @@ def all_unread_notifications():
 
 @main_bp.route("/notifications/unread")
 def unread_notifications():
-    current_user = db.get_or_404(User, session["user_id"])
-    notifications = get_unread_notifications(current_user.id)
+    notifications = g.unread_notifications
     return jsonify([n.to_dict() for n in notifications])
 
 
 @main_bp.route("/notifications/<int:notification_id>/read", methods=["POST"])
 def mark_notification_read(notification_id):
-    notification = mark_as_read(notification_id, session["user_id"])
+    found = mark_as_read(notification_id, session["user_id"])
 
-    if not notification:
+    if not found:
         flash("Notification not found!", "error")
         return jsonify({"status": "error", "message": "Notification not found"}), 404
 
@@ -1057,34 +1096,85 @@ def next_unread_notification():
 
 @main_bp.route("/notifications/mark-all-read", methods=["POST"])
 def mark_all_notifications_read():
-    current_user = db.get_or_404(User, session["user_id"])
-    Notification.query.filter_by(recipient_id=current_user.id, is_read=False).update(
-        {Notification.is_read: True}
-    )
+    current_user = g.user
+    read_count = mark_all_as_read(current_user.id)
     db.session.commit()
-    return jsonify({"status": "success"})
+    return jsonify({"status": "success", "read": read_count})
 
 
 # Hashtag page
 @main_bp.route("/tags")
 def tag_view():
     page = request.args.get("page", 1, type=int)
-    tag = request.args.get("tag")
+    cursor = request.args.get("cursor")
+    tag = normalize_tag(request.args.get("tag", ""))
 
     if not tag:
         return redirect(url_for("main.feed"))
 
-    current_user = db.get_or_404(User, session["user_id"])
-
-    pattern = f"%#{tag}%"
+    current_user = g.user
 
     pagination = get_community_posts(
         user_id=current_user.id,
-        friends=current_user.friends,
         page=page,
-        tag_pattern=pattern,
+        tag=tag,
+        cursor=cursor,
     )
 
     return render_template(
-        "tags.html", posts=pagination.items, tag=tag, page=page, pagination=pagination
+        "tags.html",
+        posts=pagination.items,
+        tag=tag,
+        page=page,
+        pagination=pagination,
+        trending_tags=get_trending_tags(),
+    )
+
+
+# Uploads to the "local" and "memory" storages, in place of S3 presigned posts
+@main_bp.route("/media", methods=["POST"])
+def media_upload():
+    storage = get_storage()
+    if not isinstance(storage, (LocalStorage, MemoryStorage)):
+        abort(404)
+
+    # Room for an upload of the largest size and the form fields
+    request.max_content_length = (
+        current_app.config.get("UPLOAD_MAX_SIZE", 5 * 1024 * 1024) + 64 * 1024
     )
+
+    policy = load_upload_policy(request.form.get("policy", ""))
+    file = request.files.get("file")
+    if (
+        policy is None
+        or file is None
+        or request.form.get("key") != policy["key"]
+        or request.form.get("Content-Type") != policy["content_type"]
+    ):
+        abort(403)
+
+    data = file.read()
+    if not 0 < len(data) <= policy["max_size"]:
+        abort(400)
+
+    storage.put(policy["key"], data, policy["content_type"])
+
+    return "", 204
+
+
+# Images of the "local" and "memory" storages, in place of S3 presigned urls
+@main_bp.route("/media/<path:key>")
+def media(key):
+    storage = get_storage()
+
+    if isinstance(storage, LocalStorage):
+        return send_from_directory(storage.root, key)
+
+    if isinstance(storage, MemoryStorage):
+        stored = storage.get(key)
+        if stored is None:
+            abort(404)
+        data, content_type = stored
+        return Response(data, mimetype=content_type)
+
+    abort(404)
@@ -0,0 +1,189 @@
+from sqlalchemy import func, or_, select, update
+
+from app.models import (
+    Comment,
+    Friendship,
+    FriendshipState,
+    Group,
+    Like,
+    Message,
+    Notification,
+    Post,
+    User,
+)
+from app.services import db
+
+
+def supports_returning():
+    """Whether the database returns rows from UPDATE statements"""
+    return db.session.get_bind().dialect.update_returning
+
+
+def increment(column, row_id, amount=1, returning=False):
+    """
+    Atomically add amount to a counter column in SQL (negative to decrement).
+    With returning the new value is returned, in the same statement if supported.
+    """
+    model = column.class_
+    statement = (
+        update(model).where(model.id == row_id).values({column.key: column + amount})
+    )
+
+    if not returning:
+        db.session.execute(statement)
+        return None
+
+    if supports_returning():
+        return db.session.execute(statement.returning(column)).scalar()
+
+    db.session.execute(statement)
+    return db.session.scalar(select(column).where(model.id == row_id))
+
+
+def decrement(column, row_id, amount=1, returning=False):
+    return increment(column, row_id, -amount, returning=returning)
+
+
+def _count(column, *conditions):
+    return select(func.count(column)).where(*conditions).scalar_subquery()
+
+
+def release_user_counters(user_id):
+    """Decrement counters the user's friendships, likes, comments and posts added to"""
+    liked_posts = select(Like.post_id).where(Like.user_id == user_id)
+    liked_comments = select(Like.comment_id).where(Like.user_id == user_id)
+    commented_posts = select(Comment.post_id).where(Comment.user_id == user_id)
+    posted_groups = select(Post.group_id).where(Post.user_id == user_id)
+
+    statements = [
+        update(User)
+        .where(
+            User.id.in_(
+                select(Friendship.other_id).where(
+                    Friendship.user_id == user_id,
+                    Friendship.state == FriendshipState.FRIENDS,
+                )
+            )
+        )
+        .values(friend_count=User.friend_count - 1),
+        update(Post)
+        .where(Post.id.in_(liked_posts))
+        .values(
+            like_count=Post.like_count
+            - _count(Like.id, Like.post_id == Post.id, Like.user_id == user_id)
+        ),
+        update(Post)
+        .where(Post.id.in_(commented_posts))
+        .values(
+            comment_count=Post.comment_count
+            - _count(Comment.id, Comment.post_id == Post.id, Comment.user_id == user_id)
+        ),
+        update(Comment)
+        .where(Comment.id.in_(liked_comments))
+        .values(
+            like_count=Comment.like_count
+            - _count(Like.id, Like.comment_id == Comment.id, Like.user_id == user_id)
+        ),
+        update(Group)
+        .where(Group.id.in_(posted_groups))
+        .values(
+            post_count=Group.post_count
+            - _count(Post.id, Post.group_id == Group.id, Post.user_id == user_id)
+        ),
+    ]
+
+    for statement in statements:
+        db.session.execute(statement.execution_options(synchronize_session=False))
+
+    release_unread_messages(Message.sender_id == user_id)
+    release_unread_notifications(Notification.sender_id == user_id)
+
+
+def release_unread_messages(*conditions):
+    """Decrement recipients' unread counters for messages about to be deleted"""
+    unread = (Message.is_read == False, *conditions)
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(select(Message.recipient_id).where(*unread)))
+        .values(
+            unread_message_count=User.unread_message_count
+            - _count(Message.id, Message.recipient_id == User.id, *unread)
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def release_unread_notifications(*conditions):
+    """Decrement recipients' unread counters for notifications about to be deleted"""
+    unread = (Notification.is_read == False, *conditions)
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(select(Notification.recipient_id).where(*unread)))
+        .values(
+            unread_notification_count=User.unread_notification_count
+            - _count(Notification.id, Notification.recipient_id == User.id, *unread)
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def release_group_counters(group_id, exclude_sender_id=None):
+    """
+    Decrement post counts of users whose group posts are deleted with the group,
+    and unread counts for the group's notifications. Notifications of
+    exclude_sender_id are left out, when release_user_counters covers them.
+    """
+    group_posts = select(Post.id).where(Post.group_id == group_id)
+    conditions = [
+        or_(Notification.group_id == group_id, Notification.post_id.in_(group_posts))
+    ]
+    if exclude_sender_id is not None:
+        conditions.append(Notification.sender_id != exclude_sender_id)
+    release_unread_notifications(*conditions)
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(select(Post.user_id).where(Post.group_id == group_id)))
+        .values(
+            post_count=User.post_count
+            - _count(Post.id, Post.user_id == User.id, Post.group_id == group_id)
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def reconcile_counters():
+    """Recompute every counter column from the source rows"""
+    statements = [
+        update(Post).values(
+            like_count=_count(Like.id, Like.post_id == Post.id),
+            comment_count=_count(Comment.id, Comment.post_id == Post.id),
+        ),
+        update(Comment).values(
+            like_count=_count(Like.id, Like.comment_id == Comment.id)
+        ),
+        update(User).values(
+            friend_count=_count(
+                Friendship.other_id,
+                Friendship.user_id == User.id,
+                Friendship.state == FriendshipState.FRIENDS,
+            ),
+            post_count=_count(Post.id, Post.user_id == User.id),
+            unread_message_count=_count(
+                Message.id, Message.recipient_id == User.id, Message.is_read == False
+            ),
+            unread_notification_count=_count(
+                Notification.id,
+                Notification.recipient_id == User.id,
+                Notification.is_read == False,
+            ),
+        ),
+        update(Group).values(post_count=_count(Post.id, Post.group_id == Group.id)),
+    ]
+
+    for statement in statements:
+        db.session.execute(statement.execution_options(synchronize_session=False))
+
+    db.session.commit()
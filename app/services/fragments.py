@@ -0,0 +1,140 @@
+import re
+
+from cachelib import FileSystemCache
+from flask import current_app, get_template_attribute
+from markupsafe import Markup
+from sqlalchemy import select
+
+from app.models import Post
+from app.services import db
+from app.utils.cache import LRUCache
+
+# Bump when components/post.html changes so cached cards are not reused
+POST_CARD_VERSION = 2
+
+POST_TEMPLATE = "components/post.html"
+
+# Viewer markers left in the cached card, e.g. <!--viewer:comment-like:12-->
+VIEWER_MARKER = re.compile(r"<!--viewer:([a-z-]+)(?::(\d+))?-->")
+
+
+class PostCardCache:
+    """Rendered post cards without viewer state, invalidated per post or all at once"""
+
+    GENERATION_KEY = "post-card:generation"
+
+    def __init__(self, maxsize=1024, ttl=60, shared=None):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl, shared=shared)
+        self.shared = shared
+        self._generation = 0
+
+    def generation(self):
+        # Other workers bump the generation through the shared backend
+        if self.shared:
+            self._generation = self.shared.get(self.GENERATION_KEY) or 0
+        return self._generation
+
+    def key(self, post_id, group_id=None, display_group=True):
+        return (
+            f"post-card:{POST_CARD_VERSION}:{self.generation()}:"
+            f"{post_id}:{group_id or 0}:{int(bool(display_group))}"
+        )
+
+    def invalidate(self, post_id, group_id=None):
+        # Cards are rendered alone, with their group, or inside the group page
+        self.cache.delete(
+            self.key(post_id),
+            self.key(post_id, group_id),
+            self.key(post_id, group_id, display_group=False),
+        )
+
+    def invalidate_all(self):
+        self._generation = self.generation() + 1
+        if self.shared:
+            self.shared.set(self.GENERATION_KEY, self._generation, timeout=0)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def get_post_card_cache():
+    if "post_card_cache" not in current_app.extensions:
+        cache_dir = current_app.config.get("POST_CARD_CACHE_DIR")
+        current_app.extensions["post_card_cache"] = PostCardCache(
+            maxsize=current_app.config.get("POST_CARD_CACHE_SIZE", 1024),
+            ttl=current_app.config.get("POST_CARD_CACHE_TTL", 60),
+            shared=FileSystemCache(cache_dir) if cache_dir else None,
+        )
+
+    return current_app.extensions["post_card_cache"]
+
+
+def render_post_card(post, current_user, group=None, display_group=True):
+    """Post card for the viewer, from the cache when possible"""
+    cache = get_post_card_cache()
+    key = cache.key(post.id, group.id if group else None, display_group)
+
+    html = cache.cache.get(key)
+    if html is None:
+        card = get_template_attribute(POST_TEMPLATE, "post_card")
+        html = str(card(post, group=group, display_group=display_group))
+        cache.cache.set(key, html)
+
+    return Markup(_patch_viewer(html, post, current_user, group))
+
+
+def _patch_viewer(html, post, current_user, group):
+    """Replace viewer markers with the viewer's like state and delete rights"""
+    comments = {comment.id: comment for comment in post.latest_comments()}
+
+    def can_remove(user):
+        return bool(group and group.can_remove_user(current_user, user))
+
+    def replace(match):
+        marker, comment_id = match.group(1), match.group(2)
+
+        if marker == "post-like":
+            button = get_template_attribute(POST_TEMPLATE, "post_like_button")
+            return button(post, post.is_liked_by_user(current_user.id))
+
+        if marker == "post-delete":
+            button = get_template_attribute(POST_TEMPLATE, "post_delete_button")
+            # Owner and group moderator buttons, same as before caching
+            count = (post.user_id == current_user.id) + can_remove(post.user)
+            return str(button(post)) * count
+
+        comment = comments.get(int(comment_id))
+        if comment is None:
+            return ""
+
+        if marker == "comment-like":
+            button = get_template_attribute(POST_TEMPLATE, "comment_like_button")
+            return button(comment.is_liked_by_user(current_user.id))
+
+        if marker == "comment-delete":
+            button = get_template_attribute(POST_TEMPLATE, "comment_delete_button")
+            count = (comment.user_id == current_user.id) + can_remove(comment.user)
+            return str(button()) * count
+
+        return ""
+
+    return VIEWER_MARKER.sub(lambda match: str(replace(match)), html)
+
+
+def invalidate_post_card(post):
+    get_post_card_cache().invalidate(post.id, post.group_id)
+
+
+def invalidate_reshare_cards(post_id):
+    """Reshares show the original post, drop theirs when it changes"""
+    reshares = db.session.execute(
+        select(Post.id, Post.group_id).where(Post.parent_id == post_id)
+    ).all()
+
+    for reshare in reshares:
+        get_post_card_cache().invalidate(reshare.id, reshare.group_id)
+
+
+def invalidate_all_post_cards():
+    """After changes shown on many cards, e.g. a profile image or group name"""
+    get_post_card_cache().invalidate_all()
@@ -0,0 +1,175 @@
+from sqlalchemy import (
+    MetaData,
+    Table,
+    delete,
+    exists,
+    insert,
+    inspect,
+    literal,
+    select,
+    update,
+)
+from sqlalchemy.exc import IntegrityError
+
+from app.models import Friendship, FriendshipState, User
+from app.services import db
+from app.services.counters import decrement, increment
+
+# Tables replaced by friendship: column of the other user and the edge state
+LEGACY_TABLES = {
+    "friends": ("friend_id", FriendshipState.FRIENDS),
+    "pending_requests": ("pending_id", FriendshipState.REQUESTED),
+    "received_requests": ("request_id", FriendshipState.RECEIVED),
+}
+
+
+def _edge(user_id, other_id):
+    return (Friendship.user_id == user_id, Friendship.other_id == other_id)
+
+
+def get_friendship_state(user_id, other_id):
+    """State of the edge from user_id to other_id, None if unrelated"""
+    friendship = db.session.get(Friendship, (user_id, other_id))
+    return friendship.state if friendship else None
+
+
+def are_friends(user_id, other_id):
+    return get_friendship_state(user_id, other_id) == FriendshipState.FRIENDS
+
+
+def friend_ids(user_id):
+    """Subquery of the user's friend ids"""
+    return select(Friendship.other_id).where(
+        Friendship.user_id == user_id, Friendship.state == FriendshipState.FRIENDS
+    )
+
+
+def requester_ids(user_id):
+    """Subquery of ids of users who sent the user a friend request"""
+    return select(Friendship.other_id).where(
+        Friendship.user_id == user_id, Friendship.state == FriendshipState.RECEIVED
+    )
+
+
+def send_friendship_request(user_id, other_id):
+    """
+    Store a friend request from user_id to other_id from both sides.
+    False if the users already have an edge, e.g. from a concurrent request.
+    """
+    try:
+        with db.session.begin_nested():
+            db.session.execute(
+                insert(Friendship),
+                [
+                    {
+                        "user_id": user_id,
+                        "other_id": other_id,
+                        "state": FriendshipState.REQUESTED,
+                    },
+                    {
+                        "user_id": other_id,
+                        "other_id": user_id,
+                        "state": FriendshipState.RECEIVED,
+                    },
+                ],
+            )
+    except IntegrityError:
+        return False
+
+    return True
+
+
+def accept_friendship(user_id, requester_id):
+    """Turn a received friend request into friendship, False if there was none"""
+    accepted = db.session.execute(
+        update(Friendship)
+        .where(*_edge(user_id, requester_id))
+        .where(Friendship.state == FriendshipState.RECEIVED)
+        .values(state=FriendshipState.FRIENDS)
+    ).rowcount
+    if not accepted:
+        return False
+
+    db.session.execute(
+        update(Friendship)
+        .where(*_edge(requester_id, user_id))
+        .values(state=FriendshipState.FRIENDS)
+    )
+
+    increment(User.friend_count, user_id)
+    increment(User.friend_count, requester_id)
+
+    return True
+
+
+def _delete_edge(user_id, other_id, state):
+    """Delete both sides of an edge in state, False if there was none"""
+    deleted = db.session.execute(
+        delete(Friendship)
+        .where(*_edge(user_id, other_id))
+        .where(Friendship.state == state)
+    ).rowcount
+    if not deleted:
+        return False
+
+    db.session.execute(delete(Friendship).where(*_edge(other_id, user_id)))
+
+    return True
+
+
+def decline_friendship(user_id, requester_id):
+    return _delete_edge(user_id, requester_id, FriendshipState.RECEIVED)
+
+
+def remove_friendship(user_id, friend_id):
+    """End a friendship, False if the users were not friends"""
+    if not _delete_edge(user_id, friend_id, FriendshipState.FRIENDS):
+        return False
+
+    decrement(User.friend_count, user_id)
+    decrement(User.friend_count, friend_id)
+
+    return True
+
+
+def copy_legacy_friendships(connection):
+    """
+    Copy edges of the friends, pending_requests and received_requests tables
+    into friendship. Runs on a plain connection so a migration can call it with
+    op.get_bind() before the old tables are dropped. Friendship wins over a
+    request left behind for the same pair.
+    """
+    table_names = inspect(connection).get_table_names()
+    state_type = Friendship.__table__.c.state.type
+    total = 0
+
+    for name, (column, state) in LEGACY_TABLES.items():
+        if name not in table_names:
+            continue
+
+        legacy = Table(name, MetaData(), autoload_with=connection)
+        user_id, other_id = legacy.c.user_id, legacy.c[column]
+
+        edges = (
+            select(user_id, other_id, literal(state, state_type))
+            .where(user_id.is_not(None), other_id.is_not(None), user_id != other_id)
+            .where(
+                ~exists().where(
+                    Friendship.user_id == user_id, Friendship.other_id == other_id
+                )
+            )
+            .distinct()
+        )
+
+        total += connection.execute(
+            insert(Friendship).from_select(["user_id", "other_id", "state"], edges)
+        ).rowcount
+
+    return total
+
+
+def migrate_legacy_friendships():
+    total = copy_legacy_friendships(db.session.connection())
+    db.session.commit()
+
+    return total
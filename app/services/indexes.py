@@ -0,0 +1,136 @@
+from sqlalchemy import delete, func, select, text
+
+from app.models import (
+    Comment,
+    Invitation,
+    Like,
+    Message,
+    Notification,
+    Post,
+)
+from app.services import db
+
+# Main query shapes and the index each one should use, user/post id 1 as sample
+QUERY_PLANS = {
+    "community feed": (
+        select(Post.id).order_by(Post.created_at.desc(), Post.id.desc()).limit(10),
+        "ix_post_created",
+    ),
+    "profile posts": (
+        select(Post.id)
+        .where(Post.user_id == 1)
+        .order_by(Post.created_at.desc(), Post.id.desc())
+        .limit(10),
+        "ix_post_user_created",
+    ),
+    "group posts": (
+        select(Post.id)
+        .where(Post.group_id == 1)
+        .order_by(Post.created_at.desc(), Post.id.desc())
+        .limit(10),
+        "ix_post_group_created",
+    ),
+    "post comments": (
+        select(Comment.id)
+        .where(Comment.post_id == 1)
+        .order_by(Comment.created_at.desc(), Comment.id.desc())
+        .limit(10),
+        "ix_comment_post_created",
+    ),
+    "post like": (
+        select(Like.id).where(Like.post_id == 1, Like.user_id == 1),
+        "uq_like_post_user",
+    ),
+    "comment like": (
+        select(Like.id).where(Like.comment_id == 1, Like.user_id == 1),
+        "uq_like_comment_user",
+    ),
+    "unread messages": (
+        select(Message.id).where(Message.recipient_id == 1, Message.is_read == False),
+        "ix_message_recipient_read",
+    ),
+    "conversation history": (
+        select(Message.id)
+        .where(Message.sender_id == 1, Message.recipient_id == 2)
+        .order_by(Message.created_at.desc())
+        .limit(20),
+        "ix_message_pair_created",
+    ),
+    "unread notifications": (
+        select(Notification.id)
+        .where(Notification.recipient_id == 1, Notification.is_read == False)
+        .order_by(Notification.created_at.desc())
+        .limit(10),
+        "ix_notification_recipient_read_created",
+    ),
+    "notifications page": (
+        select(Notification.id)
+        .where(Notification.recipient_id == 1)
+        .order_by(Notification.created_at.desc())
+        .limit(10),
+        "ix_notification_recipient_created",
+    ),
+    "group invitation": (
+        select(Invitation.id).where(
+            Invitation.group_id == 1, Invitation.invitee_id == 1
+        ),
+        "uq_invitation_group_invitee",
+    ),
+}
+
+
+def explain(statement):
+    """Query plan of a select as text, on PostgreSQL or SQLite"""
+    bind = db.session.get_bind()
+    prefix = "EXPLAIN QUERY PLAN" if bind.dialect.name == "sqlite" else "EXPLAIN"
+    sql = statement.compile(bind, compile_kwargs={"literal_binds": True})
+
+    # The plan text is the last column (SQLite also returns node ids)
+    rows = db.session.execute(text(f"{prefix} {sql}")).all()
+    return "\n".join(str(row[-1]) for row in rows)
+
+
+def check_query_plans():
+    """
+    Explain each of QUERY_PLANS and report whether its index is used.
+    On PostgreSQL sequential scans are disabled for the check so small tables
+    still show whether the index can serve the query.
+    """
+    if db.session.get_bind().dialect.name == "postgresql":
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+
+    results = []
+    for name, (statement, index) in QUERY_PLANS.items():
+        plan = explain(statement)
+        results.append((name, index, index in plan, plan))
+
+    db.session.rollback()
+
+    return results
+
+
+def delete_duplicates(model, *columns):
+    """Delete rows repeating the columns' values, keeping the oldest one"""
+    keep = (
+        select(func.min(model.id))
+        .where(*[column.is_not(None) for column in columns])
+        .group_by(*columns)
+    )
+
+    return db.session.execute(
+        delete(model)
+        .where(*[column.is_not(None) for column in columns])
+        .where(model.id.not_in(keep))
+    ).rowcount
+
+
+def dedupe_unique_rows():
+    """Remove duplicate likes and invitations so their unique constraints apply"""
+    removed = (
+        delete_duplicates(Like, Like.post_id, Like.user_id)
+        + delete_duplicates(Like, Like.comment_id, Like.user_id)
+        + delete_duplicates(Invitation, Invitation.group_id, Invitation.invitee_id)
+    )
+    db.session.commit()
+
+    return removed
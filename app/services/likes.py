@@ -0,0 +1,65 @@
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from app.models import Comment, Like, Post
+from app.services import db
+from app.services.counters import increment
+
+# Like column and like counter of each likeable model, None to count the likes
+LIKE_TARGETS = {
+    Post: (Like.post_id, Post.like_count),
+    Comment: (Like.comment_id, Comment.like_count),
+}
+
+
+def _insert_like(values):
+    """
+    Insert a like in one statement, skipping it if the unique index already has it.
+    Returns whether a row was inserted.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert_ = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        statement = insert_(Like).values(values).on_conflict_do_nothing()
+        return bool(db.session.execute(statement).rowcount)
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(Like).values(values))
+    except IntegrityError:
+        return False
+
+    return True
+
+
+def _like_count(target, column, counter, amount=0):
+    """Add amount to the like counter and return it, COUNT the likes without one"""
+    if counter is None:
+        return db.session.scalar(select(func.count(Like.id)).where(column == target.id))
+    if amount:
+        return increment(counter, target.id, amount, returning=True)
+    return db.session.scalar(select(counter).where(counter.class_.id == target.id))
+
+
+def toggle_like(user_id, target):
+    """
+    Like or unlike a post or comment, safe to repeat on double clicks.
+    Returns whether the user now likes it, the new like count and whether this
+    call added the like.
+    """
+    column, counter = LIKE_TARGETS[type(target)]
+
+    unliked = db.session.execute(
+        delete(Like)
+        .where(column == target.id, Like.user_id == user_id)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if unliked:
+        return False, _like_count(target, column, counter, -1), False
+
+    if not _insert_like({"user_id": user_id, column.key: target.id}):
+        # A concurrent request liked it first
+        return True, _like_count(target, column, counter), False
+
+    return True, _like_count(target, column, counter, 1), True
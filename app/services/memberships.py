@@ -0,0 +1,156 @@
+from flask import g
+from sqlalchemy import and_, delete, exists, insert, literal, select, union, union_all
+from sqlalchemy.exc import IntegrityError
+
+from app.models import Group, GroupRole, Invitation, group_admins, group_members
+from app.services import db
+
+
+def _roles():
+    """Roles looked up during this request, by (group_id, user_id)"""
+    if "group_roles" not in g:
+        g.group_roles = {}
+    return g.group_roles
+
+
+def get_group_role(group, user_id):
+    """Role of the user in the group or None, one indexed query per request"""
+    if user_id is None:
+        return None
+    if group.owner_id == user_id:
+        return GroupRole.OWNER
+
+    key = (group.id, user_id)
+    roles = _roles()
+    if key not in roles:
+        found = db.session.execute(
+            union_all(
+                select(literal(GroupRole.ADMIN.value)).where(
+                    group_admins.c.group_id == group.id,
+                    group_admins.c.user_id == user_id,
+                ),
+                select(literal(GroupRole.MEMBER.value)).where(
+                    group_members.c.group_id == group.id,
+                    group_members.c.user_id == user_id,
+                ),
+            )
+        ).scalars()
+        # A user listed as both is an admin
+        found = {GroupRole(role) for role in found}
+        roles[key] = (
+            GroupRole.ADMIN
+            if GroupRole.ADMIN in found
+            else GroupRole.MEMBER if found else None
+        )
+
+    return roles[key]
+
+
+def user_group_ids(user_id):
+    """Groups the user owns, administrates or is a member of"""
+    return union(
+        select(Group.id).where(Group.owner_id == user_id),
+        select(group_admins.c.group_id).where(group_admins.c.user_id == user_id),
+        select(group_members.c.group_id).where(group_members.c.user_id == user_id),
+    )
+
+
+def group_user_ids(group_id):
+    """Owner, admins and members of the group"""
+    return union(
+        select(Group.owner_id).where(Group.id == group_id),
+        select(group_admins.c.user_id).where(group_admins.c.group_id == group_id),
+        select(group_members.c.user_id).where(group_members.c.group_id == group_id),
+    )
+
+
+def _set_role(group, user_id, role):
+    """Replace the user's admin/member row with role (None removes both)"""
+    for table in (group_admins, group_members):
+        db.session.execute(
+            delete(table).where(
+                table.c.group_id == group.id, table.c.user_id == user_id
+            )
+        )
+
+    if role is not None:
+        table = group_admins if role == GroupRole.ADMIN else group_members
+        db.session.execute(insert(table).values(group_id=group.id, user_id=user_id))
+
+    _roles()[(group.id, user_id)] = role
+
+
+def add_member(group, user_id):
+    """Add the user as a member, False if already in the group"""
+    if get_group_role(group, user_id) is not None:
+        return False
+
+    _set_role(group, user_id, GroupRole.MEMBER)
+    return True
+
+
+def remove_from_group(group, user_id):
+    """Remove a member or admin, returns the role the user had"""
+    role = get_group_role(group, user_id)
+    if role in (GroupRole.ADMIN, GroupRole.MEMBER):
+        _set_role(group, user_id, None)
+
+    return role
+
+
+def promote_to_admin(group, user_id):
+    _set_role(group, user_id, GroupRole.ADMIN)
+
+
+def demote_to_member(group, user_id):
+    _set_role(group, user_id, GroupRole.MEMBER)
+
+
+def create_invitation(group, invitee_id, inviter_id):
+    """Invite the user to the group, None if already invited"""
+    invitation = Invitation(
+        group_id=group.id, invitee_id=invitee_id, inviter_id=inviter_id
+    )
+
+    try:
+        # Unique per group and invitee, a concurrent invite may win
+        with db.session.begin_nested():
+            db.session.add(invitation)
+    except IntegrityError:
+        return None
+
+    return invitation
+
+
+def dedupe_memberships():
+    """
+    Remove duplicate and empty admin and member rows, and member rows of admins,
+    so the tables can get their primary keys. Run before upgrading.
+    """
+    removed = 0
+
+    for table in (group_admins, group_members):
+        rows = db.session.execute(
+            select(table.c.group_id, table.c.user_id)
+            .where(table.c.group_id.is_not(None), table.c.user_id.is_not(None))
+            .distinct()
+        ).all()
+
+        removed += db.session.execute(delete(table)).rowcount - len(rows)
+        if rows:
+            db.session.execute(insert(table), [row._asdict() for row in rows])
+
+    removed += db.session.execute(
+        delete(group_members).where(
+            exists().where(
+                and_(
+                    group_admins.c.group_id == group_members.c.group_id,
+                    group_admins.c.user_id == group_members.c.user_id,
+                )
+            )
+        )
+    ).rowcount
+
+    db.session.commit()
+
+    return removed
@@ -1,18 +1,308 @@
-from app.events import connected_users
-from app.models import Message, db
+from datetime import datetime
+from typing import Optional
+
+import msgspec
+from flask import abort
+from sqlalchemy import case, delete, func, select, union_all, update
+from sqlalchemy.exc import IntegrityError
+
+from app.events import user_room
+from app.models import Conversation, Message, User, db
 from app.services import socketio
+from app.services.counters import decrement, increment
+from app.services.pagination import keyset_condition
+from app.services.tasks import on_commit
+from app.utils.helpers import get_presigned_url
+from app.utils.images import variant_key
+from app.utils.time_utils import format_message_time
+
+HISTORY_KEYS = (Message.created_at, Message.id)
+
+
+class SenderProfile(msgspec.Struct):
+    id: int
+    username: str
+    name: str
+    surname: str
+    image: Optional[str]
+
+
+class HistoryMessage(msgspec.Struct):
+    id: int
+    sender_id: int
+    recipient_id: int
+    content: str
+    created_at: str
+    created_at_iso: str
+
+
+class MessageHistory(msgspec.Struct):
+    """A page of messages, senders are sent once in a map by id"""
+
+    messages: list[HistoryMessage]
+    senders: dict[int, SenderProfile]
+    next_before: Optional[str] = None
+
+
+def _pair(user_id, other_user_id):
+    """Conversation primary key, the smaller user id comes first"""
+    return min(user_id, other_user_id), max(user_id, other_user_id)
+
+
+def _unread_column(user_id, other_user_id):
+    """Unread counter column of user_id in the pair"""
+    return (
+        Conversation.user1_unread
+        if user_id < other_user_id
+        else Conversation.user2_unread
+    )
+
+
+def _pair_filter(user_id, other_user_id):
+    user1_id, user2_id = _pair(user_id, other_user_id)
+    return (Conversation.user1_id == user1_id, Conversation.user2_id == user2_id)
 
 
 def create_message(sender_id, recipient_id, content):
     message = Message(recipient_id=recipient_id, sender_id=sender_id, content=content)
 
     db.session.add(message)
+    db.session.flush()
+
+    update_conversation(message)
+    increment(User.unread_message_count, recipient_id)
 
     return message
 
 
+def update_conversation(message):
+    """Store message as the last one of its conversation and count it unread"""
+    unread = _unread_column(message.recipient_id, message.sender_id)
+    values = {
+        "last_message_id": message.id,
+        "last_sender_id": message.sender_id,
+        "last_message_preview": message.content[: Conversation.PREVIEW_LENGTH],
+        "last_message_at": message.created_at,
+    }
+
+    statement = (
+        update(Conversation)
+        .where(*_pair_filter(message.sender_id, message.recipient_id))
+        .values({**values, unread.key: unread + 1})
+        .execution_options(synchronize_session=False)
+    )
+
+    if db.session.execute(statement).rowcount:
+        return
+
+    user1_id, user2_id = _pair(message.sender_id, message.recipient_id)
+    try:
+        # Another request may create the same conversation concurrently
+        with db.session.begin_nested():
+            db.session.add(
+                Conversation(
+                    user1_id=user1_id,
+                    user2_id=user2_id,
+                    **values,
+                    **{unread.key: 1},
+                )
+            )
+    except IntegrityError:
+        db.session.execute(statement)
+
+
+def emit_messages_read(user_id, sender_id, unread_total):
+    """Push the read conversation and new unread total to user's other tabs"""
+    socketio.emit(
+        "messages_read",
+        {"sender_id": sender_id, "unread_messages": unread_total},
+        to=user_room(user_id),
+    )
+
+
+def mark_conversation_read(user_id, other_user_id):
+    """
+    Mark messages from other user as read in one UPDATE and reset the counters.
+    Returns the number of messages marked and user's remaining unread total.
+    """
+    read_count = db.session.execute(
+        update(Message)
+        .where(
+            Message.sender_id == other_user_id,
+            Message.recipient_id == user_id,
+            Message.is_read == False,
+        )
+        .values(is_read=True)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    db.session.execute(
+        update(Conversation)
+        .where(*_pair_filter(user_id, other_user_id))
+        .values({_unread_column(user_id, other_user_id).key: 0})
+        .execution_options(synchronize_session=False)
+    )
+
+    unread_total = decrement(
+        User.unread_message_count, user_id, read_count, returning=True
+    )
+
+    # Other tabs of the user update their badges once the read state is saved
+    on_commit(emit_messages_read, user_id, other_user_id, unread_total)
+
+    return read_count, unread_total
+
+
+def rebuild_conversations():
+    """Recompute every conversation from the messages"""
+    db.session.execute(delete(Conversation))
+
+    user1_id = case(
+        (Message.sender_id < Message.recipient_id, Message.sender_id),
+        else_=Message.recipient_id,
+    )
+    user2_id = case(
+        (Message.sender_id > Message.recipient_id, Message.sender_id),
+        else_=Message.recipient_id,
+    )
+    # Latest message per pair, highest id wins on equal timestamps
+    ranked = select(
+        Message.id,
+        Message.sender_id,
+        Message.recipient_id,
+        Message.content,
+        Message.created_at,
+        func.row_number()
+        .over(
+            partition_by=(user1_id, user2_id),
+            order_by=(Message.created_at.desc(), Message.id.desc()),
+        )
+        .label("rank"),
+    ).subquery()
+
+    unread_counts = {
+        (recipient_id, sender_id): count
+        for recipient_id, sender_id, count in db.session.execute(
+            select(Message.recipient_id, Message.sender_id, func.count(Message.id))
+            .where(Message.is_read == False)
+            .group_by(Message.recipient_id, Message.sender_id)
+        )
+    }
+
+    rows = db.session.execute(select(ranked).where(ranked.c.rank == 1)).all()
+    for row in rows:
+        user1, user2 = _pair(row.sender_id, row.recipient_id)
+        db.session.add(
+            Conversation(
+                user1_id=user1,
+                user2_id=user2,
+                last_message_id=row.id,
+                last_sender_id=row.sender_id,
+                last_message_preview=row.content[: Conversation.PREVIEW_LENGTH],
+                last_message_at=row.created_at,
+                user1_unread=unread_counts.get((user1, user2), 0),
+                user2_unread=unread_counts.get((user2, user1), 0),
+            )
+        )
+
+    db.session.commit()
+
+    return len(rows)
+
+
 def emit_message(message):
-    """Emit message to specific user"""
-    recipient_sid = connected_users.get(message.recipient_id)
-    if recipient_sid:
-        socketio.emit("message", message.to_dict(), to=recipient_sid)
+    """Emit message to every connection of the recipient, on any worker"""
+    socketio.emit("message", message.to_dict(), to=user_room(message.recipient_id))
+
+
+def encode_before(message):
+    """History cursor of a message, <created_at>,<id>"""
+    return f"{message.created_at.isoformat()},{message.id}"
+
+
+def decode_before(before):
+    """Key values of a history cursor, None without one"""
+    if not before:
+        return None
+
+    try:
+        created_at, message_id = before.rsplit(",", 1)
+        return datetime.fromisoformat(created_at), int(message_id)
+    except ValueError:
+        abort(400)
+
+
+def get_message_history(user_id, other_user_id, before=None, limit=20):
+    """
+    Messages between the users older than the before key values, newest first.
+    Each direction is read from the (sender, recipient, created_at) index and
+    the two are merged. Returns the messages and the cursor of the next page.
+    """
+
+    def direction(sender_id, recipient_id):
+        query = select(Message.id).where(
+            Message.sender_id == sender_id, Message.recipient_id == recipient_id
+        )
+        if before:
+            query = query.where(keyset_condition(HISTORY_KEYS, before))
+
+        latest = query.order_by(*[key.desc() for key in HISTORY_KEYS])
+        return select(latest.limit(limit + 1).subquery())
+
+    messages = db.session.execute(
+        select(
+            Message.id,
+            Message.sender_id,
+            Message.recipient_id,
+            Message.content,
+            Message.created_at,
+        )
+        .where(
+            Message.id.in_(
+                union_all(
+                    direction(user_id, other_user_id), direction(other_user_id, user_id)
+                )
+            )
+        )
+        .order_by(*[key.desc() for key in HISTORY_KEYS])
+        .limit(limit + 1)
+    ).all()
+
+    if len(messages) <= limit:
+        return messages, None
+
+    messages = messages[:limit]
+    return messages, encode_before(messages[-1])
+
+
+def encode_message_history(messages, next_before, users):
+    """JSON of a history page, with the profiles of its senders among users"""
+    sender_ids = {message.sender_id for message in messages}
+
+    return msgspec.json.encode(
+        MessageHistory(
+            messages=[
+                HistoryMessage(
+                    id=message.id,
+                    sender_id=message.sender_id,
+                    recipient_id=message.recipient_id,
+                    content=message.content,
+                    created_at=format_message_time(message.created_at),
+                    created_at_iso=message.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+                )
+                for message in messages
+            ],
+            senders={
+                user.id: SenderProfile(
+                    id=user.id,
+                    username=user.username,
+                    name=user.name,
+                    surname=user.surname,
+                    image=get_presigned_url(variant_key(user.image, "thumb")),
+                )
+                for user in users
+                if user.id in sender_ids
+            },
+            next_before=next_before,
+        )
+    )
@@ -1,8 +1,113 @@
-from sqlalchemy import select
+import threading
+from datetime import datetime, timedelta, timezone
 
-from app.events import connected_users
-from app.models import Notification, db
+from flask import current_app
+from sqlalchemy import exists, func, insert, or_, select, update
+
+from app.events import user_room
+from app.models import (
+    Notification,
+    NotificationEnum,
+    Post,
+    User,
+    db,
+    notification_actors,
+)
 from app.services import socketio
+from app.services.counters import decrement, increment, supports_returning
+from app.services.pagination import paginate
+from app.services.tasks import enqueue, on_commit
+
+NOTIFICATION_KEYS = (Notification.created_at, Notification.id)
+
+# Latest actors kept on an aggregated notification
+RECENT_ACTORS = 3
+
+# Notifications with an emit scheduled in this process
+_pending_emits = set()
+_pending_lock = threading.Lock()
+
+
+def _aggregate_target(notification_type, post_id, comment_id, group_id):
+    """Condition matching notifications of the same target, None if not aggregated"""
+    match notification_type:
+        case NotificationEnum.POST_LIKE | NotificationEnum.POST_COMMENT:
+            return Notification.post_id == post_id
+        case NotificationEnum.COMMENT_LIKE:
+            return Notification.comment_id == comment_id
+        case NotificationEnum.POST_SHARE:
+            # Share notifications point to the reshares of the same post
+            parent_id = select(Post.parent_id).where(Post.id == post_id)
+            return Notification.post_id.in_(
+                select(Post.id).where(Post.parent_id == parent_id.scalar_subquery())
+            )
+        case NotificationEnum.GROUP_INVITE | NotificationEnum.INVITE_ACCEPTED:
+            return Notification.group_id == group_id
+        case _:
+            return None
+
+
+def _find_aggregate(recipient_id, notification_type, target):
+    """Recipient's latest unread notification of the target within the window"""
+    window = current_app.config.get("NOTIFICATION_AGGREGATE_WINDOW", 3600)
+    if target is None or not window:
+        return None
+
+    since = datetime.now(timezone.utc) - timedelta(seconds=window)
+
+    return db.session.scalars(
+        select(Notification)
+        .where(
+            Notification.recipient_id == recipient_id,
+            Notification.is_read == False,
+            Notification.notification_type == notification_type,
+            Notification.created_at >= since,
+            target,
+        )
+        .order_by(Notification.created_at.desc())
+        .limit(1)
+        .with_for_update()
+    ).first()
+
+
+def _add_actor(notification_id, user_id):
+    db.session.execute(
+        insert(notification_actors).values(
+            notification_id=notification_id, user_id=user_id
+        )
+    )
+
+
+def _is_counted(notification, user_id):
+    """Whether the user is already counted in the notification's actor_count"""
+    return db.session.scalar(
+        select(
+            exists().where(
+                notification_actors.c.notification_id == notification.id,
+                notification_actors.c.user_id == user_id,
+            )
+        )
+    )
+
+
+def _fold(notification, sender_id, post_id, comment_id):
+    """Make sender the latest actor, counting them once"""
+    if not _is_counted(notification, sender_id):
+        # Notifications from before actors were recorded count their recent actors
+        if sender_id not in notification.recent_actors():
+            notification.actor_count = (notification.actor_count or 1) + 1
+        _add_actor(notification.id, sender_id)
+
+    actors = notification.recent_actors()
+
+    actors = [sender_id] + [actor for actor in actors if actor != sender_id]
+    notification.recent_actor_ids = ",".join(map(str, actors[:RECENT_ACTORS]))
+    notification.sender_id = sender_id
+
+    # Link to the latest comment or reshare and move to the top
+    notification.post_id = post_id
+    notification.comment_id = comment_id
+    notification.created_at = func.now()
 
 
 def create_notification(
@@ -13,6 +118,17 @@ def create_notification(
     comment_id=None,
     group_id=None,
 ):
+    """
+    Notify the recipient. Likes, comments, shares and invites fold into the
+    recipient's unread notification of the same target from the last
+    NOTIFICATION_AGGREGATE_WINDOW seconds, e.g. "X and 12 others liked your post".
+    """
+    target = _aggregate_target(notification_type, post_id, comment_id, group_id)
+    notification = _find_aggregate(recipient_id, notification_type, target)
+    if notification is not None:
+        _fold(notification, sender_id, post_id, comment_id)
+        return notification
+
     notification = Notification(
         recipient_id=recipient_id,
         sender_id=sender_id,
@@ -20,18 +136,136 @@ def create_notification(
         post_id=post_id,
         comment_id=comment_id,
         group_id=group_id,
+        actor_count=1,
+        recent_actor_ids=str(sender_id),
     )
 
     db.session.add(notification)
+    # Notification must be flushed to have an id
+    db.session.flush()
+    _add_actor(notification.id, sender_id)
+    increment(User.unread_notification_count, recipient_id)
 
     return notification
 
 
+def create_notification_once(
+    recipient_id, sender_id, notification_type, post_id=None, comment_id=None
+):
+    """
+    Create a notification unless the sender already sent the same one, so
+    liking again after unliking does not notify the recipient twice. The
+    sender may be any of the actors folded into it, not only the latest.
+    """
+    already_sent = db.session.scalar(
+        select(
+            exists().where(
+                Notification.recipient_id == recipient_id,
+                Notification.notification_type == notification_type,
+                Notification.post_id == post_id,
+                Notification.comment_id == comment_id,
+                or_(
+                    Notification.sender_id == sender_id,
+                    Notification.id.in_(
+                        select(notification_actors.c.notification_id).where(
+                            notification_actors.c.user_id == sender_id
+                        )
+                    ),
+                ),
+            )
+        )
+    )
+    if already_sent:
+        return None
+
+    return create_notification(
+        recipient_id,
+        sender_id,
+        notification_type,
+        post_id=post_id,
+        comment_id=comment_id,
+    )
+
+
+def deliver_notification(
+    recipient_id,
+    sender_id,
+    notification_type,
+    post_id=None,
+    comment_id=None,
+    group_id=None,
+    once=False,
+):
+    """Create, commit and emit a notification, run as a background task"""
+    notification_type = NotificationEnum(notification_type)
+    if once:
+        notification = create_notification_once(
+            recipient_id, sender_id, notification_type, post_id, comment_id
+        )
+    else:
+        notification = create_notification(
+            recipient_id, sender_id, notification_type, post_id, comment_id, group_id
+        )
+
+    db.session.commit()
+
+    if notification is not None:
+        emit_notification(notification)
+
+
+def notify(recipient_id, sender_id, notification_type, once=False, **targets):
+    """
+    Notify the recipient in the background, once the request commits.
+    With once the sender notifies about the same target only once.
+    """
+    enqueue(
+        deliver_notification,
+        recipient_id,
+        sender_id,
+        notification_type.value,
+        once=once,
+        **targets,
+    )
+
+
 def emit_notification(notification):
-    """Emit notification to specific user"""
-    recipient_sid = connected_users.get(notification.recipient_id)
-    if recipient_sid:
-        socketio.emit("notification", notification.to_dict(), to=recipient_sid)
+    """
+    Emit notification to every connection of the recipient, on any worker.
+    Emits of a notification within NOTIFICATION_EMIT_DELAY seconds are sent once,
+    with its state at the end of the delay.
+    """
+    delay = current_app.config.get("NOTIFICATION_EMIT_DELAY", 2)
+    if not delay:
+        _emit(notification)
+        return
+
+    with _pending_lock:
+        if notification.id in _pending_emits:
+            return
+        _pending_emits.add(notification.id)
+
+    socketio.start_background_task(
+        _emit_later, current_app._get_current_object(), notification.id, delay
+    )
+
+
+def _emit(notification):
+    socketio.emit(
+        "notification", notification.to_dict(), to=user_room(notification.recipient_id)
+    )
+
+
+def _emit_later(app, notification_id, delay):
+    socketio.sleep(delay)
+
+    with app.app_context():
+        # Events committed from here on schedule their own emit
+        with _pending_lock:
+            _pending_emits.discard(notification_id)
+
+        notification = db.session.get(Notification, notification_id)
+        if notification is not None and not notification.is_read:
+            _emit(notification)
 
 
 def get_unread_notifications(user_id):
@@ -44,26 +278,22 @@ def get_unread_notifications(user_id):
     )
 
 
-def get_all_unread_notifications(user_id, page=1, per_page=10):
+def get_all_unread_notifications(user_id, page=1, per_page=10, cursor=None):
     """Get user's unread notifications"""
-    query = (
-        select(Notification)
-        .filter_by(recipient_id=user_id, is_read=False)
-        .order_by(Notification.created_at.desc())
-    )
+    query = select(Notification).filter_by(recipient_id=user_id, is_read=False)
 
-    return db.paginate(query, page=page, per_page=per_page)
+    return paginate(
+        query, NOTIFICATION_KEYS, page=page, per_page=per_page, cursor=cursor
+    )
 
 
-def get_notifications(user_id, page=1, per_page=10):
+def get_notifications(user_id, page=1, per_page=10, cursor=None):
     """Get user's all notifications"""
-    query = (
-        select(Notification)
-        .filter_by(recipient_id=user_id)
-        .order_by(Notification.created_at.desc())
-    )
+    query = select(Notification).filter_by(recipient_id=user_id)
 
-    return db.paginate(query, page=page, per_page=per_page)
+    return paginate(
+        query, NOTIFICATION_KEYS, page=page, per_page=per_page, cursor=cursor
+    )
 
 
 def get_next_notification(user_id, notificationIds):
@@ -80,14 +310,96 @@ def get_next_notification(user_id, notificationIds):
     return next_unread_notification
 
 
+def _mark_read(*conditions):
+    """Mark matching unread notifications as read in one UPDATE, return their ids"""
+    unread = (Notification.is_read == False, *conditions)
+    statement = (
+        update(Notification)
+        .values(is_read=True)
+        .execution_options(synchronize_session=False)
+    )
+
+    if supports_returning():
+        return (
+            db.session.execute(statement.where(*unread).returning(Notification.id))
+            .scalars()
+            .all()
+        )
+
+    ids = db.session.execute(select(Notification.id).where(*unread)).scalars().all()
+    if ids:
+        db.session.execute(statement.where(Notification.id.in_(ids)))
+
+    return ids
+
+
+def emit_notifications_read(user_id, notification_ids, unread_count):
+    """Push read notifications and the new unread count to user's other tabs"""
+    socketio.emit(
+        "notifications_read",
+        {"ids": notification_ids, "unread_notifications": unread_count},
+        to=user_room(user_id),
+    )
+
+
+def _release_read(user_id, notification_ids):
+    if not notification_ids:
+        return
+
+    unread_count = decrement(
+        User.unread_notification_count,
+        user_id,
+        len(notification_ids),
+        returning=True,
+    )
+    on_commit(emit_notifications_read, user_id, notification_ids, unread_count)
+
+
 def mark_as_read(notification_id, user_id):
-    """Mark notification as read"""
-    notification = Notification.query.filter(
+    """Mark notification as read, return False if user has no such notification"""
+    ids = _mark_read(
         Notification.id == notification_id, Notification.recipient_id == user_id
-    ).first()
+    )
 
-    if notification:
-        notification.is_read = True
-        db.session.commit()
+    if not ids:
+        # Already read or not found
+        return db.session.execute(
+            select(
+                exists().where(
+                    Notification.id == notification_id,
+                    Notification.recipient_id == user_id,
+                )
+            )
+        ).scalar()
 
-    return notification
+    _release_read(user_id, ids)
+    db.session.commit()
+
+    return True
+
+
+def mark_friend_request_read(user_id, sender_id):
+    """Mark friend request notification from sender as read if not read yet"""
+    ids = _mark_read(
+        Notification.recipient_id == user_id,
+        Notification.sender_id == sender_id,
+        Notification.notification_type == NotificationEnum.FRIEND_REQUEST.value,
+    )
+
+    _release_read(user_id, ids)
+
+
+def mark_all_as_read(user_id):
+    """Mark all of user's notifications as read, return how many were unread"""
+    ids = _mark_read(Notification.recipient_id == user_id)
+
+    # Everything is read now, reset rather than subtract
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(unread_notification_count=0)
+        .execution_options(synchronize_session=False)
+    )
+    on_commit(emit_notifications_read, user_id, ids, 0)
+
+    return len(ids)
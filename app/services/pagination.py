@@ -0,0 +1,154 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import String, tuple_, type_coerce
+
+from app.services import db
+
+
+class CursorPagination:
+    """Keyset pagination result, exposes the same attributes templates use"""
+
+    def __init__(self, items, per_page, cursor=None, next_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        # No page numbers or total count in cursor mode
+        self.page = None
+        self.total = None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return bool(self.cursor)
+
+    def iter_pages(self, *args, **kwargs):
+        return iter(())
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def encode_cursor(values):
+    """Encode key values of the last item into an opaque url-safe string"""
+    raw = json.dumps(
+        [
+            value.isoformat() if isinstance(value, datetime) else value
+            for value in values
+        ]
+    )
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, keys):
+    """Decode a cursor back into values typed after the key columns"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError
+
+        return [
+            (
+                datetime.fromisoformat(value)
+                if key.type.python_type is datetime
+                else key.type.python_type(value)
+            )
+            for key, value in zip(keys, values)
+        ]
+    except (binascii.Error, TypeError, ValueError):
+        abort(400)
+
+
+def _keyset_position(keys, values):
+    """Row values of the keys and the cursor to compare"""
+    # SQLite stores func.now() as "YYYY-MM-DD HH:MM:SS" text and compares as text
+    if db.session.get_bind().dialect.name == "sqlite":
+        keys = [
+            type_coerce(key, String) if isinstance(value, datetime) else key
+            for key, value in zip(keys, values)
+        ]
+        values = [
+            value.isoformat(sep=" ") if isinstance(value, datetime) else value
+            for value in values
+        ]
+
+    return tuple_(*keys), tuple(values)
+
+
+def keyset_condition(keys, values, descending=True):
+    """Rows after the key values in the keys' order"""
+    position, values = _keyset_position(keys, values)
+    return position < values if descending else position > values
+
+
+def paginate(query, keys, page=1, per_page=10, cursor=None, descending=True):
+    """
+    Paginate a select ordered by keys.
+    Without a cursor this is the usual OFFSET pagination with a total count.
+    With a cursor (an empty one is the first page) rows are fetched after the
+    last seen key values and no count is issued.
+    Key values are read back from the item attributes with the same name.
+    """
+    order_by = [key.desc() if descending else key.asc() for key in keys]
+    query = query.order_by(*order_by)
+
+    if cursor is None:
+        return db.paginate(query, page=page, per_page=per_page)
+
+    if cursor:
+        query = query.where(
+            keyset_condition(keys, decode_cursor(cursor, keys), descending)
+        )
+
+    items = db.session.execute(query.limit(per_page + 1)).scalars().unique().all()
+
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, key.key) for key in keys])
+
+    return CursorPagination(items, per_page, cursor=cursor, next_cursor=next_cursor)
+
+
+def paginate_merged(streams, page=1, per_page=10, cursor=None):
+    """
+    Keyset pagination over several selects, e.g. indexed slices of different
+    tables, merged newest first. streams is a list of (query, keys) whose keys
+    hold the same values for the same item (e.g. a copied created_at and the
+    post id). Each select fetches at most a page after the cursor, items in
+    more than one are returned once. Always in cursor mode, without a cursor a
+    page number is skipped to by fetching the pages before it.
+    """
+    offset = (page - 1) * per_page if cursor is None else 0
+    limit = offset + per_page + 1
+    values = decode_cursor(cursor, streams[0][1]) if cursor else None
+
+    merged = {}
+    for query, keys in streams:
+        query = query.order_by(*[key.desc() for key in keys])
+        if values:
+            query = query.where(keyset_condition(keys, values))
+
+        for item in db.session.execute(query.limit(limit)).scalars().unique():
+            merged[tuple(getattr(item, key.key) for key in keys)] = item
+
+    items = [merged[position] for position in sorted(merged, reverse=True)]
+    items = items[offset : offset + per_page + 1]
+
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        next_cursor = encode_cursor(
+            [getattr(items[-1], key.key) for key in streams[0][1]]
+        )
+
+    return CursorPagination(items, per_page, cursor=cursor, next_cursor=next_cursor)
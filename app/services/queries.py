@@ -1,17 +1,60 @@
-from sqlalchemy import and_, case, func, or_, select
+from sqlalchemy import and_, exists, or_, select
+from sqlalchemy.orm import joinedload, selectinload, with_expression
 
 from app.models import (
+    Comment,
+    Conversation,
     Group,
     GroupType,
+    LatestComment,
+    Like,
     Message,
+    Notification,
     Post,
     User,
-    friends_table,
     group_admins,
     group_members,
-    received_requests_table,
 )
 from app.services import db
+from app.services.friendships import friend_ids, requester_ids
+from app.services.pagination import paginate, paginate_merged
+from app.services.search import search
+from app.services.tags import TAG_KEYS, tagged_posts_query
+from app.services.timeline import (
+    TIMELINE_KEYS,
+    timeline_enabled,
+    timeline_query,
+)
+from app.services.visibility import get_visibility
+
+# Pagination keys, newest first with id as tie-breaker
+POST_KEYS = (Post.created_at, Post.id)
+COMMENT_KEYS = (Comment.created_at, Comment.id)
+GROUP_KEYS = (Group.created_at, Group.id)
+USER_KEYS = (User.id,)
+
+
+# Everything components/post.html renders, loaded in a constant number of queries
+# (like and comment counts are counter columns)
+def post_card_options(viewer_id):
+    return (
+        joinedload(Post.user),
+        joinedload(Post.group),
+        joinedload(Post.original_post).joinedload(Post.user),
+        with_expression(
+            Post.liked_by_viewer,
+            exists().where(Like.post_id == Post.id, Like.user_id == viewer_id),
+        ),
+        selectinload(Post.recent_comments).options(
+            joinedload(LatestComment.user),
+            with_expression(
+                LatestComment.liked_by_viewer,
+                exists().where(
+                    Like.comment_id == LatestComment.id, Like.user_id == viewer_id
+                ),
+            ),
+        ),
+    )
 
 
 # Friends of user
@@ -19,26 +62,17 @@ def get_friends(
     user_id,
     page=1,
     per_page=10,
+    cursor=None,
 ):
-    query = (
-        select(User)
-        .join(friends_table, friends_table.c.friend_id == User.id)
-        .filter(friends_table.c.user_id == user_id)
-    )
+    query = select(User).where(User.id.in_(friend_ids(user_id)))
 
-    return db.paginate(query, page=page, per_page=per_page)
+    return paginate(query, USER_KEYS, page=page, per_page=per_page, cursor=cursor)
 
 
 # Friend requests for user
 def get_requests(user_id):
     requests = (
-        db.session.execute(
-            select(User)
-            .join(
-                received_requests_table, received_requests_table.c.request_id == User.id
-            )
-            .filter(received_requests_table.c.user_id == user_id)
-        )
+        db.session.execute(select(User).where(User.id.in_(requester_ids(user_id))))
         .scalars()
         .all()
     )
@@ -46,49 +80,22 @@ def get_requests(user_id):
     return requests
 
 
-# Errors fixed by ChatGPT
-# Messages between current user and users
+# Conversations of user by last activity, read from the summary table
 def get_latest_conversations(user_id):
-    # Define user1_id and user2_id without LEAST and GREATEST
-    latest_message_subquery = (
-        db.session.query(
-            case(
-                (Message.sender_id < Message.recipient_id, Message.sender_id),
-                else_=Message.recipient_id,
-            ).label("user1_id"),
-            case(
-                (Message.sender_id > Message.recipient_id, Message.sender_id),
-                else_=Message.recipient_id,
-            ).label("user2_id"),
-            db.func.max(Message.created_at).label("latest_created_at"),
-        )
-        .filter((Message.sender_id == user_id) | (Message.recipient_id == user_id))
-        .group_by("user1_id", "user2_id")
-        .subquery()
-    )
-
-    # Join with Message to get the full Message objects
-    latest_messages = (
-        db.session.query(Message)
-        .join(
-            latest_message_subquery,
-            db.or_(
-                db.and_(
-                    Message.sender_id == latest_message_subquery.c.user1_id,
-                    Message.recipient_id == latest_message_subquery.c.user2_id,
-                ),
-                db.and_(
-                    Message.sender_id == latest_message_subquery.c.user2_id,
-                    Message.recipient_id == latest_message_subquery.c.user1_id,
-                ),
+    conversations = (
+        db.session.execute(
+            select(Conversation)
+            .where(
+                or_(Conversation.user1_id == user_id, Conversation.user2_id == user_id)
             )
-            & (Message.created_at == latest_message_subquery.c.latest_created_at),
+            .options(joinedload(Conversation.user1), joinedload(Conversation.user2))
+            .order_by(Conversation.last_message_at.desc())
         )
-        .order_by(Message.created_at.desc())
+        .scalars()
         .all()
     )
 
-    return latest_messages
+    return conversations
 
 
 # Fetch messages exchanged between the current user and the other user
@@ -123,6 +130,32 @@ def has_unread_messages(user_id):
     return unread_count > 0
 
 
+# Current user with the navbar state (unread messages, latest unread notifications)
+def get_user_with_unread_state(user_id, notification_limit=5):
+    user = db.session.get(User, user_id)
+
+    if user is None:
+        return None, False, []
+
+    # Unread counters skip the notification query for most requests
+    notifications = []
+    if user.unread_notification_count:
+        notifications = (
+            db.session.execute(
+                select(Notification)
+                .where(
+                    Notification.recipient_id == user_id, Notification.is_read == False
+                )
+                .order_by(Notification.created_at.desc())
+                .limit(notification_limit)
+            )
+            .scalars()
+            .all()
+        )
+
+    return user, user.unread_message_count > 0, notifications
+
+
 def get_user_by_username(username, posts=False):
     query = select(User).filter_by(username=username, is_completed=True)
 
@@ -132,134 +165,139 @@ def get_user_by_username(username, posts=False):
     return db.first_or_404(query)
 
 
-def get_users(page=1, per_page=10, search_query=None, get_friends=False, user_id=None):
+def get_users(
+    page=1,
+    per_page=10,
+    search_query=None,
+    get_friends=False,
+    user_id=None,
+    cursor=None,
+):
     query = select(User).filter_by(is_completed=True)
-
-    if search_query:
-        search_term = f"%{search_query}%"
-        query = query.where(
-            or_(
-                User.name.ilike(search_term),
-                User.surname.ilike(search_term),
-                User.username.ilike(search_term),
-                # For full name
-                func.concat(User.name, " ", User.surname).ilike(search_term),
-            )
-        )
+    query, keys = search(query, User, search_query, USER_KEYS)
 
     if get_friends and user_id:
-        query = query.join(friends_table, friends_table.c.friend_id == User.id).filter(
-            friends_table.c.user_id == user_id
-        )
+        query = query.where(User.id.in_(friend_ids(user_id)))
 
-    return db.paginate(query, page=page, per_page=per_page)
+    return paginate(query, keys, page=page, per_page=per_page, cursor=cursor)
 
 
-def get_user_posts(page=1, per_page=10, user_id=None):
+def get_user_posts(page=1, per_page=10, user_id=None, cursor=None, viewer_id=None):
     query = (
         select(Post)
         .join(Post.user)
         .filter(
             Post.user_id == user_id,
         )
-        .order_by(Post.created_at.desc())
+        .options(*post_card_options(viewer_id))
     )
 
-    return db.paginate(query, page=page, per_page=per_page)
+    return paginate(query, POST_KEYS, page=page, per_page=per_page, cursor=cursor)
 
 
-def get_community_posts(
-    page=1, per_page=10, user_id=None, friends=None, tag_pattern=None
-):
-    query = select(Post).join(Post.user)
+# Post's comments, oldest first
+def get_post_comments(post_id, page=1, per_page=3, cursor=None):
+    query = select(Comment).filter_by(post_id=post_id)
 
-    user_groups = select(Group.id).where(
-        or_(
-            Group.owner_id == user_id,
-            Group.id.in_(
-                select(group_admins.c.group_id).where(group_admins.c.user_id == user_id)
-            ),
-            Group.id.in_(
-                select(group_members.c.group_id).where(
-                    group_members.c.user_id == user_id
-                )
-            ),
-        )
+    return paginate(
+        query,
+        COMMENT_KEYS,
+        page=page,
+        per_page=per_page,
+        cursor=cursor,
+        descending=False,
     )
 
-    group_filters = or_(
-        Post.group_id.in_(user_groups),
-        and_(
-            Post.group_id.in_(
-                select(Group.id).where(Group.group_type == GroupType.PUBLIC)
-            ),
-            or_(
-                Post.user_id == user_id,
-                Post.user_id.in_([friend.id for friend in friends]),
-                User.is_private == False,
-            ),
-        ),
-    )
 
-    user_filters = and_(
-        Post.group_id.is_(None),
-        or_(
-            Post.user_id == user_id,
-            Post.user_id.in_([friend.id for friend in friends]),
-            User.is_private == False,
-        ),
+def get_community_posts(page=1, per_page=10, user_id=None, tag=None, cursor=None):
+    public_groups = select(Group.id).where(Group.group_type == GroupType.PUBLIC)
+    outside_private_groups = or_(
+        Post.group_id.is_(None), Post.group_id.in_(public_groups)
     )
+    visibility = get_visibility(user_id)
+
+    # The timeline's indexed slice of own, friends' and group posts, merged with
+    # the newest posts of public accounts. Posts with a tag come from the
+    # hashtag index instead.
+    if timeline_enabled() and not tag:
+        # Friends' posts are in the timeline even in private groups the user
+        # is not in, those only show on the friends feed
+        timeline_posts = timeline_query(user_id).where(
+            or_(
+                outside_private_groups,
+                Post.group_id.in_(list(visibility.group_ids)),
+            )
+        )
+        public_posts = (
+            select(Post)
+            .join(Post.user)
+            .where(User.is_private == False, outside_private_groups)
+        )
 
-    all_filters = or_(group_filters, user_filters)
+        return paginate_merged(
+            [
+                (timeline_posts.options(*post_card_options(user_id)), TIMELINE_KEYS),
+                (public_posts.options(*post_card_options(user_id)), POST_KEYS),
+            ],
+            page=page,
+            per_page=per_page,
+            cursor=cursor,
+        )
 
-    if tag_pattern:
-        query = query.filter(and_(all_filters, Post.content.ilike(tag_pattern)))
+    if tag:
+        query = tagged_posts_query(tag)
+        keys = TAG_KEYS
     else:
-        query = query.filter(all_filters)
+        query = select(Post)
+        keys = POST_KEYS
+
+    query = query.join(Post.user).options(*post_card_options(user_id))
+    authors = [user_id, *visibility.friend_ids]
 
-    query = query.order_by(Post.created_at.desc())
+    # Posts in the user's groups, otherwise posts outside groups or in public
+    # groups by the user, friends or public accounts
+    query = query.filter(
+        or_(
+            Post.group_id.in_(list(visibility.group_ids)),
+            and_(
+                outside_private_groups,
+                or_(Post.user_id.in_(authors), User.is_private == False),
+            ),
+        )
+    )
 
-    return db.paginate(query, page=page, per_page=per_page)
+    return paginate(query, keys, page=page, per_page=per_page, cursor=cursor)
 
 
 def get_posts(
     page=1,
     per_page=10,
     user_id=None,
-    friends=None,
+    cursor=None,
 ):
-    query = select(Post).join(Post.user)
+    if timeline_enabled():
+        return paginate(
+            timeline_query(user_id).options(*post_card_options(user_id)),
+            TIMELINE_KEYS,
+            page=page,
+            per_page=per_page,
+            cursor=cursor,
+        )
 
-    user_groups = select(Group.id).where(
+    query = select(Post).join(Post.user).options(*post_card_options(user_id))
+    visibility = get_visibility(user_id)
+
+    query = query.where(
         or_(
-            Group.owner_id == user_id,
-            Group.id.in_(
-                select(group_admins.c.group_id).where(group_admins.c.user_id == user_id)
-            ),
-            Group.id.in_(
-                select(group_members.c.group_id).where(
-                    group_members.c.user_id == user_id
-                )
-            ),
+            Post.user_id.in_([user_id, *visibility.friend_ids]),
+            Post.group_id.in_(list(visibility.group_ids)),
         )
     )
 
-    filters = or_(
-        and_(
-            or_(
-                Post.user_id == user_id,
-                Post.user_id.in_([friend.id for friend in friends]),
-            )
-        ),
-        Post.group_id.in_(user_groups),
-    )
-
-    query = query.where(filters).order_by(Post.created_at.desc())
-
-    return db.paginate(query, page=page, per_page=per_page)
+    return paginate(query, POST_KEYS, page=page, per_page=per_page, cursor=cursor)
 
 
-def get_groups(page=1, per_page=10, search_query=None, user_id=None):
+def get_groups(page=1, per_page=10, search_query=None, user_id=None, cursor=None):
     query = select(Group)
 
     if user_id:
@@ -279,86 +317,80 @@ def get_groups(page=1, per_page=10, search_query=None, user_id=None):
             )
         )
 
-    if search_query:
-        search_term = f"%{search_query}%"
-        query = query.where(
-            or_(
-                Group.name.ilike(search_term),
-                Group.about.ilike(search_term),
-            )
-        )
+    query, keys = search(query, Group, search_query, GROUP_KEYS)
 
-    return db.paginate(
-        query.order_by(Group.created_at.desc()), page=page, per_page=per_page
-    )
+    return paginate(query, keys, page=page, per_page=per_page, cursor=cursor)
 
 
 def get_users_groups(
     page=1,
     per_page=10,
     user_id=None,
+    cursor=None,
 ):
-    query = (
-        select(Group)
-        .filter(
-            or_(
-                Group.owner_id == user_id,
-                Group.id.in_(
-                    select(group_admins.c.group_id).filter(
-                        group_admins.c.user_id == user_id
-                    )
-                ),
-                Group.id.in_(
-                    select(group_members.c.group_id).filter(
-                        group_members.c.user_id == user_id
-                    )
-                ),
-            )
+    query = select(Group).filter(
+        or_(
+            Group.owner_id == user_id,
+            Group.id.in_(
+                select(group_admins.c.group_id).filter(
+                    group_admins.c.user_id == user_id
+                )
+            ),
+            Group.id.in_(
+                select(group_members.c.group_id).filter(
+                    group_members.c.user_id == user_id
+                )
+            ),
         )
-        .order_by(Group.created_at.desc())
     )
 
-    return db.paginate(query, page=page, per_page=per_page)
+    return paginate(query, GROUP_KEYS, page=page, per_page=per_page, cursor=cursor)
 
 
 def get_group_posts(
     page=1,
     per_page=10,
     group_id=None,
+    cursor=None,
+    viewer_id=None,
 ):
     query = (
         select(Post)
         .join(Post.group)
         .filter(Post.group_id == group_id)
-        .order_by(Post.created_at.desc())
+        .options(*post_card_options(viewer_id))
     )
 
-    return db.paginate(query, page=page, per_page=per_page)
+    return paginate(query, POST_KEYS, page=page, per_page=per_page, cursor=cursor)
 
 
 def get_group_admins(
     page=1,
     per_page=10,
     group_id=None,
+    cursor=None,
 ):
     query = select(User).join(group_admins).filter(group_admins.c.group_id == group_id)
 
-    return db.paginate(query, page=page, per_page=per_page)
+    return paginate(query, USER_KEYS, page=page, per_page=per_page, cursor=cursor)
 
 
 def get_group_members(
     page=1,
     per_page=10,
     group_id=None,
+    cursor=None,
 ):
     query = (
         select(User).join(group_members).filter(group_members.c.group_id == group_id)
     )
 
-    return db.paginate(query, page=page, per_page=per_page)
+    return paginate(query, USER_KEYS, page=page, per_page=per_page, cursor=cursor)
 
 
-def get_users_to_invite(page=1, per_page=10, search_query=None, group_id=None):
+def get_users_to_invite(
+    page=1, per_page=10, search_query=None, group_id=None, cursor=None
+):
     query = select(User).filter(
         User.is_completed == True,
         User.id.not_in(
@@ -371,16 +403,6 @@ def get_users_to_invite(page=1, per_page=10, search_query=None, group_id=None):
         != select(Group.owner_id).filter(Group.id == group_id).scalar_subquery(),
     )
 
-    if search_query:
-        search_term = f"%{search_query}%"
-        query = query.where(
-            or_(
-                User.name.ilike(search_term),
-                User.surname.ilike(search_term),
-                User.username.ilike(search_term),
-                # For full name
-                func.concat(User.name, " ", User.surname).ilike(search_term),
-            ),
-        )
+    query, keys = search(query, User, search_query, USER_KEYS)
 
-    return db.paginate(query, page=page, per_page=per_page)
+    return paginate(query, keys, page=page, per_page=per_page, cursor=cursor)
@@ -0,0 +1,45 @@
+from sqlalchemy import or_, select, update
+
+from app.models import Post
+from app.services import db
+from app.utils.helpers import TEXT_RENDER_VERSION, process_text
+
+
+def rerender_posts(batch_size=500):
+    """Render stored html of posts missing it or rendered by older rules"""
+    outdated = or_(
+        Post.content_html_version.is_(None),
+        Post.content_html_version != TEXT_RENDER_VERSION,
+    )
+    total = 0
+    last_id = 0
+
+    while True:
+        rows = db.session.execute(
+            select(Post.id, Post.content)
+            .where(outdated, Post.id > last_id)
+            .order_by(Post.id)
+            .limit(batch_size)
+        ).all()
+
+        if not rows:
+            break
+
+        # Bulk UPDATE by primary key, one batch per transaction
+        db.session.execute(
+            update(Post),
+            [
+                {
+                    "id": row.id,
+                    "content_html": process_text(row.content),
+                    "content_html_version": TEXT_RENDER_VERSION,
+                }
+                for row in rows
+            ],
+        )
+        db.session.commit()
+
+        total += len(rows)
+        last_id = rows[-1].id
+
+    return total
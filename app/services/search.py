@@ -0,0 +1,76 @@
+from flask import current_app
+from sqlalchemy import and_, case, or_, select
+from sqlalchemy.orm import with_expression
+
+from app.models import Group, User
+from app.services import db
+from app.utils.helpers import normalize_search_text
+
+
+class SearchBackend:
+    """
+    Matches every word of the term anywhere in the normalized search column.
+    Results starting with the term rank first, then those with a word starting
+    with it. On PostgreSQL the trigram index serves these LIKE patterns.
+    """
+
+    def match(self, column, term):
+        return and_(*[column.contains(word, autoescape=True) for word in term.split()])
+
+    def score(self, column, term):
+        return case(
+            (column.startswith(term, autoescape=True), 2),
+            (column.contains(f" {term}", autoescape=True), 1),
+            else_=0,
+        )
+
+
+class TrigramSearchBackend(SearchBackend):
+    """PostgreSQL pg_trgm, also matches misspelled words by word similarity"""
+
+    def match(self, column, term):
+        return or_(super().match(column, term), column.op("%>")(term))
+
+
+SEARCH_BACKENDS = {"like": SearchBackend, "trigram": TrigramSearchBackend}
+
+
+def get_search_backend():
+    return SEARCH_BACKENDS[current_app.config.get("SEARCH_BACKEND", "like")]()
+
+
+def search(query, model, search_query, keys):
+    """
+    Filter query by the model's search column and rank the matches.
+    Returns the query and pagination keys with the score first.
+    """
+    term = normalize_search_text(search_query)
+    if not term:
+        return query, keys
+
+    backend = get_search_backend()
+    score = backend.score(model.search_text, term).label("search_score")
+
+    query = query.where(backend.match(model.search_text, term)).options(
+        with_expression(model.search_score, score)
+    )
+
+    return query, (score, *keys)
+
+
+def reindex_search(batch_size=500):
+    """Fill the search column of every user and group"""
+    total = 0
+
+    for model in (User, Group):
+        rows = db.session.execute(
+            select(model).execution_options(yield_per=batch_size)
+        ).scalars()
+
+        for row in rows:
+            row.search_text = row.build_search_text()
+            total += 1
+
+    db.session.commit()
+
+    return total
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, desc, func, insert, select
+
+from app.models import Post, PostTag
+from app.services import db
+from app.utils.helpers import extract_hashtags
+
+# Pagination keys for tagged posts, created_at is copied from the post
+TAG_KEYS = (PostTag.created_at, Post.id)
+
+
+def normalize_tag(tag):
+    """Tag as stored in the index, lowercase without the leading #"""
+    return tag.strip().lstrip("#").lower()
+
+
+def _post_tags(content):
+    # Longer tags don't fit the column
+    return sorted(
+        tag for tag in extract_hashtags(content) if len(tag) <= PostTag.tag.type.length
+    )
+
+
+def index_post_tags(post):
+    """Store the hashtags of a new post"""
+    tags = _post_tags(post.content)
+    if not tags:
+        return
+
+    db.session.flush()
+
+    db.session.execute(
+        insert(PostTag),
+        [
+            {"tag": tag, "post_id": post.id, "created_at": post.created_at}
+            for tag in tags
+        ],
+    )
+
+
+def backfill_post_tags(batch_size=1000):
+    """Rebuild the hashtag index from every post's content"""
+    db.session.execute(delete(PostTag))
+
+    total = 0
+    posts = db.session.execute(
+        select(Post.id, Post.content, Post.created_at)
+        .where(Post.content.contains("#"))
+        .execution_options(yield_per=batch_size)
+    )
+
+    for batch in posts.partitions():
+        rows = [
+            {"tag": tag, "post_id": post.id, "created_at": post.created_at}
+            for post in batch
+            for tag in _post_tags(post.content)
+        ]
+        if rows:
+            db.session.execute(insert(PostTag), rows)
+            total += len(rows)
+
+    db.session.commit()
+
+    return total
+
+
+def tagged_posts_query(tag):
+    """Posts with the tag, paginate by TAG_KEYS to use the index"""
+    return (
+        select(Post).join(PostTag, PostTag.post_id == Post.id).where(PostTag.tag == tag)
+    )
+
+
+def get_trending_tags(hours=24, limit=10):
+    """Most used tags of posts created in the last hours, with their counts"""
+    since = datetime.now(timezone.utc) - timedelta(hours=hours)
+    uses = func.count(PostTag.post_id).label("uses")
+
+    return db.session.execute(
+        select(PostTag.tag, uses)
+        .where(PostTag.created_at >= since)
+        .group_by(PostTag.tag)
+        .order_by(desc(uses), PostTag.tag)
+        .limit(limit)
+    ).all()
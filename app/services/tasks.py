@@ -0,0 +1,237 @@
+import importlib
+from datetime import datetime, timedelta, timezone
+
+import msgspec
+from flask import current_app
+from sqlalchemy import delete, event, select
+from sqlalchemy.orm import Session
+
+from app.models import Job
+from app.services import db, socketio
+
+
+def task_name(func):
+    """Importable name of a task function, as module:name"""
+    return f"{func.__module__}:{func.__qualname__}"
+
+
+def resolve_task(name):
+    module, qualname = name.split(":")
+    return getattr(importlib.import_module(module), qualname)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+class TaskQueue:
+    """
+    Pool of background workers (greenlets under gevent) running queued tasks
+    in an app context. A failed task is retried with a doubling delay.
+    """
+
+    def __init__(self, app, workers=4, retries=3, retry_delay=1):
+        self.app = app
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        # Queue of the Socket.IO async mode, so waiting workers don't block
+        self.queue = socketio.server.eio.create_queue()
+        for _ in range(workers):
+            socketio.start_background_task(self._work)
+
+    def put(self, func, args, kwargs, delay=0, attempt=1):
+        if delay:
+            # Sleep outside the pool so waiting tasks don't hold a worker
+            socketio.start_background_task(
+                self._put_later, func, args, kwargs, delay, attempt
+            )
+        else:
+            self.queue.put((func, args, kwargs, attempt))
+
+    def _put_later(self, func, args, kwargs, delay, attempt):
+        socketio.sleep(delay)
+        self.queue.put((func, args, kwargs, attempt))
+
+    def _work(self):
+        while True:
+            func, args, kwargs, attempt = self.queue.get()
+            try:
+                with self.app.app_context():
+                    func(*args, **kwargs)
+            except Exception:
+                self.app.logger.exception(
+                    "Task %s failed, attempt %s", task_name(func), attempt
+                )
+                if attempt <= self.retries:
+                    delay = self.retry_delay * 2 ** (attempt - 1)
+                    self.put(func, args, kwargs, delay, attempt + 1)
+
+
+def get_task_queue():
+    if "task_queue" not in current_app.extensions:
+        current_app.extensions["task_queue"] = TaskQueue(
+            current_app._get_current_object(),
+            workers=current_app.config.get("TASK_WORKERS", 4),
+            retries=current_app.config.get("TASK_RETRIES", 3),
+            retry_delay=current_app.config.get("TASK_RETRY_DELAY", 1),
+        )
+
+    return current_app.extensions["task_queue"]
+
+
+def enqueue(func, *args, **kwargs):
+    """Run func(*args, **kwargs) in the background, see enqueue_in"""
+    enqueue_in(0, func, *args, **kwargs)
+
+
+def enqueue_in(delay, func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) in the background after delay seconds.
+    Inside a transaction the task is only queued once it commits, and dropped
+    if it rolls back. With TASK_QUEUE "database" the task is stored as a Job
+    for `flask tasks work`, so arguments must be msgpack serializable.
+    """
+    mode = current_app.config.get("TASK_QUEUE", "local")
+
+    if mode == "sync":
+        _run_inline(func, args, kwargs)
+        return
+
+    # The request's session, scoped_session doesn't proxy in_transaction()
+    session = db.session()
+
+    if mode == "database":
+        in_transaction = session.in_transaction()
+        session.add(
+            Job(
+                name=task_name(func),
+                payload=msgspec.msgpack.encode([args, kwargs]),
+                run_at=_now() + timedelta(seconds=delay),
+            )
+        )
+        if not in_transaction:
+            session.commit()
+        return
+
+    if session.in_transaction():
+        session.info.setdefault("pending_tasks", []).append((func, args, kwargs, delay))
+    else:
+        get_task_queue().put(func, args, kwargs, delay)
+
+
+def on_commit(func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs) in this process once the current transaction
+    commits, or right away outside one. Dropped if the transaction rolls back,
+    e.g. so clients aren't pushed state that was never saved.
+    """
+    session = db.session()
+
+    if session.in_transaction():
+        session.info.setdefault("commit_callbacks", []).append((func, args, kwargs))
+    else:
+        func(*args, **kwargs)
+
+
+def _run_inline(func, args, kwargs):
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        current_app.logger.exception("Task %s failed", task_name(func))
+
+
+@event.listens_for(Session, "after_commit")
+def _queue_pending_tasks(session):
+    for func, args, kwargs in session.info.pop("commit_callbacks", ()):
+        func(*args, **kwargs)
+
+    pending = session.info.pop("pending_tasks", None)
+    if pending:
+        queue = get_task_queue()
+        for func, args, kwargs, delay in pending:
+            queue.put(func, args, kwargs, delay)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending_tasks(session):
+    session.info.pop("commit_callbacks", None)
+    session.info.pop("pending_tasks", None)
+
+
+def _claim_jobs(limit):
+    """Due jobs, leased to this worker by pushing their run_at forward"""
+    now = _now()
+    jobs = db.session.scalars(
+        select(Job)
+        .where(Job.run_at <= now)
+        .order_by(Job.run_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+    lease = current_app.config.get("TASK_LEASE", 300)
+    claimed = []
+    for job in jobs:
+        job.attempts += 1
+        job.run_at = now + timedelta(seconds=lease)
+        claimed.append((job.id, job.name, job.payload, job.attempts))
+
+    db.session.commit()
+
+    return claimed
+
+
+def run_jobs(limit=10):
+    """Run up to limit due jobs, returns how many succeeded and failed"""
+    retries = current_app.config.get("TASK_RETRIES", 3)
+    retry_delay = current_app.config.get("TASK_RETRY_DELAY", 1)
+    succeeded = failed = 0
+
+    for job_id, name, payload, attempts in _claim_jobs(limit):
+        try:
+            args, kwargs = msgspec.msgpack.decode(payload)
+            resolve_task(name)(*args, **kwargs)
+        except Exception as error:
+            db.session.rollback()
+            current_app.logger.exception("Job %s %s failed", job_id, name)
+
+            job = db.session.get(Job, job_id)
+            job.last_error = repr(error)
+            # Retry with a doubling delay, keep the job without run_at at the end
+            job.run_at = (
+                _now() + timedelta(seconds=retry_delay * 2 ** (attempts - 1))
+                if attempts <= retries
+                else None
+            )
+            db.session.commit()
+            failed += 1
+            continue
+
+        db.session.execute(delete(Job).where(Job.id == job_id))
+        db.session.commit()
+        succeeded += 1
+
+    return succeeded, failed
+
+
+def work(limit=10, poll_interval=1.0, once=False):
+    """Run due jobs until stopped, sleeping poll_interval when there are none"""
+    while True:
+        succeeded, failed = run_jobs(limit)
+        if once:
+            return
+        if not succeeded and not failed:
+            # Lets background tasks of the jobs (e.g. delayed emits) run
+            socketio.sleep(poll_interval)
+
+
+def retry_failed_jobs():
+    """Queue jobs that failed every attempt again, returns how many"""
+    jobs = db.session.scalars(select(Job).where(Job.run_at.is_(None))).all()
+    for job in jobs:
+        job.attempts = 0
+        job.run_at = _now()
+    db.session.commit()
+
+    return len(jobs)
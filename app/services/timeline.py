@@ -0,0 +1,165 @@
+from flask import current_app
+from sqlalchemy import and_, delete, exists, insert, literal, or_, select, union
+
+from app.models import (
+    Group,
+    Post,
+    TimelineEntry,
+    User,
+    group_admins,
+    group_members,
+)
+from app.services import db
+from app.services.friendships import friend_ids
+from app.services.memberships import user_group_ids
+
+# Pagination keys for timeline_query, created_at is copied from the post
+TIMELINE_KEYS = (TimelineEntry.created_at, Post.id)
+
+
+def timeline_enabled():
+    return current_app.config.get("TIMELINE_ENABLED", False)
+
+
+def _insert_missing(user_id, posts):
+    """Insert posts (id, created_at) into user's timeline, skipping existing rows"""
+    posts = posts.subquery()
+
+    db.session.execute(
+        insert(TimelineEntry).from_select(
+            ["user_id", "post_id", "created_at"],
+            select(literal(user_id), posts.c.id, posts.c.created_at).where(
+                ~exists().where(
+                    TimelineEntry.user_id == user_id,
+                    TimelineEntry.post_id == posts.c.id,
+                )
+            ),
+        )
+    )
+
+
+def push_post(post):
+    """Fan a new post out to the author, author's friends and group participants"""
+    if not timeline_enabled():
+        return
+
+    db.session.flush()
+
+    recipients = [
+        select(literal(post.user_id).label("user_id")),
+        friend_ids(post.user_id),
+    ]
+
+    if post.group_id:
+        recipients += [
+            select(Group.owner_id).where(Group.id == post.group_id),
+            select(group_admins.c.user_id).where(
+                group_admins.c.group_id == post.group_id
+            ),
+            select(group_members.c.user_id).where(
+                group_members.c.group_id == post.group_id
+            ),
+        ]
+
+    recipients = union(*recipients).subquery()
+
+    db.session.execute(
+        insert(TimelineEntry).from_select(
+            ["user_id", "post_id", "created_at"],
+            select(recipients.c.user_id, Post.id, Post.created_at).join_from(
+                recipients, Post, Post.id == post.id
+            ),
+        )
+    )
+
+
+def backfill_author(user_id, author_id):
+    """Add author's posts to user's timeline (e.g. after becoming friends)"""
+    if not timeline_enabled():
+        return
+
+    _insert_missing(
+        user_id, select(Post.id, Post.created_at).where(Post.user_id == author_id)
+    )
+
+
+def prune_author(user_id, author_id):
+    """Remove author's posts from user's timeline unless visible through a group"""
+    if not timeline_enabled():
+        return
+
+    hidden_posts = select(Post.id).where(
+        Post.user_id == author_id,
+        or_(Post.group_id.is_(None), Post.group_id.not_in(user_group_ids(user_id))),
+    )
+
+    db.session.execute(
+        delete(TimelineEntry).where(
+            TimelineEntry.user_id == user_id,
+            TimelineEntry.post_id.in_(hidden_posts),
+        )
+    )
+
+
+def backfill_group(user_id, group_id):
+    """Add group's posts to user's timeline (e.g. after joining the group)"""
+    if not timeline_enabled():
+        return
+
+    _insert_missing(
+        user_id, select(Post.id, Post.created_at).where(Post.group_id == group_id)
+    )
+
+
+def prune_group(user_id, group_id):
+    """Remove group's posts from user's timeline except own and friends' posts"""
+    if not timeline_enabled():
+        return
+
+    hidden_posts = select(Post.id).where(
+        Post.group_id == group_id,
+        Post.user_id != user_id,
+        Post.user_id.not_in(friend_ids(user_id)),
+    )
+
+    db.session.execute(
+        delete(TimelineEntry).where(
+            TimelineEntry.user_id == user_id,
+            TimelineEntry.post_id.in_(hidden_posts),
+        )
+    )
+
+
+def rebuild_timeline(user_id):
+    """Recompute a user's whole timeline from posts, friends and groups"""
+    db.session.execute(delete(TimelineEntry).where(TimelineEntry.user_id == user_id))
+
+    _insert_missing(
+        user_id,
+        select(Post.id, Post.created_at).where(
+            or_(
+                Post.user_id == user_id,
+                Post.user_id.in_(friend_ids(user_id)),
+                Post.group_id.in_(user_group_ids(user_id)),
+            )
+        ),
+    )
+
+
+def rebuild_all_timelines():
+    user_ids = db.session.execute(select(User.id)).scalars().all()
+
+    for user_id in user_ids:
+        rebuild_timeline(user_id)
+
+    db.session.commit()
+
+    return len(user_ids)
+
+
+def timeline_query(user_id):
+    """User's timeline posts, paginate by TIMELINE_KEYS to use the index"""
+    return select(Post).join(
+        TimelineEntry,
+        and_(TimelineEntry.post_id == Post.id, TimelineEntry.user_id == user_id),
+    )
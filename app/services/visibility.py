@@ -0,0 +1,48 @@
+from collections import namedtuple
+
+from cachelib import FileSystemCache
+from flask import current_app
+
+from app.services import db
+from app.services.friendships import friend_ids
+from app.services.memberships import user_group_ids
+from app.utils.cache import LRUCache
+
+# Whose posts and which groups' posts a user can see besides public ones
+VisibilityContext = namedtuple("VisibilityContext", ["friend_ids", "group_ids"])
+
+
+def get_visibility_cache():
+    if "visibility_cache" not in current_app.extensions:
+        cache_dir = current_app.config.get("VISIBILITY_CACHE_DIR")
+        current_app.extensions["visibility_cache"] = LRUCache(
+            maxsize=current_app.config.get("VISIBILITY_CACHE_SIZE", 4096),
+            ttl=current_app.config.get("VISIBILITY_CACHE_TTL", 60),
+            shared=FileSystemCache(cache_dir) if cache_dir else None,
+        )
+
+    return current_app.extensions["visibility_cache"]
+
+
+def _key(user_id):
+    return f"visibility:{user_id}"
+
+
+def get_visibility(user_id):
+    """Friend and group ids of the user, cached between requests"""
+    cache = get_visibility_cache()
+
+    context = cache.get(_key(user_id))
+    if context is None:
+        context = VisibilityContext(
+            friend_ids=frozenset(db.session.execute(friend_ids(user_id)).scalars()),
+            group_ids=frozenset(db.session.execute(user_group_ids(user_id)).scalars()),
+        )
+        cache.set(_key(user_id), context)
+
+    return context
+
+
+def invalidate_visibility(*user_ids):
+    """After friendships or group memberships of the users change"""
+    get_visibility_cache().delete(*[_key(user_id) for user_id in user_ids])
@@ -0,0 +1,70 @@
+// Upload profile and group images straight to storage, the settings form then
+// only submits the upload token. If anything fails the file is sent with the form.
+document
+  .querySelectorAll('input[type="file"][data-upload-folder]')
+  .forEach((imageInput) => {
+    const form = imageInput.form;
+    const submitBtns = form.querySelectorAll(
+      'button[type="submit"], button:not([type])'
+    );
+
+    // Token of the uploaded image, submitted in place of the file
+    const uploadInput = document.createElement('input');
+    uploadInput.type = 'hidden';
+    uploadInput.name = 'upload';
+    form.appendChild(uploadInput);
+
+    imageInput.addEventListener('change', () => {
+      const file = imageInput.files[0];
+      uploadInput.value = '';
+
+      if (!file) {
+        return;
+      }
+
+      // Wait for the upload before the form can be saved
+      submitBtns.forEach((btn) => (btn.disabled = true));
+
+      fetch('/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          folder: imageInput.dataset.uploadFolder,
+          group_id: imageInput.dataset.uploadGroup,
+          filename: file.name,
+        }),
+      })
+        .then((response) => {
+          if (!response.ok) {
+            throw new Error(`Upload form failed: ${response.status}`);
+          }
+          return response.json();
+        })
+        .then((upload) => {
+          // Fields of the presigned post, the file has to be the last one
+          const data = new FormData();
+          Object.entries(upload.fields).forEach(([name, value]) => {
+            data.append(name, value);
+          });
+          data.append('file', file);
+
+          return fetch(upload.url, { method: 'POST', body: data }).then(
+            (response) => {
+              if (!response.ok) {
+                throw new Error(`Upload failed: ${response.status}`);
+              }
+
+              uploadInput.value = upload.upload;
+              // Don't send the file through the app as well
+              imageInput.value = '';
+            }
+          );
+        })
+        .catch((error) => {
+          console.error('Error:', error);
+        })
+        .finally(() => {
+          submitBtns.forEach((btn) => (btn.disabled = false));
+        });
+    });
+  });
@@ -46,8 +46,41 @@ socket.on('message', function () {
   unreadBadgeWrapper.appendChild(newBadge);
 });
 
+// Messages read in another tab
+socket.on('messages_read', function (data) {
+  if (data.unread_messages > 0) return;
+
+  document.querySelectorAll('[id="unread-badge"]').forEach((badge) => {
+    badge.remove();
+  });
+});
+
+// Notifications read in another tab
+socket.on('notifications_read', function (data) {
+  data.ids.forEach((id) => {
+    removeNotificationFromDropdown(String(id));
+  });
+  displayedNotifications = displayedNotifications.filter(
+    (id) => !data.ids.includes(Number(id))
+  );
+
+  if (data.unread_notifications === 0) {
+    notificationsDisplayBase();
+    hideNotificationBadge();
+  }
+});
+
 // New notifications
 socket.on('notification', function (notification) {
+  // An aggregated notification already shown, update it in place
+  const shownNotification = document.querySelector(
+    `li[data-notification="${notification.id}"]`
+  );
+  if (shownNotification) {
+    shownNotification.replaceWith(createNotification(notification));
+    return;
+  }
+
   // Check if the notification has already been displayed
   if (!displayedNotifications.includes(notification.id)) {
     // Update notification badge
@@ -276,7 +309,11 @@ function formatTimeAgo(date) {
 }
 
 function createNotificationMessage(notification) {
-  const senderName = notification.sender_name;
+  // Aggregated notifications, e.g. "X and 12 others liked your post"
+  const others = (notification.actor_count || 1) - 1;
+  const senderName = others
+    ? `${notification.sender_name} and ${others} other${others > 1 ? 's' : ''}`
+    : notification.sender_name;
 
   switch (notification.type) {
     case 'friend_request':
@@ -0,0 +1,95 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """
+    Process-local LRU cache with per-entry expiry and hit/miss metrics.
+    An optional cachelib backend (e.g. FileSystemCache) shares entries between
+    worker processes, the local cache stays in front of it.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, shared=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and (entry[1] is None or entry[1] > now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        # Entries are stored with their expiry time so it survives sharing
+        entry = self.shared.get(key) if self.shared else None
+        if not entry or (entry[1] is not None and entry[1] <= now):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.shared_hits += 1
+        self._store(key, entry)
+
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        # A zero ttl would expire right away
+        if ttl == 0 or not self.maxsize:
+            return
+
+        entry = (value, time.time() + ttl if ttl else None)
+        if self.shared:
+            self.shared.set(key, entry, timeout=ttl or 0)
+        self._store(key, entry)
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+        if self.shared:
+            self.shared.delete_many(*keys)
+
+    def local_keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.shared:
+            self.shared.clear()
+
+    def stats(self):
+        with self._lock:
+            hits = self.hits + self.shared_hits
+            lookups = hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
@@ -1,16 +1,29 @@
-import imghdr
-import os
 import re
+import unicodedata
 from datetime import datetime
 from functools import wraps
 from typing import Literal
 from urllib.parse import urlparse
+from uuid import uuid4
 
-import boto3
-from botocore.config import Config
-from flask import flash, redirect, session, url_for
+from cachelib import FileSystemCache
+from flask import current_app, flash, redirect, session, url_for
+from itsdangerous import BadData, URLSafeTimedSerializer
 from werkzeug.utils import secure_filename
 
+from app.utils.cache import LRUCache
+from app.utils.images import (
+    IMAGE_SIZES,
+    VARIANT_KEY,
+    InvalidImage,
+    image_variants,
+    open_image,
+    upload_variant_extension,
+    variant_extension,
+    variant_key,
+)
+from app.utils.storage import get_storage
+
 
 # Login required
 def login_required(f):
@@ -62,21 +75,30 @@ def logout_required(func):
 #     mail.send(msg)
 
 
+def normalize_search_text(*parts):
+    """Lowercase, accent-free, single-spaced text of the non-empty parts"""
+    text = " ".join(part for part in parts if part)
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(text.lower().split())
+
+
 def array_to_str(array):
     return ",".join(array)
 
 
-def validate_image(stream):
-    header = stream.read(512)
-    stream.seek(0)
-    format = imghdr.what(None, header)
-    if not format:
-        return None
-    return "." + (format if format != "jpeg" else "jpg")
+def notification_actors(notification):
+    """Latest actor's name, followed by how many others did the same"""
+    sender_name = f"{notification.sender.name} {notification.sender.surname}"
+    others = (notification.actor_count or 1) - 1
+
+    if not others:
+        return sender_name
+    return f"{sender_name} and {others} other{'s' if others > 1 else ''}"
 
 
 def create_notification_message(notification):
-    sender_name = f"{notification.sender.name} {notification.sender.surname}"
+    sender_name = notification_actors(notification)
 
     match notification.notification_type.value:
         case "friend_request":
@@ -127,6 +149,15 @@ def create_notification_link(notification):
             return "#"
 
 
+# Hashtags contain only letters and numbers
+HASHTAG_PATTERN = re.compile(r"#([a-zA-Z0-9]+)")
+
+
+def extract_hashtags(text):
+    """Unique lowercase hashtags in text, without the #"""
+    return {tag.lower() for tag in HASHTAG_PATTERN.findall(text or "")}
+
+
 # Generated by Claude AI
 def process_hashtags(text):
     """
@@ -140,8 +171,6 @@ def process_hashtags(text):
     Input: "Hello #World this is a #greatpost!"
     Output: 'Hello <a href="/hashtag/world">#{world}</a> this is a #<a href="/hashtag/greatpost">#{greatpost}</a>!'
     """
-    # Pattern matches # followed by letters/numbers only
-    pattern = r"#([a-zA-Z0-9]+)"
 
     def replace_tag(match):
         tag = match.group(1)  # Get the tag without the #
@@ -150,20 +179,21 @@ def process_hashtags(text):
         return f'<a href="/tags?tag={tag_lower}">#{tag}</a>'
 
     # Replace all hashtags with their link versions
-    processed_text = re.sub(pattern, replace_tag, text)
+    processed_text = HASHTAG_PATTERN.sub(replace_tag, text)
 
     return processed_text
 
 
+# Pattern for URLs - matches http://, https://, or www.
+URL_PATTERN = re.compile(r"(https?://[^\s]+)|(www\.[^\s]+)")
+
+
 # Also generated by Claude AI
 def process_urls(text):
     """
     Process text to convert URLs into clickable links.
     Matches URLs starting with http://, https://, or www.
     """
-    # Pattern for URLs - matches http://, https://, or www.
-    url_pattern = r"(https?://[^\s]+)|(www\.[^\s]+)"
-
     def replace_url(match):
         url = match.group(0)
         # Add https:// to www. urls if needed
@@ -174,11 +204,15 @@ def process_urls(text):
         return f'<a href="{full_url}" target="_blank">{url}</a>'
 
     # Replace URLs with clickable links
-    processed_text = re.sub(url_pattern, replace_url, text)
+    processed_text = URL_PATTERN.sub(replace_url, text)
 
     return processed_text
 
 
+# Stored post html older than this is rendered again, bump on changes to the rules
+TEXT_RENDER_VERSION = 1
+
+
 # Combined processor for both URLs and hashtags
 def process_text(text):
     """Process text for both URLs and hashtags"""
@@ -191,72 +225,313 @@ def process_text(text):
 
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
 
+# Content type direct uploads must be sent with, by file extension
+UPLOAD_CONTENT_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "gif": "image/gif",
+}
+
 
 # function to check file extension
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-# AWS S3 bucket connection
-s3 = boto3.client(
-    "s3",
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    config=Config(signature_version="s3v4"),
-)
+class PresignedUrlCache:
+    """
+    Presigned urls keyed by object key, in an LRUCache.
+    A url is reused until refresh_margin seconds before it expires, so browsers
+    can also cache the image under the same url.
+    """
+
+    def __init__(self, maxsize=2048, refresh_margin=300, shared=None):
+        self.refresh_margin = refresh_margin
+        self.cache = LRUCache(maxsize=maxsize, shared=shared)
+
+    def get(self, key, expires_in, sign):
+        cache_key = f"{key}:{expires_in}"
+
+        url = self.cache.get(cache_key)
+        if url is None:
+            url = sign(key, expires_in)
+            # Don't cache failures
+            if url is not None:
+                # Reuse only while the url stays valid for at least the margin
+                self.cache.set(
+                    cache_key, url, ttl=max(expires_in - self.refresh_margin, 0)
+                )
 
-# Get presigned url
-def get_presigned_url(key, expires_in=3600):
-    try:
-        url = s3.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': os.getenv("AWS_BUCKET_NAME"), 'Key': key},
-            ExpiresIn=expires_in
-        )
         return url
+
+    def invalidate(self, key):
+        self.cache.delete(
+            *[k for k in self.cache.local_keys() if k.rsplit(":", 1)[0] == key]
+        )
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def get_presigned_url_cache():
+    if "presigned_url_cache" not in current_app.extensions:
+        # Shared between worker processes on the same host if a directory is given
+        cache_dir = current_app.config.get("PRESIGNED_URL_CACHE_DIR")
+        current_app.extensions["presigned_url_cache"] = PresignedUrlCache(
+            maxsize=current_app.config.get("PRESIGNED_URL_CACHE_SIZE", 2048),
+            refresh_margin=current_app.config.get("PRESIGNED_URL_REFRESH_MARGIN", 300),
+            shared=FileSystemCache(cache_dir) if cache_dir else None,
+        )
+
+    return current_app.extensions["presigned_url_cache"]
+
+
+def _sign_url(key, expires_in):
+    try:
+        return get_storage().url(key, expires_in)
     except Exception as e:
         print("Error generating URL:", e)
         return None
 
 
+# Get presigned url
+def get_presigned_url(key, expires_in=3600):
+    if not key:
+        return _sign_url(key, expires_in)
+
+    return get_presigned_url_cache().get(key, expires_in, _sign_url)
+
+
+def store_image(key, data):
+    """Store the size variants of an uploaded image under key"""
+    storage = get_storage()
+    extension = VARIANT_KEY.match(key)["extension"]
+    for size, (content, content_type) in image_variants(data, extension).items():
+        storage.put(variant_key(key, size), content, content_type)
+
+
+def _image_owner(folder):
+    # Imported here, the models import the helpers
+    from app.models import Group, User
+
+    return Group if folder == "group-image" else User
+
+
+def record_image(key, folder, owner_id):
+    """
+    Point the user or group at its newly stored image and delete the image it
+    replaces. If the owner was deleted meanwhile the new image is deleted.
+    """
+    from app.extensions import db
+    from app.services.fragments import invalidate_all_post_cards
+
+    model = _image_owner(folder)
+    replaced = db.session.execute(
+        db.select(model.image).where(model.id == owner_id)
+    ).first()
+
+    if replaced is None:
+        delete_file_from_s3(key)
+    else:
+        db.session.execute(
+            db.update(model).where(model.id == owner_id).values(image=key)
+        )
+        delete_file_from_s3(replaced.image)
+
+    db.session.commit()
+
+    if replaced is not None:
+        # Avatars and group images are shown on post cards
+        invalidate_all_post_cards()
+
+
+def store_upload(key, data, folder, owner_id):
+    """
+    Store an uploaded image's variants, then record it on its owner, run as a
+    background task. Until then the owner keeps its previous image, so a store
+    that fails every retry never leaves it pointing at a missing object.
+    """
+    store_image(key, data)
+    record_image(key, folder, owner_id)
+
+
+def delete_stored_objects(keys):
+    """Delete stored objects in one batch, run as a background task"""
+    get_storage().delete_objects(keys)
+
+
+def _image_key(folder, name, extension):
+    """
+    Key of a new image's full size variant. Unique even for the same file name
+    within a second, so deleting the replaced image never hits the new one.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    return f"{folder}/{timestamp}-{uuid4().hex[:8]}-{name}_full.{extension}"
+
+
 # Upload image to AWS S3
 def upload_file_to_s3(
-    file, folder: Literal["user-image", "group-image"] = "user-image"
+    file, owner_id, folder: Literal["user-image", "group-image"] = "user-image"
 ):
+    """
+    Store the uploaded image of the user or group owner_id in the background
+    once the request commits, see store_upload. Returns the key of the full
+    size variant it will be recorded as, or None if the file is not an
+    allowed image.
+    """
+    # Imported here, the tasks import the models which import the helpers
+    from app.services.tasks import enqueue
+
+    # No file or an empty file input
+    if not file:
+        return None
+
+    filename = secure_filename(file.filename)
+
+    if not filename or not allowed_file(filename):
+        return None
+
+    # The uploaded file is closed after the request, pass its content
+    data = file.read()
     try:
-        filename = secure_filename(file.filename)
+        extension = variant_extension(open_image(data))
+    except InvalidImage:
+        return None
+
+    key = _image_key(folder, filename.rsplit(".", 1)[0], extension)
+
+    enqueue(store_upload, key, data, folder, owner_id)
+
+    return key
+
+
+# Delete user image from AWS S3
+def delete_file_from_s3(*keys):
+    """
+    Delete the images and their variants in the background once the request
+    commits, with one batch delete for all of them
+    """
+    from app.services.tasks import enqueue
 
-        if not filename or not allowed_file(filename):
-            return None
+    keys = sorted(
+        {variant_key(key, size) for key in keys if key for size in IMAGE_SIZES}
+    )
+    if not keys:
+        return
 
+    url_cache = get_presigned_url_cache()
+    for stored_key in keys:
+        url_cache.invalidate(stored_key)
 
-        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-        unique_filename = f"{folder}/{timestamp}-{filename}"
+    enqueue(delete_stored_objects, keys)
 
-        s3.upload_fileobj(
-            file,
-            os.getenv("AWS_BUCKET_NAME"),
-            unique_filename,
-            ExtraArgs={"ContentType": file.content_type, "ACL": "private"},
+
+def _upload_serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt="image-upload")
+
+
+def create_upload(
+    filename,
+    user_id,
+    folder: Literal["user-image", "group-image"] = "user-image",
+    group_id=None,
+):
+    """
+    Form the browser uploads an image straight to storage with, as
+    {url, fields, upload}. After uploading, the signed upload token is
+    submitted in place of the file, see complete_upload. None if the file name
+    is not an allowed image.
+    """
+    filename = secure_filename(filename or "")
+    if not filename or not allowed_file(filename):
+        return None
+
+    name, extension = filename.rsplit(".", 1)
+    extension = extension.lower()
+
+    # Uploads wait under uploads/ until they are processed
+    staging_key = f"uploads/{folder}/{uuid4().hex}.{extension}"
+
+    form = get_storage().upload_form(
+        staging_key,
+        UPLOAD_CONTENT_TYPES[extension],
+        current_app.config.get("UPLOAD_MAX_SIZE", 5 * 1024 * 1024),
+        current_app.config.get("UPLOAD_EXPIRES", 3600),
+    )
+    form["upload"] = _upload_serializer().dumps(
+        {
+            "key": staging_key,
+            "name": name,
+            "folder": folder,
+            "user_id": user_id,
+            "group_id": group_id,
+        }
+    )
+
+    return form
+
+
+def complete_upload(
+    upload,
+    user_id,
+    folder: Literal["user-image", "group-image"] = "user-image",
+    group_id=None,
+):
+    """
+    Process a finished direct upload in the background once the request
+    commits, see process_upload. Returns the key of the full size variant it
+    will be recorded as on the user or group, or None if the token is invalid,
+    expired or issued for another user, folder or group, or nothing was
+    uploaded.
+    """
+    from app.services.tasks import enqueue
+
+    try:
+        upload = _upload_serializer().loads(
+            upload, max_age=current_app.config.get("UPLOAD_EXPIRES", 3600)
         )
+    except BadData:
+        return None
 
-        # After upload file to s3 bucket, return filename
-        return unique_filename
+    if (upload["user_id"], upload["folder"], upload["group_id"]) != (
+        user_id,
+        folder,
+        group_id,
+    ):
+        return None
 
-    except Exception as e:
-        # This is a catch all exception, edit this part to fit your needs.
-        print("Something Happened: ", e)
-        return str(e)
+    if not get_storage().exists(upload["key"]):
+        return None
 
+    extension = upload_variant_extension(upload["key"].rsplit(".", 1)[1])
+    key = _image_key(folder, upload["name"], extension)
 
-# Delete user image from AWS S3
-def delete_file_from_s3(key):
-   try:
-       s3.delete_object(
-           Bucket=os.getenv("AWS_BUCKET_NAME"),
-           Key=key
-       )
-       return True
-   except Exception as e:
-       print("Error Deleting File:", e)
-       return str(e)
\ No newline at end of file
+    owner_id = group_id if folder == "group-image" else user_id
+    enqueue(process_upload, upload["key"], key, folder, owner_id)
+
+    return key
+
+
+def process_upload(staging_key, key, folder, owner_id):
+    """
+    Store the variants of a direct upload under key, record it on its owner
+    and remove the upload, run as a background task. If it is not an image
+    after all, the owner keeps its previous image.
+    """
+    storage = get_storage()
+
+    data = storage.read(staging_key)
+    # Already processed by an earlier attempt
+    if data is None:
+        return
+
+    try:
+        store_upload(key, data, folder, owner_id)
+    except InvalidImage as error:
+        current_app.logger.warning("Rejected upload %s: %s", staging_key, error)
+
+    storage.delete(staging_key)
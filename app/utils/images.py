@@ -0,0 +1,111 @@
+import io
+import re
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Longest edge of each stored variant in pixels. Avatars use thumb (up to 3rem),
+# covers and large avatars medium, group banners full.
+IMAGE_SIZES = {"thumb": 96, "medium": 320, "full": 1280}
+
+# Formats accepted on upload, by the extension they are stored with
+IMAGE_FORMATS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif"}
+
+# Larger images are rejected before decoding (decompression bombs)
+MAX_IMAGE_PIXELS = 40_000_000
+
+# Content type of the formats variants are stored in
+VARIANT_CONTENT_TYPES = {"jpg": "image/jpeg", "png": "image/png"}
+
+# Keys of processed uploads end with the variant, e.g. user-image/x_full.jpg
+VARIANT_KEY = re.compile(r"^(?P<base>.+)_full\.(?P<extension>jpg|png)$")
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def open_image(data):
+    """Open and check uploaded image bytes, raises InvalidImage"""
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.format not in IMAGE_FORMATS:
+            raise InvalidImage(f"Unsupported image format {image.format}")
+        if image.width * image.height > MAX_IMAGE_PIXELS:
+            raise InvalidImage("Image is too large")
+
+        # verify() leaves the image unusable, reopen it for processing
+        image.verify()
+        return Image.open(io.BytesIO(data))
+    except (UnidentifiedImageError, OSError, SyntaxError) as error:
+        raise InvalidImage(str(error)) from error
+
+
+def validate_image(stream):
+    """Extension of the image in stream, None if it is not a supported image"""
+    data = stream.read()
+    stream.seek(0)
+
+    try:
+        image = open_image(data)
+    except InvalidImage:
+        return None
+
+    return "." + IMAGE_FORMATS[image.format]
+
+
+def _has_alpha(image):
+    return image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+
+
+def variant_extension(image):
+    """Variants keep transparency as PNG, everything else is stored as JPEG"""
+    return "png" if _has_alpha(image) else "jpg"
+
+
+def upload_variant_extension(extension):
+    """
+    Variant format of an upload by its file extension, for uploads that are
+    keyed before their content is seen. Only PNG and GIF can be transparent.
+    """
+    return "jpg" if extension.lower() in ("jpg", "jpeg") else "png"
+
+
+def variant_key(key, size):
+    """
+    Key of a size variant of a stored image. Images stored before variants
+    existed have only the original, which is served for every size.
+    """
+    match = VARIANT_KEY.match(key or "")
+    if not match or size not in IMAGE_SIZES:
+        return key
+    return f"{match['base']}_{size}.{match['extension']}"
+
+
+def image_variants(data, extension=None):
+    """
+    Resized copies of the image for every size in IMAGE_SIZES, as
+    {size: (bytes, content_type)}, stored as extension ("jpg" or "png", by
+    default picked by variant_extension). Metadata (EXIF, GPS, comments) is
+    dropped, orientation is applied first and animations keep their first frame.
+    """
+    image = open_image(data)
+    extension = extension or variant_extension(image)
+
+    image = ImageOps.exif_transpose(image)
+    image = image.convert("RGBA" if extension == "png" else "RGB")
+
+    variants = {}
+    for size, edge in IMAGE_SIZES.items():
+        variant = image.copy()
+        variant.thumbnail((edge, edge), Image.LANCZOS)
+
+        # A new file without the source's info, so no metadata is written
+        output = io.BytesIO()
+        if extension == "png":
+            variant.save(output, "PNG", optimize=True)
+        else:
+            variant.save(output, "JPEG", quality=85, optimize=True, progressive=True)
+
+        variants[size] = (output.getvalue(), VARIANT_CONTENT_TYPES[extension])
+
+    return variants
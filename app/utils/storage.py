@@ -0,0 +1,294 @@
+import os
+import threading
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from flask import current_app
+from itsdangerous import BadData, URLSafeTimedSerializer
+
+# Url path the local and memory storages are served under, see main.media
+MEDIA_PATH = "/media"
+
+# Where the local and memory storages accept browser uploads, see main.media_upload
+UPLOAD_PATH = "/media"
+
+# Most keys S3 accepts in one DeleteObjects request
+S3_DELETE_BATCH = 1000
+
+
+class S3Storage:
+    """
+    Private objects in an S3 bucket, served through presigned urls.
+    The boto3 client is created on first use, so importing the app or running
+    commands that never touch S3 doesn't load boto3 or need AWS credentials.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        access_key=None,
+        secret_key=None,
+        max_pool_connections=50,
+        max_attempts=3,
+        connect_timeout=5,
+        read_timeout=30,
+    ):
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.max_pool_connections = max_pool_connections
+        self.max_attempts = max_attempts
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create_client()
+        return self._client
+
+    def _create_client(self):
+        import boto3
+        from botocore.config import Config
+
+        # One client (and connection pool) shared by every greenlet, sized for
+        # the concurrent uploads of the task workers and request handlers
+        return boto3.session.Session().client(
+            "s3",
+            aws_access_key_id=self.access_key,
+            aws_secret_access_key=self.secret_key,
+            config=Config(
+                signature_version="s3v4",
+                max_pool_connections=self.max_pool_connections,
+                retries={"total_max_attempts": self.max_attempts, "mode": "standard"},
+                connect_timeout=self.connect_timeout,
+                read_timeout=self.read_timeout,
+                tcp_keepalive=True,
+            ),
+        )
+
+    def put(self, key, data, content_type):
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=data,
+            ContentType=content_type,
+            ACL="private",
+        )
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+        return True
+
+    def read(self, key):
+        """Content of the object, None if there is none"""
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def delete_objects(self, keys):
+        """Delete the keys with one request per S3_DELETE_BATCH keys"""
+        keys = list(keys)
+        for start in range(0, len(keys), S3_DELETE_BATCH):
+            response = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    "Objects": [
+                        {"Key": key} for key in keys[start : start + S3_DELETE_BATCH]
+                    ],
+                    "Quiet": True,
+                },
+            )
+
+            # Quiet mode only reports the keys that failed
+            errors = response.get("Errors")
+            if errors:
+                raise RuntimeError(
+                    f"Failed to delete {len(errors)} objects, first: {errors[0]}"
+                )
+
+    def url(self, key, expires_in):
+        # Signed locally, no request to S3
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=expires_in,
+        )
+
+    def upload_form(self, key, content_type, max_size, expires_in):
+        """Presigned POST the browser uploads the object with, as {url, fields}"""
+        return self.client.generate_presigned_post(
+            self.bucket,
+            key,
+            Fields={"Content-Type": content_type},
+            Conditions=[
+                {"Content-Type": content_type},
+                ["content-length-range", 1, max_size],
+            ],
+            ExpiresIn=expires_in,
+        )
+
+
+class LocalStorage:
+    """Objects in a local directory served by the app, a stand-in for S3"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Key {key} is outside the storage directory")
+        return path
+
+    def put(self, key, data, content_type):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Readers never see a partly written file
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def read(self, key):
+        try:
+            with open(self.path(key), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete_objects(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def url(self, key, expires_in):
+        return f"{MEDIA_PATH}/{quote(key)}"
+
+    def upload_form(self, key, content_type, max_size, expires_in):
+        return signed_upload_form(key, content_type, max_size, expires_in)
+
+
+class MemoryStorage:
+    """Objects in a dict of this process, for tests and benchmarks"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, key):
+        """(data, content_type) of the object, None if there is none"""
+        return self.objects.get(key)
+
+    def exists(self, key):
+        return key in self.objects
+
+    def read(self, key):
+        stored = self.objects.get(key)
+        return stored[0] if stored else None
+
+    def put(self, key, data, content_type):
+        self.objects[key] = (data, content_type)
+
+    def delete(self, key):
+        self.objects.pop(key, None)
+
+    def delete_objects(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def url(self, key, expires_in):
+        return f"{MEDIA_PATH}/{quote(key)}"
+
+    def upload_form(self, key, content_type, max_size, expires_in):
+        return signed_upload_form(key, content_type, max_size, expires_in)
+
+
+def _upload_serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt="storage-upload")
+
+
+def signed_upload_form(key, content_type, max_size, expires_in):
+    """
+    Upload form of the local and memory storages, shaped like an S3 presigned
+    POST: the browser posts the fields and the file to url
+    """
+    policy = _upload_serializer().dumps(
+        {
+            "key": key,
+            "content_type": content_type,
+            "max_size": max_size,
+            "expires_in": expires_in,
+        }
+    )
+
+    return {
+        "url": UPLOAD_PATH,
+        "fields": {"key": key, "Content-Type": content_type, "policy": policy},
+    }
+
+
+def load_upload_policy(policy):
+    """Key, content_type and max_size of a signed upload form, None if invalid"""
+    try:
+        policy, signed_at = _upload_serializer().loads(policy, return_timestamp=True)
+    except BadData:
+        return None
+
+    age = (datetime.now(timezone.utc) - signed_at).total_seconds()
+    if age > policy["expires_in"]:
+        return None
+
+    return policy
+
+
+def create_storage(config):
+    """Storage of STORAGE_BACKEND: "s3", "local" (files in STORAGE_DIR) or "memory" """
+    backend = config.get("STORAGE_BACKEND", "s3")
+
+    if backend == "local":
+        return LocalStorage(config.get("STORAGE_DIR", "storage"))
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "s3":
+        return S3Storage(
+            os.getenv("AWS_BUCKET_NAME"),
+            access_key=os.getenv("AWS_ACCESS_KEY"),
+            secret_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+            max_pool_connections=config.get("S3_MAX_POOL_CONNECTIONS", 50),
+            max_attempts=config.get("S3_MAX_ATTEMPTS", 3),
+            connect_timeout=config.get("S3_CONNECT_TIMEOUT", 5),
+            read_timeout=config.get("S3_READ_TIMEOUT", 30),
+        )
+
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend}")
+
+
+def get_storage():
+    if "storage" not in current_app.extensions:
+        current_app.extensions["storage"] = create_storage(current_app.config)
+
+    return current_app.extensions["storage"]
@@ -1,10 +1,13 @@
 # Generated by ClaudeAI
+import os
+
 # Server socket
 bind = '127.0.0.1:8000'
 backlog = 2048
 
 # Worker processes
-workers = 1  # Start with 1 for your memory constraints
+# More than 1 needs SOCKETIO_MESSAGE_QUEUE and sticky sessions in the proxy
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
 worker_class = 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
 threads = 2
 worker_connections = 1000
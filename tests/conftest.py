@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+# Configure the app before it is created on import
+os.environ["FLASK_ENV"] = "development"
+os.environ["DATABASE_URL"] = "sqlite://"
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ["TASK_QUEUE"] = "sync"
+# Rendered post cards are not reused, so every request renders its posts
+os.environ["POST_CARD_CACHE_SIZE"] = "0"
+
+from app import app as flask_app  # noqa: E402
+from app.extensions import db  # noqa: E402
+from app.models import User  # noqa: E402
+
+# Per process caches that would outlive the database of a test
+CACHES = (
+    "visibility_cache",
+    "post_card_cache",
+    "presigned_url_cache",
+    "storage",
+    "task_queue",
+)
+
+
+def reset_database(app):
+    """Empty database and caches"""
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+    for cache in CACHES:
+        app.extensions.pop(cache, None)
+
+
+@pytest.fixture
+def app():
+    flask_app.config["TESTING"] = True
+    reset_database(flask_app)
+
+    yield flask_app
+
+    with flask_app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def reset(app):
+    """Start over with an empty database within a test"""
+    return lambda: reset_database(app)
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield
+
+
+@pytest.fixture
+def create_user():
+    """Add a completed user, call it inside an app context"""
+
+    def create(username, **fields):
+        user = User(
+            username=username,
+            email=f"{username}@example.com",
+            password="password",
+            name=username.title(),
+            surname="Tester",
+            is_completed=True,
+            **fields,
+        )
+        db.session.add(user)
+        db.session.flush()
+        return user
+
+    return create
@@ -0,0 +1,50 @@
+import re
+
+from app.extensions import db
+from app.models import Post
+from app.utils.helpers import get_presigned_url, get_presigned_url_cache
+
+
+def test_presigned_urls_are_reused(app_context):
+    cache = get_presigned_url_cache()
+    url = get_presigned_url("user-image/a_thumb.jpg")
+
+    assert get_presigned_url("user-image/a_thumb.jpg") == url
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+    cache.invalidate("user-image/a_thumb.jpg")
+    get_presigned_url("user-image/a_thumb.jpg")
+    assert cache.stats()["misses"] == 2
+
+
+def test_presigned_url_cache_is_configured_by_the_app(app, monkeypatch):
+    monkeypatch.setitem(app.config, "PRESIGNED_URL_CACHE_SIZE", 1)
+
+    with app.app_context():
+        for key in ("user-image/a_full.jpg", "user-image/b_full.jpg"):
+            get_presigned_url(key)
+
+        stats = get_presigned_url_cache().stats()
+        assert (stats["size"], stats["maxsize"], stats["evictions"]) == (1, 1, 1)
+
+
+def test_cache_stats_command(app, create_user):
+    with app.app_context():
+        user = create_user("viewer", image="user-image/viewer_full.jpg")
+        db.session.add(Post(user_id=user.id, content="Hello"))
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["cache", "stats", "--user", "viewer", "/", "/"])
+
+    assert result.exit_code == 0, result.output
+    assert result.output.count("GET / 200") == 2
+    presigned = re.search(r"presigned urls: (\d+) hits", result.output)
+    # The second page view reuses the urls signed for the first
+    assert int(presigned.group(1)) > 0
+    assert "post cards:" in result.output and "visibility:" in result.output
+
+    result = runner.invoke(args=["cache", "stats", "/"])
+    assert result.exit_code != 0
+    assert "--user" in result.output
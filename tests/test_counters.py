@@ -0,0 +1,75 @@
+import pytest
+from sqlalchemy import select, update
+
+from app.extensions import db
+from app.models import Comment, Group, GroupType, Like, Post, User
+from app.services.friendships import accept_friendship, send_friendship_request
+from app.services.messages import create_message
+
+
+@pytest.fixture
+def users(app_context, create_user):
+    ada, bob, cem = (create_user(name) for name in ("ada", "bob", "cem"))
+    db.session.commit()
+    return ada.id, bob.id, cem.id
+
+
+def counters(*columns):
+    """Values of the counter columns, by row id"""
+    model = columns[0].class_
+    return {
+        row_id: tuple(values)
+        for row_id, *values in db.session.execute(select(model.id, *columns))
+    }
+
+
+def test_reconcile_fixes_drifted_counters(app, users):
+    ada, bob, cem = users
+    send_friendship_request(ada, bob)
+    accept_friendship(bob, ada)
+    send_friendship_request(ada, cem)
+
+    group = Group(
+        name="Readers", about="Books", group_type=GroupType.PUBLIC, owner_id=ada
+    )
+    db.session.add(group)
+    db.session.flush()
+
+    post = Post(user_id=ada, content="Hello", group_id=group.id)
+    db.session.add(post)
+    db.session.flush()
+    comment = Comment(user_id=bob, post_id=post.id, content="Hi")
+    db.session.add(comment)
+    db.session.flush()
+    db.session.add_all(
+        [
+            Like(user_id=bob, post_id=post.id),
+            Like(user_id=cem, post_id=post.id),
+            Like(user_id=ada, comment_id=comment.id),
+        ]
+    )
+    create_message(bob, ada, "Hello")
+    db.session.commit()
+
+    # Counters that missed updates, or counted some twice
+    for model, values in (
+        (User, {"friend_count": 5, "post_count": 3, "unread_message_count": 2}),
+        (Post, {"like_count": 7, "comment_count": 0}),
+        (Comment, {"like_count": 0}),
+        (Group, {"post_count": 4}),
+    ):
+        db.session.execute(update(model).values(values))
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["counters", "reconcile"])
+    assert result.exit_code == 0, result.output
+    db.session.expire_all()
+
+    assert counters(User.friend_count, User.post_count, User.unread_message_count) == {
+        ada: (1, 1, 1),
+        bob: (1, 0, 0),
+        cem: (0, 0, 0),
+    }
+    assert counters(Post.like_count, Post.comment_count) == {post.id: (2, 1)}
+    assert counters(Comment.like_count) == {comment.id: (1,)}
+    assert counters(Group.post_count) == {group.id: (1,)}
@@ -0,0 +1,86 @@
+import pytest
+
+from app.events import user_room
+from app.extensions import db, socketio
+from app.models import NotificationEnum
+from app.services.messages import create_message, emit_message
+from app.services.notifications import create_notification, emit_notification
+
+
+@pytest.fixture
+def users(app, app_context, create_user, monkeypatch):
+    # Emit right away instead of batching a notification's updates
+    monkeypatch.setitem(app.config, "NOTIFICATION_EMIT_DELAY", 0)
+
+    reader, sender = create_user("reader"), create_user("sender")
+    db.session.commit()
+    return reader.id, sender.id
+
+
+@pytest.fixture
+def connect(app):
+    """Open Socket.IO connections through the in-process manager"""
+    connections = []
+
+    def connect(user_id=None):
+        client = app.test_client()
+        if user_id is not None:
+            with client.session_transaction() as session:
+                session["user_id"] = user_id
+
+        connection = socketio.test_client(app, flask_test_client=client)
+        connections.append(connection)
+        return connection
+
+    yield connect
+
+    # The manager outlives the test, leave no connection in its rooms
+    for connection in connections:
+        if connection.is_connected():
+            connection.disconnect()
+
+
+def received(connection):
+    """Events the connection got, as (event, data)"""
+    events = []
+    for event in connection.get_received():
+        # The test client passes the data of "message" events unwrapped
+        data = event["args"] if event["name"] == "message" else event["args"][0]
+        events.append((event["name"], data))
+    return events
+
+
+def test_events_reach_every_connection_of_the_user(connect, users):
+    reader_id, sender_id = users
+    tabs = [connect(reader_id), connect(reader_id)]
+    sender_tab, anonymous = connect(sender_id), connect()
+
+    message = create_message(sender_id, reader_id, "Hello")
+    notification = create_notification(
+        reader_id, sender_id, NotificationEnum.FRIEND_REQUEST
+    )
+    db.session.commit()
+    emit_message(message)
+    emit_notification(notification)
+
+    for tab in tabs:
+        events = received(tab)
+        assert [name for name, _ in events] == ["message", "notification"]
+        assert events[0][1]["content"] == "Hello"
+        assert events[1][1]["id"] == notification.id
+
+    assert received(sender_tab) == []
+    assert received(anonymous) == []
+
+
+def test_disconnect_keeps_the_other_connections(connect, users):
+    reader_id, sender_id = users
+    closed, open_tab = connect(reader_id), connect(reader_id)
+
+    closed.disconnect()
+    emit_message(create_message(sender_id, reader_id, "Still there?"))
+
+    assert not closed.is_connected()
+    participants = socketio.server.manager.get_participants("/", user_room(reader_id))
+    assert len(list(participants)) == 1
+    assert [name for name, _ in received(open_tab)] == ["message"]
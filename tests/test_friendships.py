@@ -0,0 +1,204 @@
+import pytest
+from sqlalchemy import Column, ForeignKey, Integer, MetaData, Table, select
+
+from app.extensions import db
+from app.models import Friendship, FriendshipState, User
+from app.services.friendships import (
+    accept_friendship,
+    are_friends,
+    copy_legacy_friendships,
+    decline_friendship,
+    get_friendship_state,
+    remove_friendship,
+    send_friendship_request,
+)
+
+
+@pytest.fixture
+def users(app_context, create_user):
+    users = [create_user(name) for name in ("ada", "bob", "cem")]
+    db.session.commit()
+    return [user.id for user in users]
+
+
+def edges():
+    """Every stored edge as (user_id, other_id, state)"""
+    return set(
+        db.session.execute(
+            select(Friendship.user_id, Friendship.other_id, Friendship.state)
+        ).all()
+    )
+
+
+def friend_count(user_id):
+    return db.session.scalar(select(User.friend_count).where(User.id == user_id))
+
+
+def test_request_is_stored_from_both_sides(users):
+    ada, bob, _ = users
+
+    assert send_friendship_request(ada, bob)
+
+    assert edges() == {
+        (ada, bob, FriendshipState.REQUESTED),
+        (bob, ada, FriendshipState.RECEIVED),
+    }
+    assert get_friendship_state(ada, bob) == FriendshipState.REQUESTED
+    assert get_friendship_state(bob, ada) == FriendshipState.RECEIVED
+    assert not are_friends(ada, bob)
+
+
+def test_duplicate_request_keeps_one_edge(users):
+    ada, bob, _ = users
+    send_friendship_request(ada, bob)
+
+    assert not send_friendship_request(ada, bob)
+    # The other side already has an edge as well
+    assert not send_friendship_request(bob, ada)
+
+    db.session.commit()
+    assert edges() == {
+        (ada, bob, FriendshipState.REQUESTED),
+        (bob, ada, FriendshipState.RECEIVED),
+    }
+
+
+def test_accept_friendship(users):
+    ada, bob, cem = users
+    send_friendship_request(ada, bob)
+
+    # Only the user who received the request accepts it
+    assert not accept_friendship(ada, bob)
+    assert not accept_friendship(cem, ada)
+    assert get_friendship_state(ada, bob) == FriendshipState.REQUESTED
+
+    assert accept_friendship(bob, ada)
+    db.session.commit()
+
+    assert edges() == {
+        (ada, bob, FriendshipState.FRIENDS),
+        (bob, ada, FriendshipState.FRIENDS),
+    }
+    assert are_friends(ada, bob) and are_friends(bob, ada)
+    assert (friend_count(ada), friend_count(bob), friend_count(cem)) == (1, 1, 0)
+
+    # Accepting again neither changes the edges nor counts twice
+    assert not accept_friendship(bob, ada)
+    assert not send_friendship_request(ada, bob)
+    assert (friend_count(ada), friend_count(bob)) == (1, 1)
+
+
+def test_decline_friendship(users):
+    ada, bob, _ = users
+    send_friendship_request(ada, bob)
+
+    # The requester can't decline their own request
+    assert not decline_friendship(ada, bob)
+    assert decline_friendship(bob, ada)
+    db.session.commit()
+
+    assert edges() == set()
+    assert not decline_friendship(bob, ada)
+
+    # A declined user may ask again
+    assert send_friendship_request(ada, bob)
+
+
+def test_remove_friendship(users):
+    ada, bob, cem = users
+    send_friendship_request(ada, bob)
+
+    # A pending request is not a friendship
+    assert not remove_friendship(ada, bob)
+
+    accept_friendship(bob, ada)
+    send_friendship_request(ada, cem)
+
+    assert remove_friendship(bob, ada)
+    db.session.commit()
+
+    assert edges() == {
+        (ada, cem, FriendshipState.REQUESTED),
+        (cem, ada, FriendshipState.RECEIVED),
+    }
+    assert (friend_count(ada), friend_count(bob)) == (0, 0)
+    assert not remove_friendship(bob, ada)
+
+
+def test_copy_legacy_friendships(users):
+    ada, bob, cem = users
+    connection = db.session.connection()
+
+    # The association tables friendship replaces
+    metadata = MetaData()
+    legacy = {
+        name: Table(
+            name,
+            metadata,
+            Column("user_id", Integer, ForeignKey(User.id)),
+            Column(column, Integer, ForeignKey(User.id)),
+        )
+        for name, column in (
+            ("friends", "friend_id"),
+            ("pending_requests", "pending_id"),
+            ("received_requests", "request_id"),
+        )
+    }
+    metadata.create_all(connection)
+
+    connection.execute(
+        legacy["friends"].insert(),
+        [
+            {"user_id": ada, "friend_id": bob},
+            {"user_id": bob, "friend_id": ada},
+            # Duplicate rows, the old tables had no primary key
+            {"user_id": ada, "friend_id": bob},
+            {"user_id": ada, "friend_id": None},
+            {"user_id": ada, "friend_id": ada},
+        ],
+    )
+    connection.execute(
+        legacy["pending_requests"].insert(),
+        [
+            {"user_id": cem, "pending_id": ada},
+            # A request left behind by an accepted friendship
+            {"user_id": ada, "pending_id": bob},
+        ],
+    )
+    connection.execute(
+        legacy["received_requests"].insert(),
+        [{"user_id": ada, "request_id": cem}],
+    )
+
+    assert copy_legacy_friendships(connection) == 4
+    assert edges() == {
+        (ada, bob, FriendshipState.FRIENDS),
+        (bob, ada, FriendshipState.FRIENDS),
+        (cem, ada, FriendshipState.REQUESTED),
+        (ada, cem, FriendshipState.RECEIVED),
+    }
+
+    # Copying again adds nothing
+    assert copy_legacy_friendships(connection) == 0
+
+
+def test_request_to_requester_accepts(app, users):
+    ada, bob, _ = users
+    send_friendship_request(bob, ada)
+    db.session.commit()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = ada
+
+    assert client.post("/requests/bob").status_code == 200
+
+    assert edges() == {
+        (ada, bob, FriendshipState.FRIENDS),
+        (bob, ada, FriendshipState.FRIENDS),
+    }
+    assert (friend_count(ada), friend_count(bob)) == (1, 1)
+
+    # Requesting a friend again changes nothing
+    assert client.post("/requests/bob").status_code == 200
+    assert len(edges()) == 2
@@ -0,0 +1,30 @@
+from flask import g
+
+from app.extensions import db
+from app.models import User
+
+
+def test_each_request_loads_its_own_user(app):
+    with app.app_context():
+        users = [
+            User(
+                username=username,
+                email=f"{username}@example.com",
+                password="password",
+                is_completed=True,
+            )
+            for username in ("first", "second")
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+        user_ids = [user.id for user in users]
+
+    # g of an outer app context is shared by the requests inside it
+    with app.app_context():
+        for user_id in user_ids:
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session["user_id"] = user_id
+
+            client.get("/")
+            assert g.user.id == user_id
@@ -0,0 +1,135 @@
+import io
+
+import pytest
+from PIL import Image
+from sqlalchemy import select
+
+from app.extensions import db
+from app.models import User
+from app.utils.helpers import process_upload
+from app.utils.images import (
+    IMAGE_SIZES,
+    InvalidImage,
+    image_variants,
+    open_image,
+    validate_image,
+    variant_key,
+)
+from app.utils.storage import get_storage
+
+# EXIF tags written to the test photo
+MAKE, ORIENTATION, GPS_INFO = 0x010F, 0x0112, 0x8825
+
+
+def image_bytes(size=(1600, 1200), format="JPEG", mode="RGB", **save_options):
+    output = io.BytesIO()
+    Image.new(mode, size, "white" if mode == "1" else "teal").save(
+        output, format, **save_options
+    )
+    return output.getvalue()
+
+
+def photo_with_exif():
+    """A landscape JPEG with camera, GPS and a rotate-90 orientation tag"""
+    exif = Image.Exif()
+    exif[MAKE] = "Camera"
+    exif[ORIENTATION] = 6
+    exif.get_ifd(GPS_INFO)[1] = "N"
+    return image_bytes(exif=exif.tobytes())
+
+
+def test_rejects_non_images():
+    with pytest.raises(InvalidImage):
+        open_image(b"not an image")
+
+    # Formats other than JPEG, PNG and GIF
+    with pytest.raises(InvalidImage):
+        open_image(image_bytes(format="BMP"))
+
+    assert validate_image(io.BytesIO(b"<svg></svg>")) is None
+
+
+def test_rejects_decompression_bomb():
+    # A few kilobytes that decode to 48 million pixels
+    data = image_bytes(size=(8000, 6000), format="PNG", mode="1")
+    assert len(data) < 100_000
+
+    with pytest.raises(InvalidImage, match="too large"):
+        open_image(data)
+    assert validate_image(io.BytesIO(data)) is None
+
+
+def test_variants_drop_metadata():
+    variants = image_variants(photo_with_exif())
+
+    assert list(variants) == list(IMAGE_SIZES)
+    for size, (data, content_type) in variants.items():
+        image = Image.open(io.BytesIO(data))
+
+        assert content_type == "image/jpeg"
+        assert not image.getexif()
+        assert "exif" not in image.info
+        # Orientation is applied to the pixels, the landscape photo stands up
+        assert image.height > image.width
+        assert max(image.size) == IMAGE_SIZES[size]
+
+
+def test_transparent_images_stay_png():
+    variants = image_variants(image_bytes(format="PNG", mode="RGBA"))
+
+    for data, content_type in variants.values():
+        assert content_type == "image/png"
+        assert Image.open(io.BytesIO(data)).mode == "RGBA"
+
+
+@pytest.fixture
+def uploader(app_context, create_user):
+    user = create_user("uploader")
+    db.session.commit()
+    return user.id
+
+
+def test_processed_upload_is_served_by_size(app, uploader):
+    storage = get_storage()
+    staging_key = "uploads/user-image/photo.jpg"
+    key = "user-image/20240101-000000-abcdef12-photo_full.jpg"
+    storage.put(staging_key, photo_with_exif(), "image/jpeg")
+
+    process_upload(staging_key, key, "user-image", uploader)
+
+    assert db.session.scalar(select(User.image).where(User.id == uploader)) == key
+    assert not storage.exists(staging_key)
+
+    s3_url = app.jinja_env.filters["s3_url"]
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = uploader
+
+    for size, edge in IMAGE_SIZES.items():
+        stored_key = key.replace("_full", f"_{size}")
+        assert variant_key(key, size) == stored_key
+
+        response = client.get(s3_url(key, size=size))
+        assert response.status_code == 200
+        assert response.content_type == "image/jpeg"
+
+        image = Image.open(io.BytesIO(response.data))
+        assert max(image.size) == edge
+        assert not image.getexif()
+
+
+def test_rejected_upload_keeps_previous_image(uploader):
+    storage = get_storage()
+    previous = "user-image/old_full.jpg"
+    db.session.get(User, uploader).image = previous
+    db.session.commit()
+
+    staging_key = "uploads/user-image/fake.jpg"
+    key = "user-image/20240101-000000-abcdef12-fake_full.jpg"
+    storage.put(staging_key, b"not an image", "image/jpeg")
+
+    process_upload(staging_key, key, "user-image", uploader)
+
+    assert db.session.scalar(select(User.image).where(User.id == uploader)) == previous
+    assert not storage.exists(staging_key)
+    assert not any(storage.exists(variant_key(key, size)) for size in IMAGE_SIZES)
@@ -0,0 +1,17 @@
+import pytest
+
+from app.services.indexes import QUERY_PLANS, check_query_plans, explain
+
+
+@pytest.mark.parametrize("name", QUERY_PLANS)
+def test_query_uses_its_index(app_context, name):
+    statement, index = QUERY_PLANS[name]
+
+    assert index in explain(statement)
+
+
+def test_check_query_plans(app_context):
+    results = check_query_plans()
+
+    assert [name for name, *_ in results] == list(QUERY_PLANS)
+    assert [name for name, _, used, _ in results if not used] == []
@@ -0,0 +1,87 @@
+import pytest
+from sqlalchemy import func, select
+
+from app.extensions import db
+from app.models import Comment, Like, Notification, NotificationEnum, Post
+from app.services.likes import _insert_like, toggle_like
+
+
+@pytest.fixture
+def post(app, app_context, create_user, monkeypatch):
+    """A post by ada with a comment by bob, liked by neither"""
+    monkeypatch.setitem(app.config, "NOTIFICATION_EMIT_DELAY", 0)
+
+    ada, bob = create_user("ada"), create_user("bob")
+    post = Post(user_id=ada.id, content="Hello")
+    db.session.add(post)
+    db.session.flush()
+    db.session.add(Comment(user_id=bob.id, post_id=post.id, content="Hi"))
+    db.session.commit()
+    return post
+
+
+def like_rows(**target):
+    return db.session.scalar(select(func.count(Like.id)).filter_by(**target))
+
+
+def test_toggle_like(post):
+    comment = post.comments[0]
+    ada_id, bob_id = post.user_id, comment.user_id
+
+    assert toggle_like(bob_id, post) == (True, 1, True)
+    assert toggle_like(ada_id, post) == (True, 2, True)
+    assert toggle_like(bob_id, post) == (False, 1, False)
+    assert toggle_like(ada_id, comment) == (True, 1, True)
+    db.session.commit()
+
+    assert like_rows(post_id=post.id) == 1
+    assert like_rows(comment_id=comment.id) == 1
+    db.session.refresh(post)
+    db.session.refresh(comment)
+    assert (post.like_count, comment.like_count) == (1, 1)
+
+    assert toggle_like(ada_id, post) == (False, 0, False)
+    assert toggle_like(ada_id, comment) == (False, 0, False)
+    assert like_rows() == 0
+
+
+@pytest.mark.parametrize("dialect", ["sqlite", "mysql"])
+def test_double_insert_keeps_one_like(post, dialect, monkeypatch):
+    # Other dialects insert in a savepoint and catch the unique index violation
+    monkeypatch.setattr(db.session.get_bind().dialect, "name", dialect)
+    bob_id = post.comments[0].user_id
+    values = {"user_id": bob_id, "post_id": post.id}
+
+    # A double click whose requests both saw no like
+    assert _insert_like(values)
+    assert not _insert_like(values)
+    db.session.commit()
+
+    assert like_rows(post_id=post.id) == 1
+
+
+def test_like_notifies_once(app, post):
+    bob_id = post.comments[0].user_id
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = bob_id
+
+    responses = [client.post(f"/like/{post.id}").get_json() for _ in range(4)]
+
+    assert (
+        responses
+        == [
+            {"likes": 1, "isLiked": True},
+            {"likes": 0, "isLiked": False},
+        ]
+        * 2
+    )
+    # Liking again after unliking doesn't notify ada twice
+    notifications = db.session.scalars(select(Notification)).all()
+    assert len(notifications) == 1
+    assert notifications[0].recipient_id == post.user_id
+    assert notifications[0].notification_type == NotificationEnum.POST_LIKE
+
+    # Nor does liking one's own comment
+    client.post(f"/like/comment/{post.comments[0].id}")
+    assert db.session.scalar(select(func.count(Notification.id))) == 1
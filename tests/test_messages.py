@@ -0,0 +1,43 @@
+import pytest
+
+from app.extensions import db
+from app.services.messages import create_message
+
+
+@pytest.fixture
+def users(app_context, create_user):
+    reader, friend, other = (
+        create_user(name) for name in ("reader", "friend", "other")
+    )
+    db.session.commit()
+    return reader.id, friend.id, other.id
+
+
+def test_history_pages_through_the_conversation(app, users):
+    reader_id, friend_id, other_id = users
+    message_ids = [
+        create_message(*pair, f"Message {i}").id
+        for i, pair in enumerate([(friend_id, reader_id), (reader_id, friend_id)] * 3)
+    ]
+    create_message(other_id, reader_id, "Another conversation")
+    db.session.commit()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = reader_id
+
+    pages = []
+    before = ""
+    while before is not None:
+        data = client.get(
+            "/messages/friend/history", query_string={"before": before, "limit": 4}
+        ).get_json()
+        pages.append([message["id"] for message in data["messages"]])
+        assert set(data["senders"]) == {str(reader_id), str(friend_id)}
+        before = data["next_before"]
+
+    assert pages == [message_ids[:1:-1], message_ids[1::-1]]
+
+    assert client.get("/messages/friend/history?before=x").status_code == 400
+    # The page-numbered endpoint the history replaced
+    assert client.get("/messages/friend/more").status_code == 404
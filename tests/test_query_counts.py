@@ -0,0 +1,132 @@
+import re
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from app.extensions import db
+from app.models import Comment, Group, GroupType, Like, Post
+from app.services.friendships import accept_friendship, send_friendship_request
+from app.services.memberships import add_member
+
+# Fewer and more posts than a page, the queries per page must not grow
+PAGE_SIZES = (2, 10)
+
+
+@contextmanager
+def count_queries(app):
+    """Collect the SQL statements executed inside the block"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def seed_posts(app, create_user, count):
+    """
+    Viewer and author are friends and members of a group. The author has
+    count posts, some in the group and some reshares, each with liked comments
+    and likes, so a post card needs every relation it can show.
+    Returns the viewer's id.
+    """
+    with app.app_context():
+        viewer, author, commenter = (
+            create_user(name) for name in ("viewer", "author", "commenter")
+        )
+
+        send_friendship_request(viewer.id, author.id)
+        accept_friendship(author.id, viewer.id)
+
+        group = Group(
+            name="Readers",
+            about="Books",
+            group_type=GroupType.PUBLIC,
+            owner_id=author.id,
+        )
+        db.session.add(group)
+        db.session.flush()
+        add_member(group, viewer.id)
+
+        previous = None
+        for i in range(count):
+            post = Post(
+                user_id=author.id,
+                content=f"Post {i} #books",
+                group_id=group.id if i % 3 == 0 else None,
+                parent_id=previous.id if previous and i % 4 == 0 else None,
+            )
+            db.session.add(post)
+            db.session.flush()
+
+            db.session.add_all(
+                [
+                    Like(user_id=viewer.id, post_id=post.id),
+                    Like(user_id=commenter.id, post_id=post.id),
+                ]
+            )
+            for j in range(4):
+                comment = Comment(
+                    user_id=(viewer.id, commenter.id)[j % 2],
+                    post_id=post.id,
+                    content=f"Comment {j}",
+                )
+                db.session.add(comment)
+                db.session.flush()
+                db.session.add(Like(user_id=author.id, comment_id=comment.id))
+
+            previous = post
+
+        db.session.commit()
+
+        return viewer.id
+
+
+def page_queries(app, reset, create_user, path, count, cursor_page=False):
+    """Statements of the viewer's request of path with count posts seeded"""
+    reset()
+    # The cursor page follows a full first page
+    viewer_id = seed_posts(app, create_user, count + 10 if cursor_page else count)
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = viewer_id
+
+    if cursor_page:
+        # An empty cursor is the first page with cursor links
+        first_page = client.get(f"{path}?cursor=").get_data(as_text=True)
+        cursor = re.search(r"\?cursor=([^\"&]+)", first_page).group(1)
+        path = f"{path}?cursor={cursor}"
+
+    with count_queries(app) as statements:
+        response = client.get(path)
+
+    assert response.status_code == 200
+    return len(statements)
+
+
+@pytest.mark.parametrize(
+    "path, cursor_page",
+    [
+        ("/", False),
+        ("/", True),
+        ("/my-feed", False),
+        ("/profiles/author", False),
+    ],
+    ids=["feed", "cursor feed", "my feed", "profile"],
+)
+def test_queries_per_page_stay_flat(app, reset, create_user, path, cursor_page):
+    counts = [
+        page_queries(app, reset, create_user, path, count, cursor_page)
+        for count in PAGE_SIZES
+    ]
+
+    assert counts[0] == counts[1], f"{counts} statements for {PAGE_SIZES} posts"
@@ -0,0 +1,155 @@
+import pytest
+from sqlalchemy import select
+
+from app.extensions import db, socketio
+from app.services import counters, notifications
+from app.models import Conversation, Message, Notification, NotificationEnum, User
+from app.services.messages import create_message, mark_conversation_read
+from app.services.notifications import (
+    create_notification,
+    mark_all_as_read,
+    mark_as_read,
+)
+
+
+@pytest.fixture
+def emits(monkeypatch):
+    """Socket.IO events emitted during the test, as (event, data, room)"""
+    emitted = []
+    monkeypatch.setattr(
+        socketio,
+        "emit",
+        lambda event, data, to=None, **kwargs: emitted.append((event, data, to)),
+    )
+    return emitted
+
+
+@pytest.fixture(autouse=True, params=[True, False], ids=["returning", "select"])
+def returning(request, monkeypatch):
+    """Run each test with and without UPDATE ... RETURNING"""
+    for module in (counters, notifications):
+        monkeypatch.setattr(module, "supports_returning", lambda: request.param)
+
+
+@pytest.fixture
+def users(app_context, create_user):
+    reader, friend, other = (
+        create_user(name) for name in ("reader", "friend", "other")
+    )
+    db.session.commit()
+    return reader.id, friend.id, other.id
+
+
+def unread_counts(user_id):
+    return db.session.execute(
+        select(User.unread_message_count, User.unread_notification_count).where(
+            User.id == user_id
+        )
+    ).one()
+
+
+def test_mark_conversation_read(users, emits):
+    reader_id, friend_id, other_id = users
+    for i in range(3):
+        create_message(friend_id, reader_id, f"Message {i}")
+    create_message(other_id, reader_id, "Another conversation")
+    create_message(reader_id, friend_id, "Reply")
+    db.session.commit()
+
+    read_count, unread_total = mark_conversation_read(reader_id, friend_id)
+
+    assert (read_count, unread_total) == (3, 1)
+    # Pushed only once the read state is saved
+    assert emits == []
+
+    db.session.commit()
+
+    assert emits == [
+        (
+            "messages_read",
+            {"sender_id": friend_id, "unread_messages": 1},
+            f"user:{reader_id}",
+        )
+    ]
+    assert unread_counts(reader_id).unread_message_count == 1
+    assert unread_counts(friend_id).unread_message_count == 1
+
+    conversation = db.session.scalar(
+        select(Conversation).where(
+            Conversation.user1_id == min(reader_id, friend_id),
+            Conversation.user2_id == max(reader_id, friend_id),
+        )
+    )
+    assert conversation.unread_count(reader_id) == 0
+    assert conversation.unread_count(friend_id) == 1
+
+    unread_from_friend = db.session.scalar(
+        select(Message.id).where(
+            Message.sender_id == friend_id, Message.is_read == False
+        )
+    )
+    assert unread_from_friend is None
+
+    # Nothing left to read
+    assert mark_conversation_read(reader_id, friend_id) == (0, 1)
+
+
+def test_mark_notifications_read(users, emits):
+    reader_id, friend_id, other_id = users
+    notification_ids = [
+        create_notification(reader_id, sender_id, NotificationEnum.FRIEND_ACCEPTED).id
+        for sender_id in (friend_id, other_id)
+    ]
+    create_notification(friend_id, reader_id, NotificationEnum.FRIEND_ACCEPTED)
+    db.session.commit()
+
+    assert unread_counts(reader_id).unread_notification_count == 2
+
+    # Commits itself
+    assert mark_as_read(notification_ids[0], reader_id)
+    assert emits[-1][:2] == (
+        "notifications_read",
+        {"ids": [notification_ids[0]], "unread_notifications": 1},
+    )
+    assert unread_counts(reader_id).unread_notification_count == 1
+
+    # Read already, or not the user's
+    assert mark_as_read(notification_ids[0], reader_id)
+    assert not mark_as_read(notification_ids[1], friend_id)
+    assert len(emits) == 1
+
+    assert mark_all_as_read(reader_id) == 1
+    db.session.commit()
+
+    assert emits[-1][:2] == (
+        "notifications_read",
+        {"ids": [notification_ids[1]], "unread_notifications": 0},
+    )
+    assert unread_counts(reader_id).unread_notification_count == 0
+    assert unread_counts(friend_id).unread_notification_count == 1
+    assert (
+        db.session.scalar(
+            select(Notification.id).where(
+                Notification.recipient_id == reader_id, Notification.is_read == False
+            )
+        )
+        is None
+    )
+
+
+def test_rolled_back_read_state_is_not_pushed(users, emits):
+    reader_id, friend_id, _ = users
+    create_message(friend_id, reader_id, "Message")
+    create_notification(reader_id, friend_id, NotificationEnum.FRIEND_ACCEPTED)
+    db.session.commit()
+
+    assert mark_conversation_read(reader_id, friend_id) == (1, 0)
+    assert mark_all_as_read(reader_id) == 1
+    db.session.rollback()
+
+    assert emits == []
+    assert tuple(unread_counts(reader_id)) == (1, 1)
+
+    # Callbacks of the rolled back transaction don't run on the next commit
+    db.session.commit()
+    assert emits == []
@@ -0,0 +1,197 @@
+import io
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from PIL import Image
+from sqlalchemy import select, update
+from werkzeug.datastructures import FileStorage
+
+from app.extensions import db, socketio
+from app.models import Job, User
+from app.services.tasks import enqueue, retry_failed_jobs, run_jobs
+from app.utils.helpers import upload_file_to_s3
+from app.utils.images import IMAGE_SIZES, variant_key
+from app.utils.storage import get_storage
+
+# Names passed to flaky, once per call
+calls = []
+
+
+def flaky(name, failures):
+    """Task failing its first failures calls"""
+    calls.append(name)
+    if calls.count(name) <= failures:
+        raise RuntimeError(f"{name} failed")
+
+
+@pytest.fixture
+def task_queue(app, monkeypatch):
+    """Set TASK_QUEUE for the test, with retries short enough to wait for"""
+    calls.clear()
+    monkeypatch.setitem(app.config, "TASK_RETRIES", 2)
+    monkeypatch.setitem(app.config, "TASK_RETRY_DELAY", 0.01)
+
+    def set_mode(mode):
+        monkeypatch.setitem(app.config, "TASK_QUEUE", mode)
+
+    return set_mode
+
+
+def jobs():
+    return db.session.scalars(select(Job).order_by(Job.id)).all()
+
+
+def make_due(*job_ids):
+    """Skip the retry delay of the jobs"""
+    db.session.execute(
+        update(Job)
+        .where(Job.id.in_(job_ids))
+        .values(run_at=datetime.now(timezone.utc) - timedelta(seconds=1))
+    )
+    db.session.commit()
+
+
+def wait_for(condition, timeout=2.0):
+    """Let the queue's greenlets run until condition() holds"""
+    waited = 0.0
+    while not condition() and waited < timeout:
+        socketio.sleep(0.01)
+        waited += 0.01
+
+
+def test_local_task_is_retried(app_context, task_queue):
+    task_queue("local")
+
+    enqueue(flaky, "retried", 2)
+    enqueue(flaky, "given up", 5)
+    wait_for(lambda: len(calls) == 6)
+    # Any further retry would be due by now
+    socketio.sleep(0.1)
+
+    assert calls.count("retried") == 3
+    # The first attempt and TASK_RETRIES retries
+    assert calls.count("given up") == 3
+
+
+def test_local_task_waits_for_commit(app_context, task_queue, create_user):
+    task_queue("local")
+
+    create_user("writer")
+    enqueue(flaky, "rolled back", 0)
+    db.session.rollback()
+
+    create_user("writer")
+    enqueue(flaky, "committed", 0)
+    socketio.sleep(0.05)
+    assert calls == []
+
+    db.session.commit()
+    wait_for(lambda: calls)
+
+    assert calls == ["committed"]
+
+
+def test_database_job_is_retried(app_context, task_queue):
+    task_queue("database")
+
+    enqueue(flaky, "retried", 1)
+    enqueue(flaky, "given up", 5)
+    retried, given_up = [job.id for job in jobs()]
+
+    assert run_jobs() == (0, 2)
+    assert calls == ["retried", "given up"]
+
+    job = db.session.get(Job, retried)
+    assert job.attempts == 1
+    assert "retried failed" in job.last_error
+    # Not due before the retry delay
+    assert run_jobs() == (0, 0)
+
+    make_due(retried, given_up)
+    assert run_jobs() == (1, 1)
+    assert [job.id for job in jobs()] == [given_up]
+
+    make_due(given_up)
+    assert run_jobs() == (0, 1)
+
+    # Failed every attempt, kept without run_at until retried by hand
+    job = db.session.get(Job, given_up)
+    assert (job.attempts, job.run_at) == (3, None)
+    assert run_jobs() == (0, 0)
+
+    assert retry_failed_jobs() == 1
+    assert db.session.get(Job, given_up).attempts == 0
+
+
+def test_work_command_runs_due_jobs(app, task_queue):
+    task_queue("database")
+    with app.app_context():
+        enqueue(flaky, "worked", 0)
+        enqueue(flaky, "failed", 5)
+
+    result = app.test_cli_runner().invoke(args=["tasks", "work", "--once"])
+
+    assert result.exit_code == 0, result.output
+    assert calls == ["worked", "failed"]
+    with app.app_context():
+        assert [(job.name, job.attempts) for job in jobs()] == [("test_tasks:flaky", 1)]
+
+
+def image_file(filename="avatar.png"):
+    image = io.BytesIO()
+    Image.new("RGB", (400, 300), "teal").save(image, "PNG")
+    image.seek(0)
+    return FileStorage(stream=image, filename=filename)
+
+
+def test_image_is_recorded_once_stored(app_context, task_queue, create_user):
+    task_queue("database")
+    storage = get_storage()
+
+    old_key = "user-image/old_full.jpg"
+    for size in IMAGE_SIZES:
+        storage.put(variant_key(old_key, size), b"old", "image/jpeg")
+    user = create_user("uploader", image=old_key)
+    db.session.commit()
+
+    key = upload_file_to_s3(image_file(), user.id)
+    db.session.commit()
+
+    # Storage is down for the first attempt
+    put = storage.put
+
+    def failing_put(*args):
+        storage.put = put
+        raise ConnectionError("storage unavailable")
+
+    storage.put = failing_put
+    assert run_jobs() == (0, 1)
+
+    # The user keeps the image that still exists
+    assert db.session.scalar(select(User.image).where(User.id == user.id)) == old_key
+    assert storage.exists(variant_key(old_key, "thumb"))
+
+    make_due(*[job.id for job in jobs()])
+    assert run_jobs() == (1, 0)
+    # Then the replaced image is deleted by its own job
+    assert run_jobs() == (1, 0)
+
+    assert db.session.scalar(select(User.image).where(User.id == user.id)) == key
+    for size in IMAGE_SIZES:
+        assert storage.exists(variant_key(key, size))
+        assert not storage.exists(variant_key(old_key, size))
+
+
+def test_image_of_deleted_owner_is_removed(app_context, task_queue, create_user):
+    task_queue("database")
+    user = create_user("leaver")
+    db.session.commit()
+
+    key = upload_file_to_s3(image_file(), user.id)
+    db.session.delete(user)
+    db.session.commit()
+
+    assert run_jobs() == (1, 0)
+    assert run_jobs() == (1, 0)
+
+    assert not any(get_storage().exists(variant_key(key, size)) for size in IMAGE_SIZES)
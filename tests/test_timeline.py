@@ -0,0 +1,175 @@
+import pytest
+from sqlalchemy import select
+
+from app.extensions import db
+from app.models import Group, GroupType, Post, TimelineEntry
+from app.services.friendships import accept_friendship, send_friendship_request
+from app.services.memberships import add_member
+from app.services.queries import get_community_posts
+from app.services.timeline import rebuild_all_timelines
+
+
+@pytest.fixture
+def timeline(app, monkeypatch):
+    monkeypatch.setitem(app.config, "TIMELINE_ENABLED", True)
+
+
+@pytest.fixture
+def users(app_context, create_user):
+    """ada and bob are friends, cem is a stranger and dan a private account"""
+    ada, bob, cem = (create_user(name) for name in ("ada", "bob", "cem"))
+    dan = create_user("dan", is_private=True)
+    befriend(ada.id, bob.id)
+    db.session.commit()
+    return ada.id, bob.id, cem.id, dan.id
+
+
+def befriend(user_id, other_id):
+    send_friendship_request(user_id, other_id)
+    accept_friendship(other_id, user_id)
+
+
+def create_group(owner_id, group_type=GroupType.PUBLIC, members=()):
+    group = Group(
+        name="Readers", about="Books", group_type=group_type, owner_id=owner_id
+    )
+    db.session.add(group)
+    db.session.flush()
+    for member_id in members:
+        add_member(group, member_id)
+    db.session.commit()
+    return group.id
+
+
+def create_post(user_id, group_id=None):
+    post = Post(user_id=user_id, content="Hello", group_id=group_id)
+    db.session.add(post)
+    db.session.commit()
+    return post.id
+
+
+def login(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+    return client
+
+
+def timeline_of(user_id):
+    return set(
+        db.session.scalars(
+            select(TimelineEntry.post_id).where(TimelineEntry.user_id == user_id)
+        )
+    )
+
+
+def newest_post_id():
+    return db.session.scalar(select(Post.id).order_by(Post.id.desc()).limit(1))
+
+
+def test_new_posts_are_pushed(app, timeline, users):
+    ada, bob, cem, dan = users
+    group_id = create_group(dan, members=[cem])
+
+    login(app, ada).post("/post", data={"content": "Hello"})
+    post_id = newest_post_id()
+
+    login(app, bob).post(f"/post/{post_id}/reshare", data={"content": "Look"})
+    reshare_id = newest_post_id()
+
+    login(app, cem).post(f"/groups/{group_id}", data={"content": "Hi group"})
+    group_post_id = newest_post_id()
+
+    assert timeline_of(ada) == {post_id, reshare_id}
+    assert timeline_of(bob) == {post_id, reshare_id}
+    # Group posts reach the owner and members
+    assert timeline_of(cem) == {group_post_id}
+    assert timeline_of(dan) == {group_post_id}
+
+
+def test_friendship_backfills_and_prunes(app, timeline, users):
+    ada, _, cem, _ = users
+    ada_post = create_post(ada)
+    cem_post = create_post(cem)
+    rebuild_all_timelines()
+
+    send_friendship_request(cem, ada)
+    db.session.commit()
+    login(app, ada).post("/requests/cem/accept")
+
+    assert cem_post in timeline_of(ada)
+    assert ada_post in timeline_of(cem)
+
+    login(app, ada).delete("/friends/cem/remove")
+
+    assert cem_post not in timeline_of(ada)
+    assert ada_post not in timeline_of(cem)
+
+
+def test_group_membership_backfills_and_prunes(app, timeline, users):
+    ada, bob, cem, dan = users
+    group_id = create_group(dan, members=[cem])
+    cem_post = create_post(cem, group_id)
+    # Posts of friends stay in the timeline after leaving the group
+    bob_post = create_post(bob, group_id)
+    rebuild_all_timelines()
+
+    login(app, ada).post(f"/groups/{group_id}/join")
+    assert {cem_post, bob_post} <= timeline_of(ada)
+
+    login(app, ada).post(f"/groups/{group_id}/leave")
+    assert cem_post not in timeline_of(ada)
+    assert bob_post in timeline_of(ada)
+
+
+def community_feed(user_id, per_page=2):
+    """Post ids of every page of the community feed, by cursor"""
+    post_ids = []
+    cursor = ""
+    while cursor is not None:
+        pagination = get_community_posts(
+            user_id=user_id, per_page=per_page, cursor=cursor
+        )
+        post_ids += [post.id for post in pagination.items]
+        cursor = pagination.next_cursor
+    return post_ids
+
+
+def test_community_feed_from_timeline(app, monkeypatch, users):
+    ada, bob, cem, dan = users
+    public_group = create_group(cem)
+    private_group = create_group(dan, GroupType.PRIVATE, members=[bob])
+    ada_private_group = create_group(dan, GroupType.PRIVATE, members=[ada])
+
+    visible = [
+        create_post(ada),
+        create_post(bob),
+        create_post(cem),
+        create_post(cem, public_group),
+        create_post(dan, ada_private_group),
+        create_post(bob, public_group),
+    ]
+    hidden = [
+        # Private account that isn't a friend
+        create_post(dan),
+        # Friend's post in a private group ada isn't in
+        create_post(bob, private_group),
+        create_post(dan, private_group),
+    ]
+    visible.append(create_post(ada))
+
+    expected = community_feed(ada)
+    assert sorted(expected) == sorted(visible)
+    assert not set(expected) & set(hidden)
+
+    monkeypatch.setitem(app.config, "TIMELINE_ENABLED", True)
+    rebuild_all_timelines()
+
+    # The same posts in the same order, friends' public posts only once
+    assert community_feed(ada) == expected
+    assert community_feed(ada, per_page=3) == expected
+
+    # Page numbers of old links skip to the same posts
+    second_page = get_community_posts(user_id=ada, page=2, per_page=3)
+    assert [post.id for post in second_page.items] == expected[3:6]
+    assert second_page.has_next
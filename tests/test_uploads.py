@@ -0,0 +1,182 @@
+import io
+
+import pytest
+from PIL import Image
+from sqlalchemy import select
+
+from app.extensions import db
+from app.models import Group, GroupType, User
+from app.services.memberships import add_member, promote_to_admin
+from app.utils.images import IMAGE_SIZES, variant_key
+from app.utils.storage import get_storage
+
+
+@pytest.fixture
+def users(app_context, create_user):
+    """owner owns a group in which admin is an admin"""
+    owner, admin, other = (create_user(name) for name in ("owner", "admin", "other"))
+    group = Group(
+        name="Readers", about="Books", group_type=GroupType.PUBLIC, owner_id=owner.id
+    )
+    db.session.add(group)
+    db.session.flush()
+    add_member(group, admin.id)
+    promote_to_admin(group, admin.id)
+    db.session.commit()
+    return owner.id, admin.id, other.id, group.id
+
+
+def login(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+    return client
+
+
+def request_form(client, folder="user-image", group_id=None, filename="photo.jpg"):
+    return client.post(
+        "/uploads",
+        json={"folder": folder, "group_id": group_id, "filename": filename},
+    )
+
+
+def upload(client, form, data=None):
+    """Post the file with the form's fields, as the browser does"""
+    if data is None:
+        image = io.BytesIO()
+        Image.new("RGB", (600, 400), "teal").save(image, "JPEG")
+        data = image.getvalue()
+
+    return client.post(
+        form["url"],
+        data={**form["fields"], "file": (io.BytesIO(data), "photo.jpg")},
+        content_type="multipart/form-data",
+    )
+
+
+def save_profile(client, token, username="owner"):
+    return client.post(
+        "/settings/general",
+        data={
+            "image": (io.BytesIO(b""), ""),
+            "upload": token,
+            "name": username.title(),
+            "surname": "Tester",
+            "email": f"{username}@example.com",
+            "delete_image": "false",
+        },
+        content_type="multipart/form-data",
+    )
+
+
+def save_group(client, group_id, token):
+    return client.post(
+        f"/groups/{group_id}/settings",
+        data={
+            "image": (io.BytesIO(b""), ""),
+            "upload": token,
+            "name": "Readers",
+            "about": "Books",
+            "privacy": "public",
+            "delete_image": "false",
+        },
+        content_type="multipart/form-data",
+    )
+
+
+def image_of(model, row_id):
+    return db.session.scalar(select(model.image).where(model.id == row_id))
+
+
+def test_profile_image_round_trip(app, users):
+    owner, *_ = users
+    client = login(app, owner)
+
+    response = request_form(client)
+    assert response.status_code == 200
+    form = response.get_json()
+    staging_key = form["fields"]["key"]
+    assert staging_key.startswith("uploads/user-image/")
+
+    assert upload(client, form).status_code == 204
+    assert get_storage().exists(staging_key)
+
+    assert save_profile(client, form["upload"]).status_code == 302
+
+    key = image_of(User, owner)
+    assert key.startswith("user-image/") and key.endswith("_full.jpg")
+    assert all(get_storage().exists(variant_key(key, size)) for size in IMAGE_SIZES)
+    assert not get_storage().exists(staging_key)
+
+
+def test_group_image_round_trip(app, users):
+    owner, _, _, group_id = users
+    client = login(app, owner)
+
+    form = request_form(client, "group-image", group_id).get_json()
+    upload(client, form)
+
+    assert save_group(client, group_id, form["upload"]).status_code == 302
+    assert image_of(Group, group_id).startswith("group-image/")
+
+
+def test_group_upload_form_needs_the_owner(app, users):
+    _, admin, other, group_id = users
+
+    # Group settings are the owner's, admins included can't replace the image
+    for user_id in (admin, other):
+        response = request_form(login(app, user_id), "group-image", group_id)
+        assert response.status_code == 403
+
+    response = request_form(login(app, admin), "group-image", group_id + 1)
+    assert response.status_code == 404
+    assert request_form(login(app, admin), "group-image").status_code == 400
+
+
+def test_token_is_bound_to_user_folder_and_group(app, users):
+    owner, _, other, group_id = users
+    owner_client = login(app, owner)
+
+    profile_form = request_form(owner_client).get_json()
+    upload(owner_client, profile_form)
+    group_form = request_form(owner_client, "group-image", group_id).get_json()
+    upload(owner_client, group_form)
+
+    # Another user's token
+    assert (
+        save_profile(login(app, other), profile_form["upload"], "other").status_code
+        == 422
+    )
+    # A group image's token for the profile and the other way around
+    assert save_profile(owner_client, group_form["upload"]).status_code == 422
+    assert save_group(owner_client, group_id, profile_form["upload"]).status_code == 422
+
+    # A token for another group
+    other_group = Group(
+        name="Others", about="More", group_type=GroupType.PUBLIC, owner_id=owner
+    )
+    db.session.add(other_group)
+    db.session.commit()
+    assert (
+        save_group(owner_client, other_group.id, group_form["upload"]).status_code
+        == 422
+    )
+
+    # A tampered token
+    assert save_profile(owner_client, profile_form["upload"] + "x").status_code == 422
+
+    assert image_of(User, owner) is None
+    assert image_of(Group, group_id) is None
+
+
+def test_upload_form_is_bound_to_its_key(app, users):
+    owner, *_ = users
+    client = login(app, owner)
+    form = request_form(client).get_json()
+
+    tampered = {**form, "fields": {**form["fields"], "key": "user-image/x_full.jpg"}}
+    assert upload(client, tampered).status_code == 403
+    assert not get_storage().exists("user-image/x_full.jpg")
+
+    # Nothing was uploaded for the token
+    assert save_profile(client, form["upload"]).status_code == 422